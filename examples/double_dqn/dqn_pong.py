@@ -18,12 +18,13 @@ reinforceflow.set_random_seed(555)
 
 steps = 50000000
 env_name = 'Pong-v0'
-env = EnvFactory.make(env_name, use_smart_wrap=True)
+env = EnvFactory.make(env_name, use_smart_wrap=True, uint8_obs=True, to_gray=True,
+                      merge_last_frames=True)
 optimizer_args = {'momentum': 0.95}
 replay_size = 20000
 
 
-agent = DQNAgent(env, net_factory=DQNFactory(), use_double=True, use_gpu=True)
+agent = DQNAgent(env, net_factory=DQNFactory(input_scale=1/255.), use_double=True, use_gpu=True)
 agent.train(max_steps=steps,
             render=False,
             optimizer='rms',
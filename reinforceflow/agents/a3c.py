@@ -13,7 +13,7 @@ import tensorflow as tf
 
 import reinforceflow.utils
 from reinforceflow.core.base_agent import BaseAgent
-from reinforceflow.core import EGreedyPolicy, GreedyPolicy
+from reinforceflow.core import EGreedyPolicy, InferenceServer, GreedyPolicy
 from reinforceflow import utils_tf
 from reinforceflow import logger
 from reinforceflow.utils import discount_rewards
@@ -54,7 +54,11 @@ class A3CAgent(BaseAgent):
             self._no_op = tf.no_op()
             self.global_step = tf.Variable(0, trainable=False, name='global_step')
             self._obs_counter = tf.Variable(0, trainable=False, name='obs_counter')
-            self._obs_counter_inc = self._obs_counter.assign_add(1, use_locking=True)
+            self._obs_counter_ph = tf.placeholder('int32', [], name='obs_counter_value')
+            self._obs_counter_assign = self._obs_counter.assign(self._obs_counter_ph)
+        # Counters are kept on the host and synced with the variables at checkpoints.
+        self._obs_count = reinforceflow.utils.Counter()
+        self._step_count = reinforceflow.utils.Counter()
         self.weights = self._weights
         self.request_stop = False
         self.opt = None
@@ -145,6 +149,8 @@ class A3CAgent(BaseAgent):
               render=False,
               saver_keep=10,
               ignore_checkpoint=False,
+              inference_batch=0,
+              inference_wait=0.002,
               **kwargs):
         """Starts training of Asynchronous n-step Q-Learning agent.
 
@@ -171,6 +177,12 @@ class A3CAgent(BaseAgent):
                         When exceeds, overwrites the most earliest checkpoints.
             ignore_checkpoint: (bool) If enabled, training will start from scratch,
                                and overwrite all old checkpoints found at `log_dir` path.
+            inference_batch: (int) If set, actor threads request action values from a shared
+                             `core.InferenceServer`, which evaluates them with the global
+                             network in batches of up to `inference_batch` observations.
+                             To disable, pass 0.
+            inference_wait: (float) Maximum time (in seconds) the inference server waits
+                            for a batch to fill up.
         """
         if num_threads < 1:
             raise ValueError("Number of threads must be >= 1 (Got: %s)." % num_threads)
@@ -203,10 +215,17 @@ class A3CAgent(BaseAgent):
             thread_agents.append(agent)
         self.writer = tf.summary.FileWriter(log_dir, self.sess.graph)
         self.sess.run(tf.global_variables_initializer())
+        self._restore_counters()
         if not ignore_checkpoint and tf.train.latest_checkpoint(log_dir) is not None:
             self.load_weights(log_dir)
         last_log_step = self.obs_counter
 
+        inference = None
+        if inference_batch:
+            inference = InferenceServer(self.predict_on_batch, max_batch_size=inference_batch,
+                                        max_wait=inference_wait).start()
+            for t in thread_agents:
+                t.inference = inference
         for t in thread_agents:
             t.daemon = True
             t.start()
@@ -218,25 +237,35 @@ class A3CAgent(BaseAgent):
         self._prev_obs_step = self.obs_counter
         self._prev_opt_step = self.step_counter
         self._last_time = time.time()
-        while has_live_threads() and self.obs_counter < steps:
-            try:
-                if render:
-                    for env in envs:
-                        env.render()
-                    time.sleep(0.01)
-                step = self.obs_counter
-                if step - last_log_step >= log_freq:
-                    last_log_step = step
-                    self._write_summary()
-                    self.save_weights(log_dir)
-            except KeyboardInterrupt:
-                logger.info('Caught Ctrl+C! Stopping training process.')
-                self.request_stop = True
-        self.save_weights(log_dir)
-        logger.info('Training finished!')
-        self.writer.close()
-        for agent in thread_agents:
-            agent.close()
+        try:
+            while has_live_threads() and self.obs_counter < steps:
+                try:
+                    if render:
+                        for env in envs:
+                            env.render()
+                        time.sleep(0.01)
+                    step = self.obs_counter
+                    if step - last_log_step >= log_freq:
+                        last_log_step = step
+                        self._write_summary()
+                        if inference is not None:
+                            self._write_inference_summary(inference, step)
+                        self.save_weights(log_dir)
+                except KeyboardInterrupt:
+                    logger.info('Caught Ctrl+C! Stopping training process.')
+                    self.request_stop = True
+            self.save_weights(log_dir)
+            logger.info('Training finished!')
+        finally:
+            # Learner threads are stopped before the writer and inference server are closed.
+            self.request_stop = True
+            for agent in thread_agents:
+                agent.join()
+            self.writer.close()
+            if inference is not None:
+                inference.close()
+            for agent in thread_agents:
+                agent.close()
 
     def _train_on_batch(self, obs, actions, rewards, obs_next, term, summarize=False):
         raise NotImplementedError('Training on batch is not supported. Use `train` method instead.')
@@ -247,6 +276,7 @@ class A3CAgent(BaseAgent):
     def save_weights(self, path, model_name='model.ckpt'):
         if not os.path.exists(path):
             os.makedirs(path)
+        self.sess.run(self._obs_counter_assign, {self._obs_counter_ph: self.obs_counter})
         self._saver.save(self.sess, os.path.join(path, model_name), global_step=self.global_step)
         logger.info('Checkpoint has been saved to: %s' % os.path.join(path, model_name))
 
@@ -256,18 +286,28 @@ class A3CAgent(BaseAgent):
         if tf.gfile.IsDirectory(checkpoint):
             checkpoint = tf.train.latest_checkpoint(checkpoint)
         self._saver.restore(self.sess, save_path=checkpoint)
+        self._restore_counters()
         logger.info('Checkpoint has been restored from: %s', checkpoint)
 
+    def _restore_counters(self):
+        """Reads host-side counters from the graph variables."""
+        obs_counter, step_counter = self.sess.run([self._obs_counter, self.global_step])
+        self._obs_count.value = obs_counter
+        self._step_count.value = step_counter
+
     def increment_obs_counter(self):
-        return self.sess.run(self._obs_counter_inc)
+        return self._obs_count.increment()
+
+    def increment_step_counter(self):
+        return self._step_count.increment()
 
     @property
     def obs_counter(self):
-        return self.sess.run(self._obs_counter_inc)
+        return self._obs_count.value
 
     @property
     def step_counter(self):
-        return self.sess.run(self.global_step)
+        return self._step_count.value
 
     def predict_action(self, obs, policy=GreedyPolicy()):
         """Computes action for given observation."""
@@ -279,6 +319,7 @@ class A3CAgent(BaseAgent):
         return self.sess.run(self.net.output, {self.net.input_ph: obs_batch})
 
     def close(self):
+        self.close_evaluator()
         if self.sess:
             self.sess.close()
 
@@ -321,6 +362,8 @@ class _ThreadDQNLearner(BaseAgent, Thread):
         self._ep_reward = reinforceflow.utils.IncrementalAverage()
         self._ep_q = reinforceflow.utils.IncrementalAverage()
         self._reward_accum = 0
+        # Shared `core.InferenceServer`. If None, action values are computed by the local net.
+        self.inference = None
 
         # Inference Graph
         with tf.variable_scope(self._scope + 'network') as scope:
@@ -329,13 +372,14 @@ class _ThreadDQNLearner(BaseAgent, Thread):
             self.net = self._net_factory.make(input_shape=[None] + self.env.obs_shape,
                                               output_size=self.env.action_shape[0])
             self._weights = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope.name)
+            self._policy_step_ph = tf.placeholder('int64', [], name='policy_step')
+            self._action_op = self._build_action_op(policy, self._policy_step_ph)
 
         # Train Graph
         with tf.variable_scope(self._scope + 'optimizer'):
             self._no_op = tf.no_op()
             self.global_step = tf.Variable(0, trainable=False, name='global_step')
             self._obs_counter = tf.Variable(0, trainable=False, name='obs_counter')
-            self._obs_counter_inc = self._obs_counter.assign_add(1, use_locking=True)
             action_argmax = tf.arg_max(self._action_ph, 1, name='action_argmax')
             self._action_onehot = tf.one_hot(action_argmax, self.env.action_shape[0],
                                              1.0, 0.0, name='action_one_hot')
@@ -387,6 +431,7 @@ class _ThreadDQNLearner(BaseAgent, Thread):
                                        self._action_ph: actions,
                                        self._reward_ph: rewards
                                    })
+        self.global_agent.increment_step_counter()
         return summary
 
     def run(self):
@@ -404,9 +449,8 @@ class _ThreadDQNLearner(BaseAgent, Thread):
                 obs = self.env.reset()
             while not term and len(batch_obs) < self.batch_size:
                 current_step = self.global_agent.increment_obs_counter()
-                reward_per_action = self.predict_on_batch([obs])
                 batch_obs.append(obs)
-                action = self.policy.select_action(self.env, reward_per_action, current_step)
+                action = self._select_action(obs, current_step)
                 obs, reward, term, info = self.env.step(action)
                 self._reward_accum += reward
                 reward = np.clip(reward, -1, 1)
@@ -419,6 +463,8 @@ class _ThreadDQNLearner(BaseAgent, Thread):
                                                batch_rewards, [obs], term, write_summary)
             if write_summary:
                 prev_step = self.global_agent.obs_counter
+                if self._action_op is not None:
+                    self.policy.update(prev_step)
                 # TODO: wrap into separate func `add_reward_summary(reward)`
                 num_ep = self._ep_reward.length
                 max_r = self._ep_reward.max
@@ -433,7 +479,8 @@ class _ThreadDQNLearner(BaseAgent, Thread):
                             tf.Summary.Value(tag=self._scope + 'avgR', simple_value=avg_r),
                             tf.Summary.Value(tag=self._scope + 'avgQ', simple_value=avg_q),
                             tf.Summary.Value(tag=self._scope + 'epsilon',
-                                             simple_value=self.policy.epsilon),
+                                             simple_value=getattr(self.policy, 'epsilon',
+                                                                  0.0)),
                             tf.Summary.Value(tag=self._scope + 'metrics/num_episodes',
                                              simple_value=num_ep)
                             ]
@@ -12,7 +12,7 @@ import tensorflow as tf
 
 import reinforceflow.utils
 from reinforceflow.core.base_agent import BaseDQNAgent
-from reinforceflow.core import EGreedyPolicy
+from reinforceflow.core import EGreedyPolicy, InferenceServer
 from reinforceflow import utils_tf
 from reinforceflow import logger
 from reinforceflow.utils import discount_rewards
@@ -50,27 +50,30 @@ class AsyncDQNAgent(BaseDQNAgent):
         self._train_op = None
         self._summary_op = None
 
-    def _write_summary(self, test_episodes=3):
-        test_r = self.test(episodes=test_episodes)
-        avg_r = test_r.compute_average()
-        max_r = test_r.max
-        min_r = test_r.min
+    def _write_summary(self, test_episodes=3, async_test=False):
         obs_step = self.obs_counter
+        if async_test:
+            self.async_test(obs_step)
+        else:
+            self._write_test_summary(obs_step, self.test(episodes=test_episodes))
         obs_per_sec = (self.obs_counter - self._prev_obs_step) / (time.time() - self._last_time)
         opt_per_sec = (self.step_counter - self._prev_opt_step) / (time.time() - self._last_time)
         self._last_time = time.time()
         self._prev_obs_step = obs_step
         self._prev_opt_step = self.step_counter
-        logger.info("Global agent greedy eval. Average R: %.2f. Step: %d."
-                    % (avg_r, obs_step))
         logger.info("Performance. Observation/sec: %0.2f. Update/sec: %0.2f."
                     % (obs_per_sec, opt_per_sec))
+        logs = [tf.Summary.Value(tag='performance/observation/sec', simple_value=obs_per_sec),
+                tf.Summary.Value(tag='performance/update/sec', simple_value=opt_per_sec)]
+        self.writer.add_summary(tf.Summary(value=logs), global_step=obs_step)
+
+    def _write_test_summary(self, obs_step, test_r, *_):
+        avg_r = test_r.compute_average()
+        logger.info("Global agent greedy eval. Average R: %.2f. Step: %d."
+                    % (avg_r, obs_step))
         logs = [tf.Summary.Value(tag=self._scope + 'greedy_R', simple_value=avg_r),
-                tf.Summary.Value(tag=self._scope + 'greedy_maxR', simple_value=max_r),
-                tf.Summary.Value(tag=self._scope + 'greedy_minR', simple_value=min_r),
-                tf.Summary.Value(tag='performance/observation/sec', simple_value=obs_per_sec),
-                tf.Summary.Value(tag='performance/update/sec', simple_value=opt_per_sec)
-                ]
+                tf.Summary.Value(tag=self._scope + 'greedy_maxR', simple_value=test_r.max),
+                tf.Summary.Value(tag=self._scope + 'greedy_minR', simple_value=test_r.min)]
         self.writer.add_summary(tf.Summary(value=logs), global_step=obs_step)
 
     def build_train_graph(self, optimizer, learning_rate, optimizer_args=None,
@@ -135,6 +138,10 @@ class AsyncDQNAgent(BaseDQNAgent):
               render=False,
               saver_keep=10,
               ignore_checkpoint=False,
+              inference_batch=0,
+              inference_wait=0.002,
+              test_episodes=3,
+              async_test=False,
               **kwargs):
         """Starts training of Asynchronous n-step Q-Learning agent.
 
@@ -161,6 +168,17 @@ class AsyncDQNAgent(BaseDQNAgent):
                         When exceeds, overwrites the most earliest checkpoints.
             ignore_checkpoint: (bool) If enabled, training will start from scratch,
                                and overwrite all old checkpoints found at `log_dir` path.
+            inference_batch: (int) If set, actor threads request action values from a shared
+                             `core.InferenceServer`, which evaluates them with the global
+                             network in batches of up to `inference_batch` observations.
+                             To disable, pass 0.
+            inference_wait: (float) Maximum time (in seconds) the inference server waits
+                            for a batch to fill up.
+            test_episodes: (int) Number of test episodes.
+            async_test: (bool) If enabled, test episodes are played on a background thread
+                        with a snapshot of the global network weights
+                        (see `start_async_test`), so the summary loop is not blocked.
+                        Test results are written with the step of the snapshot.
         """
         if num_threads < 1:
             raise ValueError("Number of threads must be >= 1 (Got: %s)." % num_threads)
@@ -199,11 +217,20 @@ class AsyncDQNAgent(BaseDQNAgent):
             thread_agents.append(agent)
         self.writer = tf.summary.FileWriter(log_dir, self.sess.graph)
         self.sess.run(tf.global_variables_initializer())
+        self._restore_counters()
         if not ignore_checkpoint and tf.train.latest_checkpoint(log_dir) is not None:
             self.load_weights(log_dir)
         last_log_step = self.obs_counter
         last_target_update = last_log_step
+        if async_test:
+            self.start_async_test(test_episodes, self._write_test_summary)
 
+        inference = None
+        if inference_batch:
+            inference = InferenceServer(self.predict_on_batch, max_batch_size=inference_batch,
+                                        max_wait=inference_wait).start()
+            for t in thread_agents:
+                t.inference = inference
         for t in thread_agents:
             t.daemon = True
             t.start()
@@ -215,28 +242,40 @@ class AsyncDQNAgent(BaseDQNAgent):
         self._prev_obs_step = self.obs_counter
         self._prev_opt_step = self.step_counter
         self._last_time = time.time()
-        while has_live_threads() and self.obs_counter < steps:
-            try:
-                if render:
-                    for env in envs:
-                        env.render()
-                    time.sleep(0.01)
-                step = self.obs_counter
-                if step - last_log_step >= log_freq:
-                    last_log_step = step
-                    self._write_summary()
-                    self.save_weights(log_dir)
-                if step - last_target_update >= target_freq:
-                    last_target_update = step
-                    self.target_update()
-            except KeyboardInterrupt:
-                logger.info('Caught Ctrl+C! Stopping training process.')
-                self.request_stop = True
-        self.save_weights(log_dir)
-        logger.info('Training finished!')
-        self.writer.close()
-        for agent in thread_agents:
-            agent.close()
+        try:
+            while has_live_threads() and self.obs_counter < steps:
+                try:
+                    if render:
+                        for env in envs:
+                            env.render()
+                        time.sleep(0.01)
+                    step = self.obs_counter
+                    if step - last_log_step >= log_freq:
+                        last_log_step = step
+                        self._write_summary(test_episodes, async_test)
+                        if inference is not None:
+                            self._write_inference_summary(inference, step)
+                        self.save_weights(log_dir)
+                    if step - last_target_update >= target_freq:
+                        last_target_update = step
+                        self.target_update()
+                except KeyboardInterrupt:
+                    logger.info('Caught Ctrl+C! Stopping training process.')
+                    self.request_stop = True
+            self.save_weights(log_dir)
+            logger.info('Training finished!')
+        finally:
+            # Learner threads are stopped before the writer and inference server are closed.
+            self.request_stop = True
+            for agent in thread_agents:
+                agent.join()
+            if async_test:
+                self.stop_async_test()
+            self.writer.close()
+            if inference is not None:
+                inference.close()
+            for agent in thread_agents:
+                agent.close()
 
     def _train_on_batch(self, obs, actions, rewards, obs_next, term, summarize=False):
         raise NotImplementedError('Training on batch is not supported. Use `train` method instead.')
@@ -284,6 +323,10 @@ class _ThreadDQNLearner(BaseDQNAgent, Thread):
         self._ep_reward = reinforceflow.utils.IncrementalAverage()
         self._ep_q = reinforceflow.utils.IncrementalAverage()
         self._reward_accum = 0
+        # Shared `core.InferenceServer`. If None, action values are computed by the local net.
+        self.inference = None
+        self._policy_step_ph = tf.placeholder('int64', [], name=self._scope + 'policy_step')
+        self._action_op = self._build_action_op(policy, self._policy_step_ph)
 
     def build_train_graph(self, optimizer, learning_rate, optimizer_args=None,
                           decay=None, decay_args=None, gradient_clip=40.0, saver_keep=10):
@@ -331,6 +374,7 @@ class _ThreadDQNLearner(BaseDQNAgent, Thread):
                                        self._action_ph: actions,
                                        self._reward_ph: rewards
                                    })
+        self.global_agent.increment_step_counter()
         return summary
 
     def run(self):
@@ -348,9 +392,8 @@ class _ThreadDQNLearner(BaseDQNAgent, Thread):
                 obs = self.env.reset()
             while not term and len(batch_obs) < self.batch_size:
                 current_step = self.global_agent.increment_obs_counter()
-                reward_per_action = self.predict_on_batch([obs])
                 batch_obs.append(obs)
-                action = self.policy.select_action(self.env, reward_per_action, current_step)
+                action = self._select_action(obs, current_step)
                 obs, reward, term, info = self.env.step(action)
                 self._reward_accum += reward
                 reward = np.clip(reward, -1, 1)
@@ -363,6 +406,8 @@ class _ThreadDQNLearner(BaseDQNAgent, Thread):
                                                batch_rewards, [obs], term, write_summary)
             if write_summary:
                 prev_step = self.global_agent.obs_counter
+                if self._action_op is not None:
+                    self.policy.update(prev_step)
                 num_ep = self._ep_reward.length
                 max_r = self._ep_reward.max
                 min_r = self._ep_reward.min
@@ -376,7 +421,8 @@ class _ThreadDQNLearner(BaseDQNAgent, Thread):
                             tf.Summary.Value(tag=self._scope + 'avgR', simple_value=avg_r),
                             tf.Summary.Value(tag=self._scope + 'avgQ', simple_value=avg_q),
                             tf.Summary.Value(tag=self._scope + 'epsilon',
-                                             simple_value=self.policy.epsilon),
+                                             simple_value=getattr(self.policy, 'epsilon',
+                                                                  0.0)),
                             tf.Summary.Value(tag=self._scope + 'metrics/num_episodes',
                                              simple_value=num_ep)
                             ]
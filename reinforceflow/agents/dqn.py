@@ -2,6 +2,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import os
 import time
 
 from six.moves import range  # pylint: disable=redefined-builtin
@@ -10,7 +11,7 @@ import tensorflow as tf
 
 import reinforceflow.utils
 from reinforceflow.core.base_agent import BaseDQNAgent
-from reinforceflow.core import ExperienceReplay
+from reinforceflow.core import ExperienceReplay, ReplayPrefetcher, fill_replay
 from reinforceflow.core import EGreedyPolicy
 from reinforceflow import utils_tf
 from reinforceflow import logger
@@ -37,6 +38,7 @@ class DQNAgent(BaseDQNAgent):
         self.sess.run(tf.global_variables_initializer())
         self._use_double = use_double
         self._importance_ph = tf.placeholder('float32', [None], name='importance_sampling')
+        self._discount_exp_ph = tf.placeholder('float32', [None], name='discount_exponent')
         self._td_error = None
         self.opt = None
         self._term_ph = None
@@ -99,7 +101,7 @@ class DQNAgent(BaseDQNAgent):
             else:
                 q_next_max = tf.reduce_max(self._target_net.output, 1)
             q_next_max_masked = (1.0 - self._term_ph) * q_next_max
-            q_target = self._reward_ph + gamma * q_next_max_masked
+            q_target = self._reward_ph + tf.pow(gamma, self._discount_exp_ph) * q_next_max_masked
             self._td_error = tf.stop_gradient(q_target) - q_selected
             td_error_weighted = self._td_error * self._importance_ph
             self._loss = tf.reduce_mean(tf.square(td_error_weighted), name='loss')
@@ -128,91 +130,167 @@ class DQNAgent(BaseDQNAgent):
         self._init_op = tf.global_variables_initializer()
 
     def _train(self, max_steps, update_freq, log_dir, render, target_freq, replay,
-               policy, log_freq, test_episodes, ignore_checkpoint):
+               policy, log_freq, test_episodes, ignore_checkpoint, save_replay, warmup_workers,
+               test_envs, async_test):
         avg_reward = reinforceflow.utils.IncrementalAverage()
         ep_reward = 0
         episode = 0
         last_log_ep = 0
         writer = tf.summary.FileWriter(log_dir, self.sess.graph)
-        self.sess.run(self._init_op)
-        if not ignore_checkpoint and log_dir and tf.train.latest_checkpoint(log_dir) is not None:
-            self.load_weights(log_dir)
-        obs = self.env.reset()
-        last_time = time.time()
-        last_step = self.step_counter
-        last_obs = self.obs_counter
-        step = self.step_counter
-        while step < max_steps:
-            obs_counter = self.increment_obs_counter()
+        finished = False
+        try:
+            self.sess.run(self._init_op)
+            self._restore_counters()
+            if not ignore_checkpoint and log_dir \
+                    and tf.train.latest_checkpoint(log_dir) is not None:
+                self.load_weights(log_dir)
+                replay_dir = os.path.join(log_dir, 'replay')
+                if save_replay and ExperienceReplay.has_snapshot(replay_dir):
+                    replay.load(replay_dir)
+            if warmup_workers and replay.size < replay.min_size:
+                fill_replay(self.env, replay, replay.min_size - replay.size,
+                            num_workers=warmup_workers, reward_clip=1.0)
+            if async_test:
+                def write_test_summary(step, test_r, test_lengths, test_time):
+                    logger.info("Background greedy eval.: Average R: %.2f. Step: %d."
+                                % (test_r.compute_average(), step))
+                    if log_dir:
+                        writer.add_summary(tf.Summary(value=self._test_summary(
+                            test_r.compute_average(), test_lengths, test_time)), global_step=step)
+                self.start_async_test(test_episodes, write_test_summary, num_envs=test_envs)
+            action_op = self._build_action_op(policy, self.global_step)
+            obs = self.env.reset()
+            last_time = time.time()
+            last_step = self.step_counter
+            last_obs = self.obs_counter
             step = self.step_counter
-            if render:
-                self.env.render()
-            action_values = self.predict_on_batch([obs])
-            action = policy.select_action(self.env, action_values, step)
-            obs_next, reward, term, info = self.env.step(action)
-            ep_reward += reward
-            reward = np.clip(reward, -1, 1)
-            replay.add(obs, action, reward, obs_next, term)
-            obs = obs_next
-            if replay.is_ready and obs_counter % update_freq == 0:
-                batch = replay.sample()
-                b_obs, b_action, b_reward, b_obs_next, b_term, b_idxs, b_importances = batch
-                summarize = episode > last_log_ep and step - last_step > log_freq
-                td_error, summary_str = self._train_on_batch(b_obs, b_action, b_reward, b_obs_next,
-                                                             b_term, summarize, b_importances)
-                try:
-                    replay.update(b_idxs, np.abs(td_error))
-                except AttributeError:
-                    pass
-                if step % target_freq == target_freq-1:
-                    self.target_update()
+            while step < max_steps:
+                obs_counter = self.increment_obs_counter()
+                step = self.step_counter
+                if render:
+                    self.env.render()
+                if action_op is not None:
+                    action, _ = self._act(obs, action_op)
+                else:
+                    action_values = self.predict_on_batch([obs])
+                    action = policy.select_action(self.env, action_values, step)
+                obs_next, reward, term, info = self.env.step(action)
+                ep_reward += reward
+                reward = np.clip(reward, -1, 1)
+                replay.add(obs, action, reward, obs_next, term)
+                obs = obs_next
+                if replay.is_ready and obs_counter % update_freq == 0:
+                    batch = replay.sample()
+                    b_obs, b_action, b_reward, b_obs_next, b_term, b_idxs, b_importances = batch[:7]
+                    # N-step replays additionally return discount exponents.
+                    b_discount_exp = batch[7] if len(batch) > 7 else None
+                    summarize = episode > last_log_ep and step - last_step > log_freq
+                    td_error, summary_str = self._train_on_batch(b_obs, b_action, b_reward,
+                                                                 b_obs_next, b_term, summarize,
+                                                                 b_importances, b_discount_exp)
+                    try:
+                        replay.update(b_idxs, np.abs(td_error))
+                    except AttributeError:
+                        pass
+                    if step % target_freq == target_freq-1:
+                        self.target_update()
+
+                    if log_dir and step % log_freq == log_freq-1:
+                        self.save_weights(log_dir)
+                        self._save_replay(replay, log_dir, save_replay)
 
-                if log_dir and step % log_freq == log_freq-1:
-                    self.save_weights(log_dir)
+                    # Eval & log
+                    if summarize:
+                        last_log_ep = episode
+                        step = self.step_counter
+                        num_ep = avg_reward.length
+                        max_r = avg_reward.max
+                        min_r = avg_reward.min
+                        train_r = avg_reward.reset()
+                        if action_op is not None:
+                            # Epsilon is annealed in-graph, sync its value for the summary.
+                            policy.update(step)
+                        test_r, test_lengths, test_time = None, None, None
+                        if async_test:
+                            self.async_test(step)
+                        elif test_envs > 1:
+                            test_r, test_lengths, test_time = self.evaluate(test_episodes,
+                                                                            test_envs)
+                            test_r = test_r.compute_average()
+                        else:
+                            test_r = self.test(episodes=test_episodes,
+                                               copy_env=True).compute_average()
+                        obs_per_sec = (self.obs_counter - last_obs) / (time.time() - last_time)
+                        step_per_sec = (self.step_counter - last_step) / (time.time() - last_time)
+                        last_time = time.time()
+                        last_step = step
+                        last_obs = self.obs_counter
+                        logger.info("On-policy eval.: Average R: %.2f. Step: %d. Ep: %d"
+                                    % (train_r, step, episode))
+                        if test_r is not None:
+                            logger.info("Greedy eval.: Average R: %.2f. Step: %d. Ep: %d"
+                                        % (test_r, step, episode))
+                        logger.info("Performance. Observation/sec: %0.2f. Update/sec: %0.2f."
+                                    % (obs_per_sec, step_per_sec))
+                        if log_dir and summary_str:
+                            logs = [tf.Summary.Value(tag='metrics/total_ep', simple_value=episode),
+                                    tf.Summary.Value(tag='metrics/num_ep', simple_value=num_ep),
+                                    tf.Summary.Value(tag='metrics/max_r', simple_value=max_r),
+                                    tf.Summary.Value(tag='metrics/min_r', simple_value=min_r),
+                                    tf.Summary.Value(tag='metrics/avg_r', simple_value=train_r),
+                                    tf.Summary.Value(tag='agent/epsilon',
+                                                     simple_value=getattr(policy, 'epsilon', 0.0)),
+                                    tf.Summary.Value(tag='step/sec', simple_value=step_per_sec),
+                                    ]
+                            if test_r is not None:
+                                logs += self._test_summary(test_r, test_lengths, test_time)
+                            writer.add_summary(tf.Summary(value=logs), global_step=step)
+                            writer.add_summary(summary_str, global_step=step)
+                if term:
+                    episode += 1
+                    avg_reward.add(ep_reward)
+                    ep_reward = 0
+                    obs = self.env.reset()
+            finished = True
+        finally:
+            # Background evaluation writes to the summary, so it is stopped first.
+            # Pending snapshot is evaluated only if training has finished normally.
+            self.stop_async_test(wait=finished)
+            writer.close()
 
-                # Eval & log
-                if summarize:
-                    last_log_ep = episode
-                    step = self.step_counter
-                    num_ep = avg_reward.length
-                    max_r = avg_reward.max
-                    min_r = avg_reward.min
-                    train_r = avg_reward.reset()
-                    test_r = self.test(episodes=test_episodes, copy_env=True).compute_average()
-                    obs_per_sec = (self.obs_counter - last_obs) / (time.time() - last_time)
-                    step_per_sec = (self.step_counter - last_step) / (time.time() - last_time)
-                    last_time = time.time()
-                    last_step = step
-                    last_obs = self.obs_counter
-                    logger.info("On-policy eval.: Average R: %.2f. Step: %d. Ep: %d"
-                                % (train_r, step, episode))
-                    logger.info("Greedy eval.: Average R: %.2f. Step: %d. Ep: %d"
-                                % (test_r, step, episode))
-                    logger.info("Performance. Observation/sec: %0.2f. Update/sec: %0.2f."
-                                % (obs_per_sec, step_per_sec))
-                    if log_dir and summary_str:
-                        logs = [tf.Summary.Value(tag='metrics/total_ep', simple_value=episode),
-                                tf.Summary.Value(tag='metrics/num_ep', simple_value=num_ep),
-                                tf.Summary.Value(tag='metrics/max_r', simple_value=max_r),
-                                tf.Summary.Value(tag='metrics/min_r', simple_value=min_r),
-                                tf.Summary.Value(tag='metrics/avg_r', simple_value=train_r),
-                                tf.Summary.Value(tag='metrics/test_r', simple_value=test_r),
-                                tf.Summary.Value(tag='agent/epsilon', simple_value=policy.epsilon),
-                                tf.Summary.Value(tag='step/sec', simple_value=step_per_sec),
-                                ]
-                        writer.add_summary(tf.Summary(value=logs), global_step=step)
-                        writer.add_summary(summary_str, global_step=step)
-            if term:
-                episode += 1
-                avg_reward.add(ep_reward)
-                ep_reward = 0
-                obs = self.env.reset()
-        writer.close()
+    @staticmethod
+    def _test_summary(test_r, test_lengths=None, test_time=None):
+        logs = [tf.Summary.Value(tag='metrics/test_r', simple_value=test_r)]
+        if test_lengths:
+            logs += [tf.Summary.Value(tag='metrics/test_ep_length',
+                                      simple_value=np.mean(test_lengths)),
+                     tf.Summary.Value(tag='metrics/test_time', simple_value=test_time)]
+        return logs
+
+    @staticmethod
+    def _save_replay(replay, log_dir, save_replay):
+        """Flushes persistent replay buffers and, if requested, saves replay snapshot
+        next to the checkpoints."""
+        try:
+            replay.flush()
+        except AttributeError:
+            pass
+        if save_replay and log_dir:
+            replay.save(os.path.join(log_dir, 'replay'))
 
     def _train_on_batch(self, obs, actions, rewards, obs_next,
-                        term, summarize=False, importance=None):
+                        term, summarize=False, importance=None, discount_exp=None):
+        """Performs training step on the given batch.
+
+        Args:
+            importance: Importance sampling weights. If None, ones will be used.
+            discount_exp: Per-sample exponents of the bootstrap discount (e.g., number of
+                          accumulated rewards for N-step returns). If None, ones will be used.
+        """
         if importance is None:
             importance = [1.0] * len(rewards)
+        if discount_exp is None:
+            discount_exp = [1.0] * len(rewards)
         _, td_error, summary = self.sess.run([self._train_op, self._td_error,
                                               self._summary_op if summarize else self._no_op],
                                              feed_dict={
@@ -221,8 +299,10 @@ class DQNAgent(BaseDQNAgent):
                                                  self._reward_ph: rewards,
                                                  self._target_net.input_ph: obs_next,
                                                  self._term_ph: term,
-                                                 self._importance_ph: importance
+                                                 self._importance_ph: importance,
+                                                 self._discount_exp_ph: discount_exp
                                              })
+        self.increment_step_counter()
         return td_error, summary
 
     def train(self,
@@ -244,6 +324,11 @@ class DQNAgent(BaseDQNAgent):
               saver_keep=3,
               test_episodes=3,
               ignore_checkpoint=False,
+              prefetch=0,
+              save_replay=False,
+              warmup_workers=0,
+              test_envs=1,
+              async_test=False,
               **kwargs):
         """Starts training process.
 
@@ -255,6 +340,10 @@ class DQNAgent(BaseDQNAgent):
             log_dir: (str) Directory used for summary and checkpoints.
                      Continues training, if checkpoint already exists.
             replay: (core.ExperienceReplay) Experience buffer.
+                    To train on N-step returns, use `core.NStepReplay`
+                    with the same `gamma`.
+                    Persistent buffers (e.g. `core.MemmapReplay`) are flushed
+                    along with the checkpoints.
             policy: (core.BasePolicy) Agent's training policy.
             optimizer_args: (dict) Keyword arguments used for optimizer creation.
             decay: (function) Learning rate decay.
@@ -272,14 +361,35 @@ class DQNAgent(BaseDQNAgent):
             test_episodes: (int) Number of test episodes.
             ignore_checkpoint: (bool) If enabled, training will start from scratch,
                                and overwrite all old checkpoints found at `log_dir` path.
+            prefetch: (int) Amount of replay batches, prepared in advance on a background
+                      thread (see `core.ReplayPrefetcher`). To disable, pass 0.
+            save_replay: (bool) If enabled, replay snapshot is saved to `log_dir/replay`
+                         along with the checkpoints, and restored on continued training.
+            warmup_workers: (int) If set, replay is filled up to its minimum size with
+                            uniform random transitions, collected by the given number of
+                            worker processes (see `core.fill_replay`). To disable, pass 0.
+            test_envs: (int) If higher than 1, test episodes are played in parallel
+                       on the given number of environment copies (see `evaluate`).
+            async_test: (bool) If enabled, test episodes are played on a background thread
+                        with a snapshot of the network weights (see `start_async_test`),
+                        so training is not paused. Test results are written to the summary
+                        with the step of the snapshot.
         """
+        if prefetch:
+            logger.info('Prefetching up to %d replay batches on a background thread.' % prefetch)
+            replay = ReplayPrefetcher(replay, queue_size=prefetch)
         self.build_train_graph(optimizer, learning_rate, optimizer_args, gamma,
                                decay, decay_args, gradient_clip, saver_keep)
         try:
             self._train(max_steps, update_freq, log_dir, render, target_freq, replay,
-                        policy, log_freq, test_episodes, ignore_checkpoint)
+                        policy, log_freq, test_episodes, ignore_checkpoint, save_replay,
+                        warmup_workers, test_envs, async_test)
             logger.info('Training finished.')
         except KeyboardInterrupt:
             logger.info('Stopping training process...')
         if log_dir:
             self.save_weights(log_dir)
+        if prefetch:
+            replay.close()
+        self.close_evaluator()
+        self._save_replay(replay, log_dir, save_replay)
@@ -2,3 +2,6 @@ from __future__ import absolute_import
 
 from reinforceflow.core.replay import *
 from reinforceflow.core.policy import *
+from reinforceflow.core.warmup import *
+from reinforceflow.core.inference import *
+from reinforceflow.core.evaluator import *
@@ -3,6 +3,7 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import time
 from collections import defaultdict
 import abc
 import six
@@ -11,7 +12,7 @@ from six.moves import range  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
 import reinforceflow.utils
-from reinforceflow.core import GreedyPolicy
+from reinforceflow.core import GreedyPolicy, ParallelEvaluator, AsyncEvaluator
 from reinforceflow import logger
 
 
@@ -21,6 +22,7 @@ class BaseAgent(object):
     def __init__(self, env):
         super(BaseAgent, self).__init__()
         self.env = env
+        self._evaluator = None
 
     def train(self, *args, **kwargs):
         raise NotImplementedError
@@ -28,33 +30,148 @@ class BaseAgent(object):
     def predict_action(self, *args, **kwargs):
         raise NotImplementedError
 
-    def test(self, episodes, max_ep_steps=int(1e5), render=False, copy_env=False):
+    def test(self, episodes, max_ep_steps=int(1e5), render=False, copy_env=False, num_envs=1,
+             ci_width=None, time_budget=None, min_episodes=3):
         """Tests agent's performance with specified policy on a given number of episodes.
 
+        Evaluation can be stopped early, once the mean episode reward is estimated
+        precisely enough (see `ci_width`), or the time budget runs out.
+        Amount of the played episodes is reported by the `length` of the result.
+
         Args:
-            episodes: (int) Number of episodes.
+            episodes: (int) Number of episodes. With early stopping enabled,
+                      the maximum number of episodes.
             max_ep_steps: (int) Maximum allowed steps per episode.
             render: (bool) Enables game screen rendering.
             copy_env: (bool) Performs tests on the copy of environment instance.
+            num_envs: (int) If higher than 1, episodes are played in parallel
+                      on copies of the environment (see `evaluate`).
+                      Ignored, when rendering or early stopping is enabled.
+            ci_width: (float) If set, stops once the 95% confidence interval on the mean
+                      episode reward is narrower than `ci_width`.
+            time_budget: (float) If set, stops once the test has taken
+                         more than `time_budget` seconds.
+            min_episodes: (int) Minimum number of episodes, required to stop
+                          by the confidence interval width.
 
         Returns: (utils.IncrementalAverage) Average reward per episode.
         """
+        early_stop = ci_width is not None or time_budget is not None
+        if num_envs > 1 and not render and not early_stop:
+            return self.evaluate(episodes, num_envs, max_ep_steps)[0]
         env = self.env.copy() if copy_env else self.env
+        start_time = time.time()
         ep_rewards = reinforceflow.utils.IncrementalAverage()
-        for _ in range(episodes):
-            reward_accum = 0
-            obs = env.reset()
-            for _ in range(max_ep_steps):
-                if render:
-                    env.render()
-                action = self.predict_action(obs)
-                obs, r, terminal, info = env.step(action)
-                reward_accum += r
-                if terminal:
+        try:
+            for _ in range(episodes):
+                reward_accum = 0
+                obs = env.reset()
+                for _ in range(max_ep_steps):
+                    if render:
+                        env.render()
+                    action = self.predict_action(obs)
+                    obs, r, terminal, info = env.step(action)
+                    reward_accum += r
+                    if terminal:
+                        break
+                ep_rewards.add(reward_accum)
+                if ci_width is not None and ep_rewards.length >= min_episodes \
+                        and 2 * ep_rewards.confidence_interval() < ci_width:
+                    break
+                if time_budget is not None and time.time() - start_time > time_budget:
                     break
-            ep_rewards.add(reward_accum)
+        finally:
+            if copy_env:
+                env.close()
+        if early_stop:
+            logger.info('Test has finished after %d episodes in %.2f sec. Average R: %.2f '
+                        '(+/- %.2f).' % (ep_rewards.length, time.time() - start_time,
+                                         ep_rewards.compute_average(),
+                                         ep_rewards.confidence_interval()))
         return ep_rewards
 
+    def evaluate(self, episodes, num_envs, max_ep_steps=int(1e5)):
+        """Tests agent's greedy policy on copies of the environment, stepped in parallel
+        worker processes (see `core.ParallelEvaluator`). Workers are created on the first
+        call and reused by the following ones.
+
+        Args:
+            episodes: (int) Number of episodes.
+            num_envs: (int) Number of environment copies.
+            max_ep_steps: (int) Maximum allowed steps per episode.
+
+        Returns:
+            Tuple of (utils.IncrementalAverage of the episode rewards;
+            list of the episode lengths; evaluation wall time in seconds).
+        """
+        evaluator = getattr(self, '_evaluator', None)
+        if evaluator is None or evaluator.num_envs != num_envs:
+            self.close_evaluator()
+            evaluator = self._evaluator = ParallelEvaluator(self.env, num_envs)
+        return evaluator.evaluate(self.predict_on_batch, episodes, max_ep_steps)
+
+    def close_evaluator(self):
+        """Stops worker processes of the parallel evaluation (see `evaluate`)."""
+        if getattr(self, '_evaluator', None) is not None:
+            self._evaluator.close()
+            self._evaluator = None
+
+    def predict_on_batch(self, obs_batch):
+        raise NotImplementedError
+
+    def _build_action_op(self, policy, step):
+        """Builds in-graph action selection of the policy on the network output.
+
+        Args:
+            policy: (core.BasePolicy) Policy.
+            step: (Tensor) Scalar step, used by annealed policies.
+
+        Returns: (Tensor) Selected action indexes, or None if policy has no graph version.
+        """
+        try:
+            return policy.build_action_op(self.net.output, step)
+        except NotImplementedError:
+            return None
+
+    def _act(self, obs, action_op, feed_dict=None):
+        """Selects action for the single observation with a single session call.
+
+        Returns:
+            Tuple of (one-hot encoded action; network output).
+        """
+        feed_dict = dict(feed_dict or {})
+        feed_dict[self.net.input_ph] = [obs]
+        action, prediction = self.sess.run([action_op, self.net.output], feed_dict)
+        return reinforceflow.utils.one_hot(self.env.action_shape, action[0]), prediction
+
+    def _select_action(self, obs, step):
+        """Selects training policy action of the asynchronous learner for the single observation.
+
+        Uses in-graph action selection (see `_build_action_op`), unless the learner
+        is served by the shared `core.InferenceServer` (`inference` attribute),
+        or the policy has no graph version.
+        """
+        if self.inference is None and self._action_op is not None:
+            action, _ = self._act(obs, self._action_op, {self._policy_step_ph: step})
+            return action
+        return self.policy.select_action(self.env, self._predict_obs(obs), step)
+
+    def _predict_obs(self, obs):
+        """Computes action-values for the single observation."""
+        if self.inference is not None:
+            return self.inference.predict(obs).result()[np.newaxis]
+        return self.predict_on_batch([obs])
+
+    def _write_inference_summary(self, inference, step):
+        """Logs and writes statistics of the `core.InferenceServer`."""
+        stats = inference.summary()
+        logger.info("Inference. Mean batch size: %.2f. Queue latency p50: %.4f sec, "
+                    "p99: %.4f sec." % (stats['mean_batch_size'], stats['latency_p50'],
+                                        stats['latency_p99']))
+        logs = [tf.Summary.Value(tag='performance/inference/' + name, simple_value=value)
+                for name, value in sorted(stats.items())]
+        self.writer.add_summary(tf.Summary(value=logs), global_step=step)
+
 
 @six.add_metaclass(abc.ABCMeta)
 class BaseDiscreteAgent(BaseAgent):
@@ -108,6 +225,8 @@ class BaseDQNAgent(BaseDiscreteAgent):
             self._weights = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES,
                                               scope.name)
         self.sess = None
+        self._async_evaluator = None
+        self._eval_sess = None
         self._target_net = None
         self._target_update = None
         self._saver = None
@@ -118,7 +237,11 @@ class BaseDQNAgent(BaseDiscreteAgent):
             self._no_op = tf.no_op()
             self.global_step = tf.Variable(0, trainable=False, name='global_step')
             self._obs_counter = tf.Variable(0, trainable=False, name='obs_counter')
-            self._obs_counter_inc = self._obs_counter.assign_add(1, use_locking=True)
+            self._obs_counter_ph = tf.placeholder('int32', [], name='obs_counter_value')
+            self._obs_counter_assign = self._obs_counter.assign(self._obs_counter_ph)
+        # Counters are kept on the host and synced with the variables at checkpoints.
+        self._obs_count = reinforceflow.utils.Counter()
+        self._step_count = reinforceflow.utils.Counter()
 
     def build_train_graph(self, optimizer, learning_rate, optimizer_args=None,
                           decay=None, decay_args=None, gradient_clip=40.0, saver_keep=3):
@@ -152,6 +275,7 @@ class BaseDQNAgent(BaseDiscreteAgent):
     def save_weights(self, path, model_name='model.ckpt'):
         if not os.path.exists(path):
             os.makedirs(path)
+        self.sess.run(self._obs_counter_assign, {self._obs_counter_ph: self.obs_counter})
         self._saver.save(self.sess, os.path.join(path, model_name), global_step=self.global_step)
         logger.info('Checkpoint has been saved to: %s' % os.path.join(path, model_name))
 
@@ -161,19 +285,29 @@ class BaseDQNAgent(BaseDiscreteAgent):
         if tf.gfile.IsDirectory(checkpoint):
             checkpoint = tf.train.latest_checkpoint(checkpoint)
         self._saver.restore(self.sess, save_path=checkpoint)
+        self._restore_counters()
         self.target_update()
         logger.info('Checkpoint has been restored from: %s', checkpoint)
 
+    def _restore_counters(self):
+        """Reads host-side counters from the graph variables."""
+        obs_counter, step_counter = self.sess.run([self._obs_counter, self.global_step])
+        self._obs_count.value = obs_counter
+        self._step_count.value = step_counter
+
     def increment_obs_counter(self):
-        return self.sess.run(self._obs_counter_inc)
+        return self._obs_count.increment()
+
+    def increment_step_counter(self):
+        return self._step_count.increment()
 
     @property
     def obs_counter(self):
-        return self.sess.run(self._obs_counter_inc)
+        return self._obs_count.value
 
     @property
     def step_counter(self):
-        return self.sess.run(self.global_step)
+        return self._step_count.value
 
     def predict_action(self, obs, policy=GreedyPolicy()):
         """Computes action for given observation."""
@@ -191,7 +325,72 @@ class BaseDQNAgent(BaseDiscreteAgent):
     def target_update(self):
         self.sess.run(self._target_update)
 
+    def _build_eval_model(self):
+        """Builds copy of the network in a separate graph and session.
+
+        Returns:
+            Tuple of (function, which predicts action-values for a batch of observations;
+            function, which loads the list of `self._weights` values).
+        """
+        graph = tf.Graph()
+        with graph.as_default():
+            with tf.variable_scope(self._scope + 'network') as scope:
+                net = self._net_factory.make(input_shape=[None] + self.env.obs_shape,
+                                             output_size=self.env.action_shape[0])
+                weights = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope.name)
+            weights_ph = [tf.placeholder(w.dtype.base_dtype, w.get_shape()) for w in weights]
+            assign_op = tf.group(*[w.assign(ph) for w, ph in zip(weights, weights_ph)])
+            init_op = tf.global_variables_initializer()
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
+        sess = tf.Session(graph=graph, config=config)
+        sess.run(init_op)
+        self._eval_sess = sess
+
+        def predict_on_batch(obs_batch):
+            return sess.run(net.output, {net.input_ph: obs_batch})
+
+        def load_weights(values):
+            sess.run(assign_op, dict(zip(weights_ph, values)))
+        return predict_on_batch, load_weights
+
+    def start_async_test(self, episodes, callback, num_envs=1, max_ep_steps=int(1e5)):
+        """Starts background evaluation of the weight snapshots (see `async_test`),
+        on a copy of the network, with its own session.
+
+        Args:
+            episodes: (int) Number of test episodes per snapshot.
+            callback: Function, called on the evaluation thread with (step, episode rewards,
+                      episode lengths, wall time) of each evaluated snapshot.
+            num_envs: (int) Number of environment copies, stepped in parallel.
+            max_ep_steps: (int) Maximum allowed steps per episode.
+        """
+        self.stop_async_test(wait=False)
+        predict_fn, load_fn = self._build_eval_model()
+        self._async_evaluator = AsyncEvaluator(self.env, predict_fn, load_fn, callback,
+                                               episodes, num_envs, max_ep_steps)
+
+    def async_test(self, step):
+        """Schedules background evaluation of the current network weights.
+        Results are passed to the callback of `start_async_test` along with `step`."""
+        self._async_evaluator.submit(step, self.sess.run(self._weights))
+
+    def stop_async_test(self, wait=True):
+        """Stops background evaluation.
+
+        Args:
+            wait: (bool) If enabled, pending snapshot is evaluated before stopping.
+        """
+        if getattr(self, '_async_evaluator', None) is not None:
+            self._async_evaluator.close(wait)
+            self._async_evaluator = None
+        if getattr(self, '_eval_sess', None) is not None:
+            self._eval_sess.close()
+            self._eval_sess = None
+
     def close(self):
+        self.stop_async_test(wait=False)
+        self.close_evaluator()
         if self.sess:
             self.sess.close()
 
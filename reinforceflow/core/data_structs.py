@@ -2,10 +2,17 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import numpy as np
+
 
 class BaseSegmentTree(object):
     """Base Segment Tree.
 
+    Nodes are stored in a flat NumPy array with the root at index 1 and the children
+    of node `i` at `2i` and `2i + 1`. Amount of leaves is rounded up to the power of two,
+    so every leaf has the same depth and the batched operations can walk all
+    batch elements level by level.
+
     Args:
         capacity: (int) Maximum size capacity.
         default_value: Default priority for initialized values.
@@ -13,43 +20,69 @@ class BaseSegmentTree(object):
     def __init__(self, capacity, default_value):
         self._size = 0
         self._capacity = capacity
-        self._tree = [default_value] * (2 * capacity - 1)
+        self._default_value = default_value
+        self._leaf_start = 1
+        while self._leaf_start < capacity:
+            self._leaf_start *= 2
+        self._depth = self._leaf_start.bit_length() - 1
+        self._tree = np.full(2 * self._leaf_start, default_value, dtype=np.float64)
         self._current_idx = 0
 
-    def _propagate(self, idx, change):
-        parent = (idx - 1) // 2
-        self._tree[parent] += change
-        if parent != 0:
-            self._propagate(parent, change)
-
-    def _retrieve(self, idx, s):
-        left = 2 * idx + 1
-        right = left + 1
-        if left >= len(self._tree):
-            return idx
-        if s <= self._tree[left]:
-            return self._retrieve(left, s)
-        else:
-            return self._retrieve(right, s - self._tree[left])
-
-    def update(self, idx, value):
-        """Updates current index with given value."""
-        self._update(self._capacity + idx - 1, value)
+    def _reduce(self, left, right):
+        """Computes parent node values from the arrays of children values."""
+        raise NotImplementedError
 
-    def _update(self, idx, value):
+    def _reduce_scalar(self, left, right):
+        """Computes parent node value from the children values."""
         raise NotImplementedError
 
+    def update(self, idx, value):
+        """Updates leaves at given index or array of indexes with given values."""
+        if np.ndim(idx) == 0:
+            tree = self._tree
+            node = self._leaf_start + int(idx)
+            tree[node] = value
+            node //= 2
+            while node >= 1:
+                tree[node] = self._reduce_scalar(tree.item(2 * node), tree.item(2 * node + 1))
+                node //= 2
+            return
+        nodes = self._leaf_start + np.asarray(idx, dtype=np.int64)
+        self._tree[nodes] = value
+        for _ in range(self._depth):
+            nodes //= 2
+            self._tree[nodes] = self._reduce(self._tree[2 * nodes], self._tree[2 * nodes + 1])
+
     def append(self, value):
-        idx = self._current_idx + self._capacity - 1
-        self._update(idx, value)
+        self.update(self._current_idx, value)
         self._current_idx += 1
         self._size = min(self._size + 1, self._capacity)
         if self._current_idx >= self._capacity:
             self._current_idx = 0
 
+    def assign(self, values, current_idx, size):
+        """Replaces all leaves of the tree with given values and rebuilds it.
+
+        Args:
+            values: Sequence of `capacity` leaf values.
+                    Values beyond `size` are replaced by the default value.
+            current_idx: (int) Index of the leaf, that will be replaced by the next `append`.
+            size: (int) Amount of appended values.
+        """
+        self._tree[self._leaf_start:] = self._default_value
+        self._tree[self._leaf_start:self._leaf_start + size] = np.asarray(values)[:size]
+        level_start = self._leaf_start // 2
+        while level_start >= 1:
+            children = self._tree[2 * level_start:4 * level_start]
+            self._tree[level_start:2 * level_start] = self._reduce(children[::2], children[1::2])
+            level_start //= 2
+        self._current_idx = current_idx
+        self._size = size
+
     def __getitem__(self, idx):
-        assert 0 <= idx < self._capacity
-        return self._tree[self._capacity + idx - 1]
+        if np.ndim(idx) == 0:
+            assert 0 <= idx < self._capacity
+        return self._tree[self._leaf_start + idx]
 
     @property
     def size(self):
@@ -67,24 +100,51 @@ class SumTree(BaseSegmentTree):
     def __init__(self, capacity, default_priority=0):
         super(SumTree, self).__init__(capacity, default_priority)
 
-    def _update(self, idx, priority):
-        diff = priority - self._tree[idx]
-        self._tree[idx] = priority
-        self._propagate(idx, diff)
+    def _reduce(self, left, right):
+        return left + right
+
+    def _reduce_scalar(self, left, right):
+        return left + right
 
     def sum(self):
         """Returns total sum of the tree values."""
-        return self._tree[0]
+        return self._tree[1]
 
     def find_sum_idx(self, s):
-        """Returns index of the leaf, that exceeds current sum."""
-        if s > self.sum():
-            s = self.sum()
-        idx = self._retrieve(0, s) - self._capacity + 1
-        if idx >= self._size:
-            idx = self._size - 1
+        """Returns index of the leaf, that exceeds current sum.
+
+        Args:
+            s: Prefix sum or array of prefix sums.
+
+        Returns:
+            Leaf index or array of leaf indexes, according to the given sums.
+        """
+        if np.ndim(s) == 0:
+            return self._find_sum_idx_scalar(s)
+        s = np.minimum(np.atleast_1d(s).astype(np.float64), self.sum())
+        idx = np.ones(len(s), dtype=np.int64)
+        for _ in range(self._depth):
+            idx *= 2
+            left_sum = self._tree.take(idx)
+            go_right = s > left_sum
+            s -= left_sum * go_right
+            idx += go_right
+        idx -= self._leaf_start
+        np.minimum(idx, self._size - 1, out=idx)
         return idx
 
+    def _find_sum_idx_scalar(self, s):
+        tree = self._tree
+        s = min(float(s), tree.item(1))
+        idx = 1
+        for _ in range(self._depth):
+            idx *= 2
+            left_sum = tree.item(idx)
+            if s > left_sum:
+                s -= left_sum
+                idx += 1
+        return min(idx - self._leaf_start, self._size - 1)
+
 
 class MinTree(BaseSegmentTree):
     """Segment Minimum Tree.
@@ -93,19 +153,11 @@ class MinTree(BaseSegmentTree):
     def __init__(self, capacity, default_priority=float('inf')):
         super(MinTree, self).__init__(capacity, default_priority)
 
-    def _update(self, idx, priority):
-        self._tree[idx] = priority
-        self._propagate(idx, priority)
+    def _reduce(self, left, right):
+        return np.minimum(left, right)
 
-    def _propagate(self, idx, change):
-        parent = (idx - 1) // 2
-        self._tree[idx] = change
-        left = 2 * parent + 1
-        right = left + 1
-        change = min(self._tree[left], self._tree[right])
-        self._tree[parent] = change
-        if parent != 0:
-            self._propagate(parent, change)
+    def _reduce_scalar(self, left, right):
+        return min(left, right)
 
     def min(self):
-        return self._tree[0]
+        return self._tree[1]
@@ -0,0 +1,176 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import copy
+import time
+import threading
+
+import numpy as np
+
+from reinforceflow import logger
+from reinforceflow.utils import IncrementalAverage
+
+
+class ParallelEvaluator(object):
+    def __init__(self, env, num_envs=4):
+        """Evaluates greedy policy on several copies of the environment at once.
+
+        Environment copies are stepped in parallel worker processes
+        (see `envs.VecEnvWrapper`), while observations of all of them are evaluated
+        with a single batched forward pass per step.
+        Worker processes are kept alive between evaluations, call `close` to stop them.
+
+        Args:
+            env: (envs.EnvWrapper) Environment. Copies are created with `env.copy`.
+            num_envs: (int) Number of environment copies.
+        """
+        from reinforceflow.envs.vec_env_wrapper import VecEnvWrapper
+        if num_envs < 1:
+            raise ValueError("Amount of environments must be higher or equal to 1.")
+        if env.is_cont_action or env.is_multiaction:
+            raise ValueError('%s supports only environments with a single discrete '
+                             'action space.' % self.__class__.__name__)
+        envs = [env.copy() if hasattr(env, 'copy') else copy.deepcopy(env)
+                for _ in range(num_envs)]
+        self.num_envs = num_envs
+        self._vec_env = VecEnvWrapper(envs)
+        self._actions = np.eye(env.action_shape[0])
+
+    def evaluate(self, predict_fn, episodes, max_ep_steps=int(1e5)):
+        """Plays `episodes` episodes with greedy policy.
+
+        Episodes are split evenly between the environments. Environments, which have
+        finished their share of episodes, keep stepping until the rest are done,
+        but their episodes are not accounted.
+
+        Args:
+            predict_fn: Function, which maps a batch of observations to a batch of action
+                        values (e.g. `BaseDQNAgent.predict_on_batch`).
+            episodes: (int) Number of episodes.
+            max_ep_steps: (int) Maximum allowed steps per episode.
+
+        Returns:
+            Tuple of (utils.IncrementalAverage of the episode rewards;
+            list of the episode lengths; evaluation wall time in seconds).
+        """
+        start_time = time.time()
+        quotas = np.full(self.num_envs, episodes // self.num_envs, dtype=np.int64)
+        quotas[:episodes % self.num_envs] += 1
+        ep_rewards = IncrementalAverage()
+        ep_lengths = []
+        reward_accum = np.zeros(self.num_envs, dtype=np.float64)
+        steps = np.zeros(self.num_envs, dtype=np.int64)
+        obs = self._vec_env.reset()
+        while quotas.any():
+            actions = self._actions[np.argmax(predict_fn(obs), axis=1)]
+            obs, rewards, terms, _ = self._vec_env.step(actions)
+            reward_accum += rewards
+            steps += 1
+            truncated = steps >= max_ep_steps
+            finished = terms | truncated
+            for env_id in np.flatnonzero(finished & (quotas > 0)):
+                ep_rewards.add(reward_accum[env_id])
+                ep_lengths.append(int(steps[env_id]))
+                quotas[env_id] -= 1
+            reward_accum[finished] = 0
+            steps[finished] = 0
+            # Terminal environments are reset by the workers, truncated ones are reset here.
+            truncated_ids = np.flatnonzero(truncated & ~terms)
+            if len(truncated_ids) and quotas.any():
+                obs = self._vec_env.reset(truncated_ids)
+        return ep_rewards, ep_lengths, time.time() - start_time
+
+    def close(self):
+        """Stops worker processes."""
+        self._vec_env.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncEvaluator(object):
+    def __init__(self, env, predict_fn, load_fn, callback, episodes, num_envs=1,
+                 max_ep_steps=int(1e5)):
+        """Evaluates snapshots of the network weights on a background thread.
+
+        Each snapshot, submitted by `submit`, is loaded into a separate evaluation model
+        with `load_fn`, and its greedy policy is tested with `ParallelEvaluator`.
+        If the thread is busy, only the latest pending snapshot is kept,
+        so evaluation never holds back the training loop.
+
+        Args:
+            env: (envs.EnvWrapper) Environment. See `ParallelEvaluator`.
+            predict_fn: Function, which maps a batch of observations to a batch of action
+                        values of the evaluation model.
+            load_fn: Function, which loads submitted weights into the evaluation model.
+            callback: Function, called on the evaluation thread with (step, episode rewards,
+                      episode lengths, wall time) of each evaluated snapshot.
+            episodes: (int) Number of test episodes per snapshot.
+            num_envs: (int) Number of environment copies, stepped in parallel.
+            max_ep_steps: (int) Maximum allowed steps per episode.
+        """
+        self._predict_fn = predict_fn
+        self._load_fn = load_fn
+        self._callback = callback
+        self._episodes = episodes
+        self._max_ep_steps = max_ep_steps
+        self._evaluator = ParallelEvaluator(env, num_envs)
+        self._cond = threading.Condition()
+        self._pending = None
+        self._stop = False
+        self._wait = True
+        self._thread = threading.Thread(target=self._run, name='AsyncEvaluator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, step, weights):
+        """Schedules evaluation of the weights snapshot, taken at the given step."""
+        with self._cond:
+            if self._pending is not None:
+                logger.warn('Evaluation of the step %d has been skipped: '
+                            'evaluator is busy.' % self._pending[0])
+            self._pending = (step, weights)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._stop:
+                    self._cond.wait()
+                if self._pending is None or self._stop and not self._wait:
+                    return
+                step, weights = self._pending
+                self._pending = None
+            try:
+                self._load_fn(weights)
+                result = self._evaluator.evaluate(self._predict_fn, self._episodes,
+                                                  self._max_ep_steps)
+                self._callback(step, *result)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error('Background evaluation of the step %d has failed: %s' % (step, e))
+
+    def close(self, wait=True):
+        """Stops evaluation thread and worker processes.
+
+        Args:
+            wait: (bool) If enabled, pending snapshot is evaluated before stopping.
+        """
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stop = True
+            self._wait = wait
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+        self._evaluator.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,160 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import time
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+from six.moves import queue
+
+from reinforceflow import logger
+
+
+class InferenceServer(object):
+    # Upper bounds (in seconds) of the queue latency histogram buckets.
+    LATENCY_BUCKETS = (1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 1e-1, np.inf)
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait=0.002):
+        """Serves predictions for many actor threads with batched forward passes.
+
+        Observations, submitted by `predict`, are collected on a background thread.
+        A batch is evaluated once `max_batch_size` observations are pending, or
+        `max_wait` seconds have passed since the first of them has arrived.
+        Results are handed back through `concurrent.futures.Future` objects.
+
+        Args:
+            predict_fn: Function, which maps a batch of observations to a batch of predictions
+                        (e.g. `BaseDQNAgent.predict_on_batch`).
+            max_batch_size: (int) Maximum number of observations in a batch.
+            max_wait: (float) Maximum time (in seconds) to wait for the batch to fill up.
+        """
+        if max_batch_size < 1:
+            raise ValueError("Maximum batch size must be higher or equal to 1.")
+        self._predict_fn = predict_fn
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._requests = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+        # Guards submission against `close`, so no request is left behind in the queue.
+        self._submit_lock = threading.Lock()
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = np.zeros(max_batch_size + 1, dtype=np.int64)
+        self._latencies = np.zeros(len(self.LATENCY_BUCKETS), dtype=np.int64)
+
+    def start(self):
+        if self._thread is None:
+            self._closed = False
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='InferenceServer')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def close(self):
+        """Stops the serving thread. Pending requests are cancelled,
+        and the following ones are rejected until the server is restarted."""
+        with self._submit_lock:
+            self._closed = True
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        while True:
+            try:
+                _, future, _ = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            future.cancel()
+
+    def predict(self, obs):
+        """Submits single observation.
+
+        Returns: (concurrent.futures.Future) Future of the prediction for `obs`.
+        """
+        future = Future()
+        with self._submit_lock:
+            if self._closed:
+                raise RuntimeError("Cannot submit requests to the closed inference server.")
+            self._requests.put((obs, future, time.time()))
+        return future
+
+    def _collect(self):
+        try:
+            first = self._requests.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = first[2] + self._max_wait
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self._requests.get(timeout=timeout))
+                else:
+                    batch.append(self._requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+            obs, futures, submit_times = zip(*batch)
+            now = time.time()
+            with self._stats_lock:
+                self._batch_sizes[len(batch)] += 1
+                latencies = now - np.array(submit_times)
+                buckets = np.searchsorted(self.LATENCY_BUCKETS, latencies)
+                np.add.at(self._latencies, buckets, 1)
+            try:
+                predictions = self._predict_fn(np.asarray(obs))
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error('Batched inference has failed: %s' % e)
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, prediction in zip(futures, predictions):
+                future.set_result(prediction)
+
+    def histograms(self, reset=False):
+        """Returns batch size and queue latency histograms.
+
+        Args:
+            reset: (bool) If enabled, histograms are cleared afterwards.
+
+        Returns:
+            Tuple of (batch size counts, indexed by the batch size;
+            queue latency counts per bucket of `LATENCY_BUCKETS`).
+        """
+        with self._stats_lock:
+            batch_sizes = self._batch_sizes.copy()
+            latencies = self._latencies.copy()
+            if reset:
+                self._batch_sizes[:] = 0
+                self._latencies[:] = 0
+        return batch_sizes, latencies
+
+    def summary(self, reset=True):
+        """Returns dict with mean batch size and upper bounds of the median
+        and 99th percentile of the queue latency (see `histograms`)."""
+        batch_sizes, latencies = self.histograms(reset)
+        num_batches = max(batch_sizes.sum(), 1)
+        cum_latencies = np.cumsum(latencies) / max(latencies.sum(), 1)
+        buckets = self.LATENCY_BUCKETS
+        return {'mean_batch_size': float(np.dot(batch_sizes, np.arange(len(batch_sizes))))
+                                   / num_batches,
+                'latency_p50': buckets[min(np.searchsorted(cum_latencies, 0.5), len(buckets) - 1)],
+                'latency_p99': buckets[min(np.searchsorted(cum_latencies, 0.99),
+                                           len(buckets) - 1)]}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
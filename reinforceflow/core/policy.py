@@ -4,6 +4,7 @@ from __future__ import print_function
 
 import random
 import numpy as np
+import tensorflow as tf
 from reinforceflow.utils import one_hot
 
 
@@ -11,11 +12,29 @@ class BasePolicy(object):
     def select_action(self, *args, **kwargs):
         raise NotImplementedError
 
+    def update(self, step):
+        """Syncs the policy parameters (e.g. annealed epsilon) to the given step."""
+        pass
+
+    def build_action_op(self, prediction, step):
+        """Builds in-graph action selection.
+
+        Args:
+            prediction: (Tensor) Batch of action values (or action probabilities).
+            step: (Tensor) Scalar step, used by annealed policies.
+
+        Returns: (Tensor) Batch of selected action indexes.
+        """
+        raise NotImplementedError
+
 
 class GreedyPolicy(BasePolicy):
     def select_action(self, env, prediction):
         return one_hot(env.action_shape, np.argmax(prediction))
 
+    def build_action_op(self, prediction, step=None):
+        return tf.argmax(prediction, 1)
+
 
 class EGreedyPolicy(BasePolicy):
     def __init__(self, eps_start, eps_final, anneal_steps):
@@ -27,13 +46,37 @@ class EGreedyPolicy(BasePolicy):
         self.epsilon = eps_start
 
     def select_action(self, env, prediction, step):
-        self.epsilon = self._update_epsilon(step)
+        self.update(step)
         if random.random() > self.epsilon:
             return one_hot(env.action_shape, np.argmax(prediction))
         else:
             return env.action_sample()
 
+    def update(self, step):
+        """Anneals epsilon to the given step."""
+        self.epsilon = self._update_epsilon(step)
+
     def _update_epsilon(self, step):
         if step >= self._anneal_steps:
             return self._final
         return self._start - (step / self._anneal_steps) * self._anneal_range
+
+    def build_action_op(self, prediction, step):
+        progress = tf.minimum(tf.cast(step, tf.float32) / self._anneal_steps, 1.0)
+        epsilon = self._start - progress * self._anneal_range
+        batch_size = tf.shape(prediction)[0]
+        num_actions = tf.cast(tf.shape(prediction)[1], tf.int64)
+        random_actions = tf.random_uniform([batch_size], maxval=num_actions, dtype=tf.int64)
+        explore = tf.random_uniform([batch_size]) < epsilon
+        return tf.where(explore, random_actions, tf.argmax(prediction, 1))
+
+
+class SoftmaxPolicy(BasePolicy):
+    """Samples actions from the probabilities, given by the prediction
+    (e.g. softmax policy output of `agents.A3CAgent`)."""
+    def select_action(self, env, prediction, step=None):
+        probs = np.ravel(prediction)
+        return one_hot(env.action_shape, np.random.choice(len(probs), p=probs / probs.sum()))
+
+    def build_action_op(self, prediction, step=None):
+        return tf.multinomial(tf.log(prediction + 1e-8), 1)[:, 0]
@@ -2,15 +2,36 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
-from operator import itemgetter
-import random
+import os
+import json
+import shutil
+import threading
+import itertools
+import zlib
+from collections import defaultdict, deque, OrderedDict
 import numpy as np
+from six.moves import queue
 from reinforceflow.core.data_structs import SumTree, MinTree
 from reinforceflow import logger
 
 
 class ExperienceReplay(object):
+    # Scalar attributes, that fully describe replay state besides the storage arrays.
+    _state_attrs = ('_idx', '_size')
+    _META_FILE = 'replay.json'
+
     def __init__(self, capacity, min_size, batch_size):
+        """Uniform Experience Replay.
+
+        Transitions are kept in preallocated NumPy arrays, which shapes and data types
+        are inferred from the first added transition. Observations are stored only once:
+        the next observation of the transition at index `i` lives at index `i + 1`.
+
+        Args:
+            capacity: (int) Maximum number of stored transitions.
+            min_size: (int) Minimum number of transitions required to start sampling.
+            batch_size: (int) Size of the sampled batch.
+        """
         if batch_size < 1:
             raise ValueError("Batch size must be higher or equal to 1.")
         if capacity < batch_size:
@@ -21,44 +42,169 @@ class ExperienceReplay(object):
         self._capacity = capacity
         self._batch_size = batch_size
         self._min_size = max(batch_size, min_size)
-        # Python lists offers ~18% faster index access speed at current setup,
-        # at the same time sacrificing ~18% of memory.
-        self._obs = [0] * (capacity + 1)
-        self._actions = [0] * capacity
-        self._rewards = [0] * capacity
-        self._terms = [0] * capacity
+        self._obs = None
+        self._actions = None
+        self._rewards = None
+        self._terms = None
         self._idx = 0
         self._size = 0
+        self._columns = []
+
+    def _new_array(self, name, shape, dtype):
+        """Creates zero-filled storage array. Override to change the storage backend.
+
+        Args:
+            name: (str) Array name. Stored as the `_<name>` attribute of the replay.
+            shape: (tuple) Array shape.
+            dtype: Array data type.
+        """
+        self._columns.append(name)
+        return np.zeros(shape, dtype=dtype)
+
+    def _load_array(self, name, filename):
+        """Opens stored array as a copy-on-write memory map. Override to change the storage
+        backend.
+
+        Args:
+            name: (str) Array name.
+            filename: (str) Path to the `.npy` file.
+        """
+        return np.load(filename, mmap_mode='c')
+
+    def _allocate(self, obs, action, reward, term):
+        """Allocates storage arrays, according to the shapes and types of the given transition."""
+        obs = np.asarray(obs)
+        action = np.asarray(action)
+        self._obs = self._new_array('obs', (self._capacity + 1,) + obs.shape, obs.dtype)
+        self._actions = self._new_array('actions', (self._capacity,) + action.shape,
+                                        action.dtype)
+        self._rewards = self._new_array('rewards', (self._capacity,),
+                                        np.result_type(reward, np.float32))
+        self._terms = self._new_array('terms', (self._capacity,), np.asarray(term).dtype)
+
+    def _on_restore(self):
+        """Called after the storage arrays and state attributes have been restored."""
+        pass
+
+    def _write_meta(self, path):
+        meta = {'capacity': self._capacity,
+                'columns': self._columns,
+                'state': {attr: _to_builtin(getattr(self, attr)) for attr in self._state_attrs}}
+        meta_path = os.path.join(path, self._META_FILE)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.rename(meta_path + '.tmp', meta_path)
+
+    def _restore(self, path):
+        with open(os.path.join(path, self._META_FILE)) as f:
+            meta = json.load(f)
+        if meta['capacity'] != self._capacity:
+            raise ValueError("Replay buffer at %s has different capacity (Got: %s, expected: %s)."
+                             % (path, meta['capacity'], self._capacity))
+        self._columns = []
+        for name in meta['columns']:
+            array = self._load_array(name, os.path.join(path, name + '.npy'))
+            setattr(self, '_' + name, array)
+            self._columns.append(name)
+        for attr, value in meta['state'].items():
+            setattr(self, attr, value)
+        self._on_restore()
+        logger.info('Replay buffer with %d transitions has been restored from: %s'
+                    % (self._size, path))
+
+    def save(self, path):
+        """Writes replay snapshot into the given directory.
+        Storage arrays are streamed to `.npy` files chunk by chunk, without making
+        an in-memory copy of the whole buffer. Existing snapshot is replaced only after
+        the new one has been completely written.
+
+        Args:
+            path: (str) Snapshot directory.
+        """
+        path = os.path.normpath(path)
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name in self._columns:
+            _save_array_chunked(os.path.join(tmp_path, name + '.npy'), getattr(self, '_' + name))
+        self._write_meta(tmp_path)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        logger.info('Replay buffer has been saved to: %s' % path)
+
+    def load(self, path):
+        """Restores replay snapshot, written by `save`.
+        Storage arrays are memory-mapped in copy-on-write mode, so no data is read
+        until it's accessed, and the snapshot files are never modified.
+
+        Args:
+            path: (str) Snapshot directory.
+        """
+        self._restore(path)
+
+    @staticmethod
+    def has_snapshot(path):
+        """Checks whether the given directory contains replay snapshot."""
+        return os.path.exists(os.path.join(path, ExperienceReplay._META_FILE))
 
     def _cycle_idx(self, idx):
         return idx % self._capacity
 
     def add(self, obs, action, reward, obs_next, term):
+        if self._obs is None:
+            self._allocate(obs, action, reward, term)
         self._actions[self._idx] = action
         self._rewards[self._idx] = reward
         self._terms[self._idx] = term
         self._obs[self._idx] = obs
-        # if not term:
         self._obs[self._idx + 1] = obs_next
         self._idx = self._cycle_idx(self._idx + 1)
         self._size = min(self._size + 1, self._capacity)
 
+    def _gather(self, idxs):
+        """Gathers batch of transitions at given indexes into contiguous arrays.
+
+        Returns:
+            Tuple of (observations, actions, rewards, next observations, terminals).
+        """
+        return (self._obs[idxs],
+                self._actions[idxs],
+                self._rewards[idxs],
+                self._obs[idxs + 1],
+                self._terms[idxs])
+
+    def _valid_start(self):
+        """Returns index of the oldest transition, which observation wasn't overwritten."""
+        if self._size < self._capacity:
+            return 0
+        # The oldest observation is overwritten by the next observation of the newest one.
+        return self._cycle_idx(self._idx + 1)
+
     def sample(self):
-        rand_idxs = random.sample(range(self._size), self._batch_size)
-        gather = itemgetter(*rand_idxs)
-        next_obs_gather = itemgetter(*[i + 1 for i in rand_idxs])
-        return (gather(self._obs),
-                gather(self._actions),
-                gather(self._rewards),
-                next_obs_gather(self._obs),
-                gather(self._terms),
-                rand_idxs,
-                [1.0] * len(rand_idxs))
+        num_valid = self._size - 1 if self._size == self._capacity else self._size
+        if num_valid < self._batch_size:
+            raise ValueError("Replay has fewer transitions than the batch size (Got: %s, "
+                             "expected at least: %s)." % (num_valid, self._batch_size))
+        # Batch is sampled without replacement: duplicate indexes are redrawn.
+        # Unlike `np.random.choice(replace=False)`, doesn't permute the whole buffer.
+        idxs = np.unique(np.random.randint(0, num_valid, self._batch_size))
+        while len(idxs) < self._batch_size:
+            draws = np.random.randint(0, num_valid, self._batch_size - len(idxs))
+            idxs = np.unique(np.concatenate([idxs, draws]))
+        np.random.shuffle(idxs)
+        idxs = self._cycle_idx(idxs + self._valid_start())
+        return self._gather(idxs) + (idxs, np.ones(self._batch_size, dtype=np.float32))
 
     @property
     def size(self):
         return self._size
 
+    @property
+    def min_size(self):
+        return self._min_size
+
     @property
     def is_ready(self):
         return self._size >= self._min_size
@@ -67,14 +213,561 @@ class ExperienceReplay(object):
         return self._size
 
 
-class ProportionalReplay(ExperienceReplay):
-    def __init__(self, capacity, min_size, batch_size, alpha=1.0):
-        super(ProportionalReplay, self).__init__(capacity, min_size, batch_size)
+class FrameStackReplay(ExperienceReplay):
+    _state_attrs = ExperienceReplay._state_attrs + ('_frame_len', '_new_episode')
+
+    def __init__(self, capacity, min_size, batch_size, obs_stack):
+        """Experience Replay for stacked observations, which stores every frame only once.
+
+        Expects observations, stacked along the last axis (see `EnvWrapper`).
+        Only the most recent frame of each observation is kept, while the whole stacks
+        for both observation and next observation are rebuilt at sample time.
+        Stacks at the beginning of an episode are padded with the episode's first frame,
+        in the same way as environment wrappers do on reset.
+
+        See `ExperienceReplay`.
+        Args:
+            obs_stack: (int) Length of the observations stack.
+        """
+        super(FrameStackReplay, self).__init__(capacity, min_size, batch_size)
+        if obs_stack < 1:
+            raise ValueError("Observation stack length must be higher or equal to 1.")
+        self._obs_stack = obs_stack
+        self._frame_len = None
+        # Amount of preceding frames from the same episode, available for each transition.
+        self._offsets = None
+        self._new_episode = True
+
+    def _allocate(self, obs, action, reward, term):
+        obs = np.asarray(obs)
+        if obs.ndim == 0 or obs.shape[-1] % self._obs_stack != 0:
+            raise ValueError("Observation last axis must be divisible by the stack length "
+                             "%d (Got shape: %s)." % (self._obs_stack, obs.shape))
+        self._frame_len = obs.shape[-1] // self._obs_stack
+        frame = obs[..., -self._frame_len:]
+        super(FrameStackReplay, self)._allocate(frame, action, reward, term)
+        self._offsets = self._new_array('offsets', (self._capacity,), np.int32)
+
+    def add(self, obs, action, reward, obs_next, term):
+        if self._obs is None:
+            self._allocate(obs, action, reward, term)
+        if self._new_episode:
+            self._offsets[self._idx] = 0
+        else:
+            prev_offset = self._offsets[self._idx - 1]
+            self._offsets[self._idx] = min(prev_offset + 1, self._obs_stack - 1)
+        self._new_episode = term
+        super(FrameStackReplay, self).add(np.asarray(obs)[..., -self._frame_len:], action,
+                                          reward, np.asarray(obs_next)[..., -self._frame_len:],
+                                          term)
+
+    def _stack_frames(self, frames):
+        """Concatenates (batch, stack, ...) frames along the last observation axis."""
+        frames = np.moveaxis(frames, 1, -2)
+        return frames.reshape(frames.shape[:-2] + (-1,))
+
+    def _gather(self, idxs):
+        start = self._valid_start()
+        offsets = np.minimum(self._offsets[idxs], (idxs - start) % self._capacity)
+        dists = np.arange(self._obs_stack - 1, -1, -1)
+        frame_idxs = idxs[:, None] - np.minimum(dists[None, :], offsets[:, None])
+        frames = self._obs[frame_idxs % self._capacity]
+        frames_next = np.concatenate([frames[:, 1:], self._obs[idxs + 1][:, None]], axis=1)
+        return (self._stack_frames(frames),
+                self._actions[idxs],
+                self._rewards[idxs],
+                self._stack_frames(frames_next),
+                self._terms[idxs])
+
+
+class NStepReplay(ExperienceReplay):
+    _state_attrs = ExperienceReplay._state_attrs + ('_num_ready', '_pending_state')
+
+    def __init__(self, capacity, min_size, batch_size, n_step, gamma=0.99):
+        """Experience Replay with N-step returns.
+
+        Each incoming transition is written to the buffer right away, while its return is
+        accumulated incrementally as further rewards of the same environment arrive.
+        Transition becomes available for sampling after `n_step` more transitions,
+        or after the end of the episode. Its bootstrap observation is the observation of
+        the transition, which was added `n_step` steps later, so transitions of several
+        environments can be added in any order (see `env_id` of `add`).
+
+        `sample` returns one more element, than `ExperienceReplay.sample`:
+        discount exponents, i.e. amount of rewards accumulated into each return.
+        The bootstrap value must be discounted by gamma to the power of this exponent.
+        Pending transitions are kept in snapshots, so environment ids must be
+        JSON-serializable (e.g. integers or strings) to `save` the replay.
+        Pending transition, which slot has been overwritten before its return is
+        completed (e.g. with more environments, than the capacity allows), is dropped.
+
+        See `ExperienceReplay`.
+        Args:
+            n_step: (int) Maximum number of accumulated rewards.
+            gamma: (float) Reward discount factor.
+        """
+        super(NStepReplay, self).__init__(capacity, min_size, batch_size)
+        if n_step < 1:
+            raise ValueError("Number of steps must be higher or equal to 1.")
+        self._n_step = n_step
+        self._gamma = gamma
+        # Pending transitions per environment:
+        # [index, accumulated return, amount of rewards, write count of the slot].
+        self._pending = defaultdict(deque)
+        self._bootstraps = None
+        self._writes = None
+        self._exponents = None
+        self._ready = None
+        self._num_ready = 0
+
+    def _allocate(self, obs, action, reward, term):
+        super(NStepReplay, self)._allocate(obs, action, reward, term)
+        self._bootstraps = self._new_array('bootstraps', (self._capacity,), np.int64)
+        self._exponents = self._new_array('exponents', (self._capacity,), np.int32)
+        self._ready = self._new_array('ready', (self._capacity,), np.bool_)
+        # Amount of writes to each slot, used to detect overwritten pending transitions.
+        self._writes = self._new_array('writes', (self._capacity,), np.int64)
+
+    @property
+    def _pending_state(self):
+        return [[env_id, list(window)] for env_id, window in self._pending.items() if window]
+
+    @_pending_state.setter
+    def _pending_state(self, value):
+        self._pending = defaultdict(deque)
+        for env_id, window in value:
+            env_id = tuple(env_id) if isinstance(env_id, list) else env_id
+            self._pending[env_id] = deque(list(pending) for pending in window)
+
+    def _finalize(self, pending, bootstrap_idx, term):
+        idx, ret, steps, write = pending
+        if self._writes[idx] != write:
+            return
+        self._rewards[idx] = ret
+        self._terms[idx] = term
+        self._bootstraps[idx] = bootstrap_idx
+        self._exponents[idx] = steps
+        self._ready[idx] = True
+        self._num_ready += 1
+
+    def add(self, obs, action, reward, obs_next, term, env_id=0):
+        """Adds transition of the given environment.
+        Transitions of each environment must be added in order of their occurrence.
+
+        Args:
+            env_id: Environment identifier.
+        """
+        if self._obs is None:
+            self._allocate(obs, action, reward, term)
+        idx = self._idx
+        if self._ready[idx]:
+            self._num_ready -= 1
+            self._ready[idx] = False
+        self._obs[idx] = obs
+        self._actions[idx] = action
+        self._writes[idx] += 1
+        window = self._pending[env_id]
+        if window and window[0][2] == self._n_step:
+            # Observation of the current transition is the bootstrap of the oldest one.
+            self._finalize(window.popleft(), idx, term=False)
+        for pending in window:
+            pending[1] += self._gamma ** pending[2] * reward
+            pending[2] += 1
+        window.append([idx, reward, 1, int(self._writes[idx])])
+        if term:
+            while window:
+                self._finalize(window.popleft(), idx, term=True)
+        self._idx = self._cycle_idx(self._idx + 1)
+        self._size = min(self._size + 1, self._capacity)
+
+    def _gather(self, idxs):
+        return (self._obs[idxs],
+                self._actions[idxs],
+                self._rewards[idxs],
+                self._obs[self._bootstraps[idxs]],
+                self._terms[idxs])
+
+    def sample(self):
+        if self._num_ready == 0:
+            raise ValueError("Replay has no transitions with completed returns.")
+        idxs = np.random.randint(0, self._size, self._batch_size)
+        not_ready = ~self._ready[idxs]
+        while np.any(not_ready):
+            idxs[not_ready] = np.random.randint(0, self._size, np.count_nonzero(not_ready))
+            not_ready = ~self._ready[idxs]
+        return self._gather(idxs) + (idxs, np.ones(self._batch_size, dtype=np.float32),
+                                     self._exponents[idxs])
+
+
+class EpisodeReplay(ExperienceReplay):
+    _state_attrs = ExperienceReplay._state_attrs + ('_num_added', '_new_episode', '_episodes')
+
+    def __init__(self, capacity, min_size, batch_size, seq_len, cross_episodes=False):
+        """Experience Replay, which samples contiguous sequences of transitions.
+
+        Keeps an index of the start and end offsets of the stored episodes.
+        `sample` returns batches of `seq_len` consecutive transitions, i.e. all the elements
+        have (batch_size, seq_len) leading dimensions, gathered at once. Importance weights
+        are returned per sequence. By default, sequences never cross episode boundaries,
+        so episodes shorter than `seq_len` are not sampled.
+
+        See `ExperienceReplay`.
+        Args:
+            seq_len: (int) Length of the sampled sequences.
+            cross_episodes: (bool) If enabled, sequences may continue into the next episode.
+                            Use returned terminal flags to separate them.
+        """
+        super(EpisodeReplay, self).__init__(capacity, min_size, batch_size)
+        if seq_len < 1:
+            raise ValueError("Sequence length must be higher or equal to 1.")
+        if seq_len >= capacity:
+            raise ValueError("Sequence length must be lower than the replay capacity "
+                             "(Got: %s)." % seq_len)
+        self._seq_len = seq_len
+        self._cross_episodes = cross_episodes
+        # Total amount of added transitions. Episode offsets are counted in these units.
+        self._num_added = 0
+        self._new_episode = True
+        # [start, end) offsets of the stored episodes, ordered from the oldest.
+        self._episodes = deque()
+
+    def _on_restore(self):
+        self._episodes = deque(list(episode) for episode in self._episodes)
+
+    def add(self, obs, action, reward, obs_next, term):
+        super(EpisodeReplay, self).add(obs, action, reward, obs_next, term)
+        if self._new_episode:
+            self._episodes.append([self._num_added, self._num_added + 1])
+        else:
+            self._episodes[-1][1] += 1
+        self._num_added += 1
+        self._new_episode = bool(term)
+        oldest = self._oldest_valid()
+        while self._episodes[0][1] <= oldest:
+            self._episodes.popleft()
+
+    def _oldest_valid(self):
+        """Returns offset of the oldest transition, which observation wasn't overwritten."""
+        num_valid = self._size - 1 if self._size == self._capacity else self._size
+        return self._num_added - num_valid
+
+    def _sequence_starts(self):
+        """Returns offsets and amounts of the valid sequence starts per chunk of transitions."""
+        oldest = self._oldest_valid()
+        if self._cross_episodes:
+            return (np.array([oldest], dtype=np.int64),
+                    np.array([max(self._num_added - oldest - self._seq_len + 1, 0)]))
+        bounds = np.array(self._episodes, dtype=np.int64).reshape(-1, 2)
+        starts = np.maximum(bounds[:, 0], oldest)
+        counts = np.maximum(bounds[:, 1] - starts - self._seq_len + 1, 0)
+        return starts, counts
+
+    def sample(self):
+        starts, counts = self._sequence_starts()
+        cum_counts = np.cumsum(counts)
+        # Empty replay has no episodes, hence no chunks at all.
+        if len(cum_counts) == 0 or cum_counts[-1] == 0:
+            raise ValueError("Replay has no sequences of length %d." % self._seq_len)
+        draws = np.random.randint(0, cum_counts[-1], self._batch_size)
+        chunks = np.searchsorted(cum_counts, draws, side='right')
+        offsets = starts[chunks] + draws - (cum_counts[chunks] - counts[chunks])
+        idxs = self._cycle_idx(offsets[:, None] + np.arange(self._seq_len))
+        return self._gather(idxs) + (idxs, np.ones(self._batch_size, dtype=np.float32))
+
+
+class ConcurrentReplay(ExperienceReplay):
+    _state_attrs = ExperienceReplay._state_attrs + ('_num_added',)
+
+    def __init__(self, capacity, min_size, batch_size):
+        """Uniform Experience Replay, which can be filled from multiple threads at once.
+
+        Each `add` reserves a write slot by drawing a ticket from an atomic counter and
+        writes the transition without taking any lock (only the counter of completed writes
+        is updated under a short lock afterwards). Every slot is guarded with
+        a sequence number, that is odd while the slot is being written:
+        `sample` rereads sequence numbers after gathering the batch and resamples
+        transitions, which were not fully written, or were overwritten in the meantime.
+        Since transitions from different threads are interleaved, next observations
+        are stored explicitly, instead of sharing them with the following transition.
+
+        See `ExperienceReplay`.
+        """
+        super(ConcurrentReplay, self).__init__(capacity, min_size, batch_size)
+        self._obs_next = None
+        self._seqs = None
+        self._num_added = 0
+        self._tickets = itertools.count()
+        self._alloc_lock = threading.Lock()
+        self._count_lock = threading.Lock()
+
+    def _allocate(self, obs, action, reward, term):
+        super(ConcurrentReplay, self)._allocate(obs, action, reward, term)
+        self._obs_next = self._new_array('obs_next', (self._capacity,) + self._obs.shape[1:],
+                                         self._obs.dtype)
+        self._seqs = self._new_array('seqs', (self._capacity,), np.int64)
+
+    def _on_restore(self):
+        self._tickets = itertools.count(self._num_added)
+
+    def add(self, obs, action, reward, obs_next, term):
+        if self._seqs is None:
+            with self._alloc_lock:
+                if self._seqs is None:
+                    self._allocate(obs, action, reward, term)
+        ticket = next(self._tickets)
+        idx = ticket % self._capacity
+        self._seqs[idx] = 2 * ticket + 1
+        self._obs[idx] = obs
+        self._actions[idx] = action
+        self._rewards[idx] = reward
+        self._obs_next[idx] = obs_next
+        self._terms[idx] = term
+        self._seqs[idx] = 2 * ticket + 2
+        with self._count_lock:
+            self._num_added += 1
+            self._idx = self._cycle_idx(self._num_added)
+            self._size = min(self._num_added, self._capacity)
+
+    def _gather(self, idxs):
+        return (self._obs[idxs],
+                self._actions[idxs],
+                self._rewards[idxs],
+                self._obs_next[idxs],
+                self._terms[idxs])
+
+    def _read(self, idxs):
+        """Gathers transitions and returns them along with the mask of consistent ones."""
+        seqs = self._seqs[idxs]
+        batch = self._gather(idxs)
+        valid = (seqs > 0) & (seqs % 2 == 0) & (seqs == self._seqs[idxs])
+        return batch, valid
+
+    def sample(self):
+        idxs = np.random.randint(0, self._size, self._batch_size)
+        batch, valid = self._read(idxs)
+        while not valid.all():
+            invalid = np.flatnonzero(~valid)
+            idxs[invalid] = np.random.randint(0, self._size, len(invalid))
+            resampled, valid[invalid] = self._read(idxs[invalid])
+            for column, values in zip(batch, resampled):
+                column[invalid] = values
+        return batch + (idxs, np.ones(self._batch_size, dtype=np.float32))
+
+
+class ZlibCodec(object):
+    def __init__(self, level=1):
+        """Observation codec, based on the standard `zlib` module.
+        Any object with `compress(bytes)` and `decompress(bytes)` methods
+        (e.g. `lz4.frame` module) can be used as a codec in the same way.
+
+        Args:
+            level: (int) Compression level from 1 (fastest) to 9 (best).
+        """
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class CompressedReplay(ExperienceReplay):
+    _state_attrs = ExperienceReplay._state_attrs + ('_new_episode', '_frame_shape',
+                                                    '_frame_dtype')
+    # Columns of the snapshot, that hold concatenated compressed frames and their offsets.
+    _BLOB_COLUMNS = ('obs_blobs', 'obs_offsets')
+
+    def __init__(self, capacity, min_size, batch_size, codec=None, cache_size=0):
+        """Uniform Experience Replay, which keeps observations compressed in memory.
+
+        Every observation is compressed on `add` (observation of a transition, which continues
+        the episode, reuses the compressed next observation of the previous one).
+        In `sample`, each distinct frame of the
+        batch (observations and next observations overlap) is decompressed only once,
+        and the decoded frames are gathered into contiguous arrays.
+        Pixel observations usually compress 5-10 times with the fastest `zlib` level.
+
+        See `ExperienceReplay`.
+        Args:
+            codec: Observation codec (see `ZlibCodec`). If None, `ZlibCodec()` is used.
+            cache_size: (int) Number of recently decoded frames to keep in the LRU cache.
+                        To disable, pass 0.
+        """
+        super(CompressedReplay, self).__init__(capacity, min_size, batch_size)
+        self._codec = codec or ZlibCodec()
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._frame_shape = None
+        self._frame_dtype = None
+        self._new_episode = True
+        # Index of the next observation of the last added transition.
+        self._last_next_idx = None
+
+    def _allocate(self, obs, action, reward, term):
+        obs = np.asarray(obs)
+        self._frame_shape = obs.shape
+        self._frame_dtype = obs.dtype
+        self._obs = [None] * (self._capacity + 1)
+        self._actions = self._new_array('actions', (self._capacity,) + np.shape(action),
+                                        np.asarray(action).dtype)
+        self._rewards = self._new_array('rewards', (self._capacity,),
+                                        np.result_type(reward, np.float32))
+        self._terms = self._new_array('terms', (self._capacity,), np.asarray(term).dtype)
+
+    def _encode(self, idx, obs):
+        obs = np.ascontiguousarray(obs, dtype=self._frame_dtype)
+        self._obs[idx] = self._codec.compress(obs.tobytes())
+        self._cache.pop(idx, None)
+
+    def _decode(self, idx):
+        frame = self._cache.pop(idx, None)
+        if frame is None:
+            frame = np.frombuffer(self._codec.decompress(self._obs[idx]),
+                                  dtype=self._frame_dtype).reshape(self._frame_shape)
+        if self._cache_size:
+            self._cache[idx] = frame
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return frame
+
+    def add(self, obs, action, reward, obs_next, term):
+        if self._obs is None:
+            self._allocate(obs, action, reward, term)
+        self._actions[self._idx] = action
+        self._rewards[self._idx] = reward
+        self._terms[self._idx] = term
+        if self._new_episode or self._last_next_idx is None:
+            self._encode(self._idx, obs)
+        elif self._last_next_idx != self._idx:
+            # After the wrap, the last next observation is stored in the extra last slot.
+            self._obs[self._idx] = self._obs[self._last_next_idx]
+            self._cache.pop(self._idx, None)
+        self._encode(self._idx + 1, obs_next)
+        self._last_next_idx = self._idx + 1
+        self._new_episode = bool(term)
+        self._idx = self._cycle_idx(self._idx + 1)
+        self._size = min(self._size + 1, self._capacity)
+
+    def _gather(self, idxs):
+        frame_idxs, positions = np.unique(np.concatenate([idxs, idxs + 1]),
+                                          return_inverse=True)
+        frames = np.empty((len(frame_idxs),) + self._frame_shape, dtype=self._frame_dtype)
+        for i, idx in enumerate(frame_idxs):
+            frames[i] = self._decode(idx)
+        return (frames[positions[:len(idxs)]],
+                self._actions[idxs],
+                self._rewards[idxs],
+                frames[positions[len(idxs):]],
+                self._terms[idxs])
+
+    def save(self, path):
+        """Writes replay snapshot into the given directory.
+        Compressed observations are written as is: concatenated into a single byte array,
+        along with the array of their offsets. See `ExperienceReplay.save`.
+        """
+        if self._obs is None:
+            return super(CompressedReplay, self).save(path)
+        lengths = [len(frame) if frame is not None else 0 for frame in self._obs]
+        self._obs_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self._obs_blobs = np.frombuffer(b''.join(frame for frame in self._obs
+                                                 if frame is not None), dtype=np.uint8)
+        columns = self._columns
+        self._columns = columns + list(self._BLOB_COLUMNS)
+        try:
+            super(CompressedReplay, self).save(path)
+        finally:
+            self._columns = columns
+            del self._obs_blobs, self._obs_offsets
+
+    def _on_restore(self):
+        self._cache.clear()
+        self._last_next_idx = None
+        if self._frame_shape is None:
+            return
+        self._frame_shape = tuple(self._frame_shape)
+        self._frame_dtype = np.dtype(self._frame_dtype)
+        blobs = self._obs_blobs
+        offsets = self._obs_offsets
+        self._obs = [bytes(blobs[start:end]) if end > start else None
+                     for start, end in zip(offsets[:-1], offsets[1:])]
+        self._columns = [name for name in self._columns if name not in self._BLOB_COLUMNS]
+        del self._obs_blobs, self._obs_offsets
+
+    @property
+    def compression_ratio(self):
+        """Returns ratio between raw and compressed size of the stored observations."""
+        stored = [frame for frame in self._obs or [] if frame is not None]
+        if not stored:
+            return 1.0
+        raw = len(stored) * int(np.prod(self._frame_shape)) * self._frame_dtype.itemsize
+        return raw / sum(len(frame) for frame in stored)
+
+
+class BasePrioritizedReplay(ExperienceReplay):
+    _state_attrs = ExperienceReplay._state_attrs + ('_max_priority', '_sample_step')
+
+    def __init__(self, capacity, min_size, batch_size, alpha=1.0,
+                 beta=1.0, beta_final=1.0, beta_anneal_steps=0):
+        """Base class for Prioritized Experience Replay, based on paper:
+        "Prioritized Experience Replay", Schaul et al., 2016.
+
+        See `ExperienceReplay`.
+        Args:
+            alpha: (float) Prioritization exponent. 0 corresponds to the uniform sampling.
+            beta: (float) Initial importance sampling exponent.
+            beta_final: (float) Final importance sampling exponent.
+            beta_anneal_steps: (int) Number of `sample` calls, during which
+                               beta is linearly annealed from `beta` to `beta_final`.
+        """
+        super(BasePrioritizedReplay, self).__init__(capacity, min_size, batch_size)
+        self._alpha = alpha
+        self._beta = beta
+        self._beta_final = beta_final
+        self._beta_anneal_steps = beta_anneal_steps
+        self._sample_step = 0
+        self._max_priority = 0.0
+
+    @property
+    def beta(self):
+        """Current importance sampling exponent."""
+        if self._sample_step >= self._beta_anneal_steps:
+            return self._beta_final
+        fraction = self._sample_step / self._beta_anneal_steps
+        return self._beta + fraction * (self._beta_final - self._beta)
+
+    def update(self, indexes, priorities):
+        """Updates priorities of the transitions at given indexes."""
+        raise NotImplementedError
+
+
+class ProportionalReplay(BasePrioritizedReplay):
+    def __init__(self, capacity, min_size, batch_size, alpha=1.0,
+                 beta=1.0, beta_final=1.0, beta_anneal_steps=0):
+        """Proportional Prioritized Experience Replay.
+        See `BasePrioritizedReplay`.
+        """
+        super(ProportionalReplay, self).__init__(capacity, min_size, batch_size, alpha,
+                                                 beta, beta_final, beta_anneal_steps)
         self.sumtree = SumTree(capacity)
         self.mintree = MinTree(capacity)
-        self._alpha = alpha
         self._epsilon = 0.00001
-        self._max_priority = 0.0
+        self._priorities = None
+
+    def _allocate(self, obs, action, reward, term):
+        super(ProportionalReplay, self)._allocate(obs, action, reward, term)
+        self._priorities = self._new_array('priorities', (self._capacity,), np.float64)
+
+    def _on_restore(self):
+        self.sumtree.assign(self._priorities, self._idx, self._size)
+        self.mintree.assign(self._priorities, self._idx, self._size)
+        self._exclude_overwritten()
+
+    def _exclude_overwritten(self):
+        """Prevents sampling of the oldest transition, which observation was overwritten."""
+        if self._size == self._capacity:
+            self.sumtree.update(self._idx, 0.0)
+            self.mintree.update(self._idx, float('inf'))
 
     def _preproc_priority(self, error):
         return (error + self._epsilon) ** self._alpha
@@ -82,44 +775,387 @@ class ProportionalReplay(ExperienceReplay):
     def add(self, obs, action, reward, obs_next, term, priority=None):
         if priority is None:
             priority = self._max_priority
+        priority = self._preproc_priority(priority)
+        idx = self._idx
         super(ProportionalReplay, self).add(obs, action, reward, obs_next, term)
-        self.sumtree.append(self._preproc_priority(priority))
-        self.mintree.append(self._preproc_priority(priority))
+        self._priorities[idx] = priority
+        self.sumtree.append(priority)
+        self.mintree.append(priority)
+        self._exclude_overwritten()
 
     def sample(self):
-        idxs = []
+        # Stratified sampling: one uniform sample per each of `batch_size` equal segments.
         proportion = self.sumtree.sum() / self._batch_size
-        for i in range(self._batch_size):
-            sum_from = proportion * i
-            sum_to = proportion * (i + 1)
-            s = random.uniform(sum_from, sum_to)
-            idxs.append(self.sumtree.find_sum_idx(s))
-        gather = itemgetter(*idxs)
-        next_obs_gather = itemgetter(*[i + 1 for i in idxs])
+        sums = (np.arange(self._batch_size) + np.random.uniform(size=self._batch_size))
+        idxs = self.sumtree.find_sum_idx(sums * proportion)
         importances = self._compute_importance(idxs)
-        return (gather(self._obs),
-                gather(self._actions),
-                gather(self._rewards),
-                next_obs_gather(self._obs),
-                gather(self._terms),
-                idxs,
-                importances)
+        self._sample_step += 1
+        return self._gather(idxs) + (idxs, importances)
 
     def _compute_importance(self, indexes):
-        importances = [0.0] * len(indexes)
-        if self.mintree.min() == float('inf'):
-            return importances
-        importance_max = (self.mintree.min() / self.sumtree.sum()) * self.sumtree.size
-        for i, idx in enumerate(indexes):
-            prob = self.sumtree[idx] / self.sumtree.sum()
-            importances[i] = (prob * self.sumtree.size) / importance_max
-        return importances
+        """Computes normalized importance sampling weights: (P(i) / min P) ^ -beta."""
+        min_priority = self.mintree.min()
+        if min_priority == float('inf') or min_priority <= 0:
+            return np.ones(len(indexes), dtype=np.float32)
+        weights = (self.sumtree[indexes] / min_priority) ** -self.beta
+        return weights.astype(np.float32)
 
     def update(self, indexes, priorities):
         if not isinstance(priorities, np.ndarray):
             priorities = np.asarray(priorities)
         priorities += self._epsilon
         priorities = self._preproc_priority(priorities)
-        for idx, prior in zip(indexes, priorities):
-            self._max_priority = max(self._max_priority, prior)
-            self.sumtree.update(int(idx), prior)
+        indexes = np.asarray(indexes, dtype=np.int64)
+        self._max_priority = max(self._max_priority, float(np.max(priorities)))
+        self._priorities[indexes] = priorities
+        self.sumtree.update(indexes, priorities)
+        self.mintree.update(indexes, priorities)
+        self._exclude_overwritten()
+
+
+class RankBasedReplay(BasePrioritizedReplay):
+    _state_attrs = BasePrioritizedReplay._state_attrs + ('_heap_size', '_updates_since_sort')
+
+    def __init__(self, capacity, min_size, batch_size, alpha=0.7,
+                 beta=0.5, beta_final=1.0, beta_anneal_steps=0, sort_freq=None):
+        """Rank-based Prioritized Experience Replay.
+
+        Transition priorities are kept in a binary max-heap, so each priority update costs
+        O(log N). The heap is periodically re-sorted, which makes heap positions
+        approximately equal to the priority ranks. Probability of the rank `r` is
+        proportional to (1 / r) ^ alpha. Batch is drawn by stratified sampling over
+        `batch_size` segments of equal probability, which boundaries are precomputed
+        from the cumulative rank distribution.
+
+        See `BasePrioritizedReplay`.
+        Args:
+            sort_freq: (int) Amount of priority updates between heap re-sorts.
+                       Defaults to `capacity`.
+        """
+        super(RankBasedReplay, self).__init__(capacity, min_size, batch_size, alpha,
+                                              beta, beta_final, beta_anneal_steps)
+        self._sort_freq = sort_freq or capacity
+        self._updates_since_sort = 0
+        self._heap_size = 0
+        self._heap_prio = None
+        self._heap_ids = None
+        self._heap_pos = None
+        self._rank_cdf = np.cumsum((1.0 / np.arange(1, capacity + 1)) ** alpha)
+        self._bounds = None
+        self._bounds_size = None
+
+    def _allocate(self, obs, action, reward, term):
+        super(RankBasedReplay, self)._allocate(obs, action, reward, term)
+        self._heap_prio = self._new_array('heap_prio', (self._capacity,), np.float64)
+        self._heap_ids = self._new_array('heap_ids', (self._capacity,), np.int64)
+        self._heap_pos = self._new_array('heap_pos', (self._capacity,), np.int64)
+
+    def _swap(self, i, j):
+        heap_prio, heap_ids = self._heap_prio, self._heap_ids
+        id_i, id_j = heap_ids.item(i), heap_ids.item(j)
+        heap_prio[i], heap_prio[j] = heap_prio.item(j), heap_prio.item(i)
+        heap_ids[i], heap_ids[j] = id_j, id_i
+        self._heap_pos[id_j] = i
+        self._heap_pos[id_i] = j
+
+    def _sift_up(self, pos):
+        heap_prio = self._heap_prio
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if heap_prio.item(pos) <= heap_prio.item(parent):
+                break
+            self._swap(pos, parent)
+            pos = parent
+        return pos
+
+    def _sift_down(self, pos):
+        heap_prio = self._heap_prio
+        while True:
+            largest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < self._heap_size and heap_prio.item(child) > heap_prio.item(largest):
+                    largest = child
+            if largest == pos:
+                return pos
+            self._swap(pos, largest)
+            pos = largest
+
+    def _set_priority(self, idx, priority):
+        pos = self._heap_pos.item(idx)
+        self._heap_prio[pos] = priority
+        if self._sift_up(pos) == pos:
+            self._sift_down(pos)
+
+    def _sort(self):
+        """Sorts the heap by priority, which makes heap positions equal to priority ranks."""
+        n = self._heap_size
+        order = np.argsort(-self._heap_prio[:n], kind='mergesort')
+        self._heap_prio[:n] = self._heap_prio[:n][order]
+        self._heap_ids[:n] = self._heap_ids[:n][order]
+        self._heap_pos[self._heap_ids[:n]] = np.arange(n)
+        self._updates_since_sort = 0
+
+    def _exclude_overwritten(self):
+        """Moves the oldest transition, which observation was overwritten,
+        to the last heap position, which is never sampled."""
+        if self._size < self._capacity:
+            return
+        pos = self._heap_pos.item(self._idx)
+        self._heap_prio[pos] = float('-inf')
+        last = self._heap_size - 1
+        if pos != last:
+            self._swap(pos, last)
+            if self._sift_up(pos) == pos:
+                self._sift_down(pos)
+
+    def add(self, obs, action, reward, obs_next, term, priority=None):
+        if priority is None:
+            priority = self._max_priority or 1.0
+        idx = self._idx
+        super(RankBasedReplay, self).add(obs, action, reward, obs_next, term)
+        if self._heap_size < self._capacity:
+            pos = self._heap_size
+            self._heap_size += 1
+            self._heap_ids[pos] = idx
+            self._heap_pos[idx] = pos
+            self._heap_prio[pos] = priority
+            self._sift_up(pos)
+        else:
+            self._set_priority(idx, priority)
+        self._exclude_overwritten()
+
+    def _segment_bounds(self, num_ranks):
+        """Returns boundaries of `batch_size` segments of equal probability over `num_ranks`."""
+        if self._bounds_size != num_ranks:
+            cdf = self._rank_cdf[:num_ranks]
+            targets = cdf[-1] * np.arange(1, self._batch_size) / self._batch_size
+            bounds = np.searchsorted(cdf, targets)
+            self._bounds = (np.concatenate([[0], bounds]),
+                            np.concatenate([bounds, [num_ranks]]))
+            self._bounds_size = num_ranks
+        return self._bounds
+
+    def sample(self):
+        num_ranks = self._heap_size - 1 if self._size == self._capacity else self._heap_size
+        low, high = self._segment_bounds(num_ranks)
+        positions = low + (np.random.uniform(size=self._batch_size)
+                           * np.maximum(high - low, 1)).astype(np.int64)
+        np.minimum(positions, num_ranks - 1, out=positions)
+        idxs = self._heap_ids[positions]
+        # P(r) / min P = (num_ranks / r) ^ alpha.
+        ranks = positions + 1.0
+        importances = ((ranks / num_ranks) ** (self._alpha * self.beta)).astype(np.float32)
+        self._sample_step += 1
+        return self._gather(idxs) + (idxs, importances)
+
+    def update(self, indexes, priorities):
+        priorities = np.asarray(priorities, dtype=np.float64)
+        self._max_priority = max(self._max_priority, float(np.max(priorities)))
+        for idx, priority in zip(np.asarray(indexes).tolist(), priorities.tolist()):
+            self._set_priority(idx, priority)
+        self._exclude_overwritten()
+        self._updates_since_sort += len(priorities)
+        if self._updates_since_sort >= self._sort_freq:
+            self._sort()
+
+
+class MemmapReplay(ExperienceReplay):
+    def __init__(self, capacity, min_size, batch_size, path, **kwargs):
+        """Experience Replay, which keeps its storage in `numpy.memmap` files.
+
+        Each storage array is placed into a separate `.npy` file under the `path` directory,
+        so hot transitions are served from the OS page cache, while the rest stays on disk.
+        If `path` already contains a buffer, it's reopened with all the stored transitions.
+        Call `flush` to make the current state persistent.
+
+        Can be combined with other replays through multiple inheritance,
+        see `MemmapProportionalReplay`.
+
+        See `ExperienceReplay`.
+        Args:
+            path: (str) Buffer directory.
+        """
+        super(MemmapReplay, self).__init__(capacity, min_size, batch_size, **kwargs)
+        self._path = os.path.normpath(path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if self.has_snapshot(path):
+            self._restore(path)
+
+    def _filename(self, name):
+        return os.path.join(self._path, name + '.npy')
+
+    def _new_array(self, name, shape, dtype):
+        self._columns.append(name)
+        return np.lib.format.open_memmap(self._filename(name), mode='w+',
+                                         dtype=dtype, shape=shape)
+
+    def _load_array(self, name, filename):
+        if os.path.normpath(filename) == self._filename(name):
+            return np.load(filename, mmap_mode='r+')
+        # Snapshot from another location: copy it into the own buffer files.
+        source = np.load(filename, mmap_mode='r')
+        array = np.lib.format.open_memmap(self._filename(name), mode='w+',
+                                          dtype=source.dtype, shape=source.shape)
+        for start, end in _chunks(source):
+            array[start:end] = source[start:end]
+        return array
+
+    def save(self, path):
+        if os.path.normpath(path) == self._path:
+            self.flush()
+        else:
+            super(MemmapReplay, self).save(path)
+
+    def flush(self):
+        """Writes storage arrays and replay state to disk."""
+        if not self._columns:
+            return
+        for name in self._columns:
+            getattr(self, '_' + name).flush()
+        self._write_meta(self._path)
+
+
+class MemmapProportionalReplay(MemmapReplay, ProportionalReplay):
+    """Proportional Prioritized Experience Replay, backed by `numpy.memmap` files.
+    See `MemmapReplay` and `ProportionalReplay`.
+    """
+    pass
+
+
+class ReplayPrefetcher(object):
+    def __init__(self, replay, queue_size=2):
+        """Samples batches from the replay on a background thread.
+
+        Proxies `add`, `update`, `flush`, `save`, `load` and `sample` of the wrapped replay,
+        so can be used in place of it. Replay is accessed under a lock, hence
+        priority updates are never interleaved with sampling. Note, that prefetched batches
+        may be sampled before the latest priority updates, up to `queue_size` batches behind.
+
+        Args:
+            replay: (core.ExperienceReplay) Wrapped replay.
+            queue_size: (int) Maximum number of ready batches.
+        """
+        if queue_size < 1:
+            raise ValueError("Queue size must be higher or equal to 1.")
+        self.replay = replay
+        self._lock = threading.Lock()
+        self._is_ready = threading.Event()
+        self._stop = threading.Event()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        if replay.is_ready:
+            self._is_ready.set()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._is_ready.wait(timeout=0.1):
+                continue
+            try:
+                with self._lock:
+                    batch = self.replay.sample()
+            except Exception as e:  # pylint: disable=broad-except
+                # Handed over to `sample`, which re-raises it and restarts the thread.
+                self._put(e)
+                return
+            self._put(batch)
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ReplayPrefetcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        """Stops the background thread and drops prefetched batches."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def add(self, *args, **kwargs):
+        with self._lock:
+            self.replay.add(*args, **kwargs)
+            if self.replay.is_ready:
+                self._is_ready.set()
+
+    def update(self, indexes, priorities):
+        with self._lock:
+            self.replay.update(indexes, priorities)
+
+    def flush(self):
+        with self._lock:
+            self.replay.flush()
+
+    def save(self, path):
+        with self._lock:
+            self.replay.save(path)
+
+    def load(self, path):
+        with self._lock:
+            self.replay.load(path)
+            if self.replay.is_ready:
+                self._is_ready.set()
+
+    def sample(self):
+        """Returns the next prefetched batch. Starts the background thread on the first call.
+        Exceptions, raised by the replay `sample` on the background thread, are re-raised."""
+        self.start()
+        batch = self._queue.get()
+        if isinstance(batch, Exception):
+            self._thread.join()
+            self._thread = None
+            raise batch
+        return batch
+
+    @property
+    def size(self):
+        return self.replay.size
+
+    @property
+    def min_size(self):
+        return self.replay.min_size
+
+    @property
+    def is_ready(self):
+        return self.replay.is_ready
+
+    def __len__(self):
+        return len(self.replay)
+
+
+def _to_builtin(value):
+    """Converts NumPy scalars and sequences of them to the built-in Python types."""
+    if isinstance(value, (list, tuple, deque)):
+        return [_to_builtin(v) for v in value]
+    if isinstance(value, np.dtype):
+        return value.str
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _chunks(array, chunk_bytes=64 * 2**20):
+    """Yields (start, end) ranges along the first axis of about `chunk_bytes` size."""
+    row_bytes = max(array[:1].nbytes, 1)
+    step = max(chunk_bytes // row_bytes, 1)
+    for start in range(0, len(array), step):
+        yield start, min(start + step, len(array))
+
+
+def _save_array_chunked(filename, array):
+    """Writes array into `.npy` file, copying at most one chunk into memory at a time."""
+    with open(filename, 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, np.lib.format.header_data_from_array_1_0(array))
+        for start, end in _chunks(array):
+            f.write(np.ascontiguousarray(array[start:end]).tobytes())
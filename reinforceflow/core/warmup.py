@@ -0,0 +1,129 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import time
+import random
+import multiprocessing as mp
+
+import numpy as np
+from six.moves import range  # pylint: disable=redefined-builtin
+from six.moves import queue
+
+import reinforceflow
+from reinforceflow import logger
+
+
+def _seed_worker(env, worker_id):
+    """Reseeds random generators of the forked worker, so workers don't repeat each other."""
+    seed = reinforceflow.get_random_seed()
+    seed = None if seed is None else seed + worker_id + 1
+    random.seed(seed)
+    np.random.seed(seed)
+    raw_env = getattr(env, 'env', None)
+    if hasattr(raw_env, 'seed'):
+        raw_env.seed(seed)
+    if hasattr(getattr(raw_env, 'action_space', None), 'seed'):
+        raw_env.action_space.seed(seed)
+
+
+def _random_rollouts(env, worker_id, chunks, stop, chunk_size):
+    """Worker loop: plays random policy and sends transitions in chunks of `chunk_size`.
+    Chunks of one worker are consecutive, the last chunk of each episode ends with terminal.
+    """
+    _seed_worker(env, worker_id)
+    # Don't wait for the parent to read buffered chunks on exit.
+    chunks.cancel_join_thread()
+    chunk = []
+    while not stop.is_set():
+        obs = env.reset()
+        term = False
+        while not term and not stop.is_set():
+            action = env.action_sample()
+            obs_next, reward, term, _ = env.step(action)
+            chunk.append((obs, action, reward, obs_next, term))
+            obs = obs_next
+            if term or len(chunk) >= chunk_size:
+                while not stop.is_set():
+                    try:
+                        chunks.put(chunk, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                chunk = []
+
+
+def fill_replay(env, replay, num_steps, num_workers=None, reward_clip=None, chunk_size=128):
+    """Fills replay with transitions of the uniform random policy.
+
+    Copies of the environment are stepped in parallel worker processes, without using
+    any model. Episodes are gathered from all workers concurrently and added to the replay
+    once completed, so transitions of each episode are contiguous, and replays, which rely
+    on the order of added transitions (e.g. `FrameStackReplay` or `NStepReplay`),
+    can be filled as well. The last episode is always completed, thus amount of added
+    transitions may exceed `num_steps` by at most one episode length.
+
+    Args:
+        env: (envs.EnvWrapper) Environment. Each worker process steps its own copy.
+        replay: (core.ExperienceReplay) Filled replay.
+        num_steps: (int) Minimum number of added transitions.
+        num_workers: (int) Number of worker processes. If None, amount of CPUs is used.
+        reward_clip: (float) If set, rewards are clipped to [-reward_clip, reward_clip].
+        chunk_size: (int) Maximum number of transitions, sent by a worker at once.
+
+    Returns: (int) Number of added transitions.
+    """
+    if num_steps <= 0:
+        return 0
+    num_workers = num_workers or mp.cpu_count()
+    stop = mp.Event()
+    queues = [mp.Queue(maxsize=4) for _ in range(num_workers)]
+    workers = [mp.Process(target=_random_rollouts,
+                          args=(env, worker_id, queues[worker_id], stop, chunk_size))
+               for worker_id in range(num_workers)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    logger.info('Filling replay with %d random transitions using %d workers.'
+                % (num_steps, num_workers))
+    start_time = time.time()
+    num_added = 0
+    # Episodes in progress, collected from the chunks of each worker.
+    episodes = [[] for _ in range(num_workers)]
+    try:
+        while num_added < num_steps:
+            received = False
+            # Poll every worker, so none of them is blocked on a full queue.
+            for worker_id, chunks in enumerate(queues):
+                try:
+                    chunk = chunks.get_nowait()
+                except queue.Empty:
+                    continue
+                received = True
+                episode = episodes[worker_id]
+                episode.extend(chunk)
+                if not episode[-1][4]:
+                    continue
+                # Completed episodes are added at once to keep their transitions contiguous.
+                for obs, action, reward, obs_next, term in episode:
+                    if reward_clip:
+                        reward = np.clip(reward, -reward_clip, reward_clip)
+                    replay.add(obs, action, reward, obs_next, term)
+                num_added += len(episode)
+                episodes[worker_id] = []
+                if num_added >= num_steps:
+                    break
+            if not received:
+                time.sleep(0.001)
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+        for chunks in queues:
+            chunks.cancel_join_thread()
+            chunks.close()
+    logger.info('Replay warm-up finished: %d transitions in %.2f sec.'
+                % (num_added, time.time() - start_time))
+    return num_added
@@ -2,3 +2,4 @@ from __future__ import absolute_import
 from reinforceflow.envs.env_factory import EnvFactory
 from reinforceflow.envs.env_wrapper import EnvWrapper
 from reinforceflow.envs.gym_wrapper import GymWrapper, GymPixelWrapper
+from reinforceflow.envs.vec_env_wrapper import VecEnvWrapper
@@ -19,7 +19,10 @@ class EnvFactory(object):
              random_start=0,
              resize_width=None,
              resize_height=None,
-             use_smart_wrap=True):
+             use_smart_wrap=True,
+             uint8_obs=False,
+             to_gray=False,
+             merge_last_frames=False):
         """Wraps environment into `reinforceflow.envs.EnvWrapper`.
 
         Args:
@@ -34,6 +37,14 @@ class EnvFactory(object):
                                 see Mnih et al., 2015.
             use_smart_wrap (bool): Enable smart wrapping. E.g.:
                            Atari environments will be processed as stated in Mnih et al., 2015.
+            uint8_obs (bool): Produces `uint8` pixel observations with the fast preprocessing.
+                              Applies only for pixel screen environments.
+                              See `GymPixelWrapper`.
+            to_gray (bool): Converts pixel observations to grayscale. For Atari environments
+                            enables reading the screen directly from ALE (see `GymPixelWrapper`).
+            merge_last_frames (bool): Takes maximum over the two last raw frames of the step,
+                                      to remove Atari sprites flickering.
+                                      Applies only for pixel screen environments.
 
         Returns (gym.Wrapper): Environment instance.
         """
@@ -46,15 +57,21 @@ class EnvFactory(object):
                 return GymPixelWrapper(env=env,
                                        action_repeat=action_repeat or 4,
                                        obs_stack=obs_stack or 4,
+                                       to_gray=to_gray,
+                                       merge_last_frames=merge_last_frames,
                                        resize_width=84,
-                                       resize_height=84)
+                                       resize_height=84,
+                                       uint8_obs=uint8_obs)
         if pixel_env:
             logger.info('Creating Gym pixel environment wrapper.')
             return GymPixelWrapper(env=env,
                                    action_repeat=action_repeat,
                                    obs_stack=obs_stack,
                                    resize_width=resize_width,
-                                   resize_height=resize_height)
+                                   resize_height=resize_height,
+                                   to_gray=to_gray,
+                                   merge_last_frames=merge_last_frames,
+                                   uint8_obs=uint8_obs)
 
         logger.info('Creating Gym environment wrapper.')
         return GymWrapper(env=env, action_repeat=action_repeat, obs_stack=obs_stack)
@@ -6,7 +6,7 @@ import copy
 
 import numpy as np
 from six.moves import range
-from reinforceflow.utils import stack_observations
+from reinforceflow.utils import FrameStack
 
 
 class EnvWrapper(object):
@@ -44,7 +44,7 @@ class EnvWrapper(object):
             raise ValueError("Observation stack length must be higher or equal to 0.")
         self._action_repeat = action_repeat or 1
         self._obs_stack_len = obs_stack or 1
-        self._obs_stack = None
+        self._obs_stack = FrameStack(self._obs_stack_len) if self._obs_stack_len > 1 else None
         self.obs_shape = list(np.shape(self.reset()))
         self.action_shape = list(np.shape(self.action_sample()))
         self.is_multiaction = len(self.action_shape) > 1
@@ -67,11 +67,10 @@ class EnvWrapper(object):
         Returns: (nd.array)
             First observation from the new episode.
         """
-        # Reset observations stack
-        self._obs_stack = None
         obs = self._reset()
-        if self._obs_stack_len > 1:
-            obs = stack_observations(obs, self._obs_stack_len, self._obs_stack)
+        # Reset observations stack
+        if self._obs_stack is not None:
+            obs = self._obs_stack.reset(obs)
         return obs
 
     def step(self, action):
@@ -91,9 +90,18 @@ class EnvWrapper(object):
             if done:
                 break
         # Observation stacking
-        if self._obs_stack_len and self._obs_stack_len > 1:
-            obs = stack_observations(obs, self._obs_stack_len, self._obs_stack)
+        if self._obs_stack is not None:
+            obs = self._obs_stack.push(obs)
         return obs, reward_total, done, info
 
-    def copy(self):
+    def copy(self, clone_state=False):
+        """Returns a copy of the environment.
+        Base implementation deep copies the wrapper, hence always copies its state.
+        """
         return copy.deepcopy(self)
+
+    def close(self):
+        """Releases resources of the raw environment, if it supports closing."""
+        close = getattr(self.env, 'close', None)
+        if close is not None:
+            close()
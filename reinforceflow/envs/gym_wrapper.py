@@ -2,6 +2,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
+import itertools
+
 import six
 try:
     import gym
@@ -12,14 +15,21 @@ except ImportError:
 import numpy as np
 import reinforceflow
 from reinforceflow.envs.env_wrapper import EnvWrapper
-from reinforceflow.utils import stack_observations, image_preprocess, one_hot
+from reinforceflow.utils import image_preprocess, one_hot, ImagePreprocessor
 
 
 class GymWrapper(EnvWrapper):
     """Light wrapper around OpenAI Gym and Universe environments.
     See `EnvWrapper`.
+
+    Args:
+        seed: (int) Environment seed. If None, global seed is used
+              (see `reinforceflow.set_random_seed`).
     """
-    def __init__(self, env, action_repeat=1, obs_stack=1):
+    # Offsets of the clone seeds from the global seed.
+    _clone_counter = itertools.count(1)
+
+    def __init__(self, env, action_repeat=1, obs_stack=1, seed=None):
         if gym is None:
             raise ImportError("Cannot import OpenAI Gym. In order to use Gym environments "
                               "you must install it first. Follow the instructions on "
@@ -35,10 +45,47 @@ class GymWrapper(EnvWrapper):
                                          continious_observation=continious_observation,
                                          action_repeat=action_repeat,
                                          obs_stack=obs_stack)
-        seed = reinforceflow.get_random_seed()
+        # Constructor arguments, used to create clones.
+        self._init_kwargs = {'action_repeat': action_repeat, 'obs_stack': obs_stack}
+        if seed is None:
+            seed = reinforceflow.get_random_seed()
         if seed and hasattr(self.env, 'seed'):
             self.env.seed(seed)
 
+    @classmethod
+    def _clone_seed(cls):
+        seed = reinforceflow.get_random_seed()
+        return None if seed is None else seed + next(cls._clone_counter)
+
+    def copy(self, clone_state=False):
+        """Creates a new instance of the environment with the same wrapper settings.
+
+        Instead of deep copying, the environment is recreated from its Gym id and
+        seeded independently. Environments without Gym id are deep copied.
+
+        Args:
+            clone_state: (bool) If enabled, Atari emulator state, observation stack and
+                         episode time limit counter are copied to the new environment
+                         (via ALE `cloneState`).
+                         Otherwise, the new environment has to be reset before use.
+        """
+        env_id = getattr(getattr(self.env, 'spec', None), 'id', None)
+        if env_id is None:
+            return super(GymWrapper, self).copy(clone_state)
+        clone = self.__class__(gym.make(env_id), seed=self._clone_seed(), **self._init_kwargs)
+        if clone_state:
+            ale = getattr(getattr(self.env, 'unwrapped', self.env), 'ale', None)
+            if ale is None:
+                raise ValueError("Only Atari environments support state cloning.")
+            clone_ale = getattr(clone.env, 'unwrapped', clone.env).ale
+            clone_ale.restoreState(ale.cloneState())
+            clone._obs_stack = copy.deepcopy(self._obs_stack)
+            # Episode time limit counters of the Gym `TimeLimit` wrapper and of the ALE fast path.
+            for src, dst in [(self.env, clone.env), (self, clone)]:
+                if hasattr(src, '_elapsed_steps'):
+                    dst._elapsed_steps = src._elapsed_steps
+        return clone
+
     def _step(self, action):
         gym_action = self._rf_to_gym(action, self.env.action_space)
         obs, reward, done, info = self.env.step(gym_action)
@@ -78,60 +125,211 @@ class GymPixelWrapper(GymWrapper):
                  to_gray=False,
                  resize_width=None,
                  resize_height=None,
-                 merge_last_frames=False):
+                 merge_last_frames=False,
+                 uint8_obs=False,
+                 seed=None):
+        """Wrapper for the environments with pixel screen observations.
+        See `GymWrapper`.
+
+        Args:
+            to_gray: (bool) Converts observations to grayscale.
+            resize_width: (int) Resize width. To disable resize, pass None.
+            resize_height: (int) Resize height. To disable resize, pass None.
+            merge_last_frames: (bool) Takes maximum over the two last raw frames of the step
+                               (or of the current and previous steps without action repeat)
+                               before preprocessing, to remove Atari sprites flickering.
+            uint8_obs: (bool) Produces `uint8` observations in 0-255 range with
+                       `utils.ImagePreprocessor`, instead of float observations in 0-1 range.
+                       Network inputs should be scaled accordingly
+                       (e.g. `nets.DQNFactory(input_scale=1/255.)`).
+
+        For Atari environments with `to_gray` enabled, screen is read directly through
+        the ALE grayscale buffer API, bypassing Gym's RGB observations: ALE is stepped
+        with the same frame skipping and episode time limit, as the Gym environment,
+        and the screen is fetched only on the last two frames of each step.
+        """
         self.height = resize_height
         self.width = resize_width
         self.to_gray = to_gray
         self._use_merged_frame = merge_last_frames
+        self._preprocessor = None
+        self._preprocess_buffer = None
+        if isinstance(env, six.string_types):
+            env = gym.make(env)
+        atari = getattr(env, 'unwrapped', env)
+        self._ale = getattr(atari, 'ale', None) if to_gray else None
+        self._atari = atari
+        self._screens = None
+        self._elapsed_steps = 0
+        self._time_limit = self._find_time_limit(env)
+        # Two last raw frames and the merge output, indexes of the frames they hold.
+        self._raw_frames = None
+        self._raw_frame_ids = [-1, -1]
+        self._raw_slot = 0
+        self._frame_id = 0
+        if uint8_obs:
+            self._preprocessor = ImagePreprocessor(resize_width=resize_width,
+                                                   resize_height=resize_height,
+                                                   to_gray=to_gray)
         super(GymPixelWrapper, self).__init__(env,
                                               action_repeat=action_repeat,
-                                              obs_stack=obs_stack)
+                                              obs_stack=obs_stack,
+                                              seed=seed)
+        self._init_kwargs.update(to_gray=to_gray, resize_width=resize_width,
+                                 resize_height=resize_height,
+                                 merge_last_frames=merge_last_frames, uint8_obs=uint8_obs)
         if len(self.obs_shape) not in [2, 3]:
             raise ValueError('%s expects observation space with pixel inputs.'
                              % self.__class__.__name__)
-        self.has_lives = hasattr(self.env, 'ale') and hasattr(self.env.ale, 'lives')
-        self._prev_obs = None
+        self.has_lives = hasattr(atari, 'ale') and hasattr(atari.ale, 'lives')
 
     def step(self, action):
         """See `EnvWrapper.step`."""
-        start_lives = self.env.ale.lives() if self.has_lives else 0
+        if self._ale is not None:
+            return self._ale_step(action)
+        start_lives = self._atari.ale.lives() if self.has_lives else 0
         reward_total = 0
         done = False
         needs_stack_reset = False
-        for _ in range(self._action_repeat):
+        for i in range(self._action_repeat):
             obs, reward, done, info = self._step(action)
+            self._frame_id += 1
             reward_total += reward
-            if done or self.has_lives and self.env.ale.lives() < start_lives:
+            if done or self.has_lives and self._atari.ale.lives() < start_lives:
                 needs_stack_reset = True
+            if self._use_merged_frame and (needs_stack_reset or i >= self._action_repeat - 2):
+                self._store_raw_frame(obs)
+            if needs_stack_reset:
                 break
+        if self._use_merged_frame:
+            obs = self._merged_raw_frame()
         obs = self._obs_preprocess(obs)
+        return self._stack(obs, needs_stack_reset), reward_total, done, info
+
+    def _stack(self, obs, needs_stack_reset):
         # Observation stacking
-        if self._obs_stack_len > 1:
-            obs = stack_observations(obs, self._obs_stack_len, self._obs_stack)
+        if self._obs_stack is not None:
+            obs = self._obs_stack.push(obs)
             # Reset observations stack whenever last step is terminal
             if needs_stack_reset:
-                self._obs_stack = None
-                self._prev_obs = None
-        return obs, reward_total, done, info
+                self._obs_stack.clear()
+        return obs
+
+    def _store_raw_frame(self, obs):
+        obs = np.asarray(obs)
+        if self._raw_frames is None or self._raw_frames.shape[1:] != obs.shape \
+                or self._raw_frames.dtype != obs.dtype:
+            self._raw_frames = np.empty((3,) + obs.shape, dtype=obs.dtype)
+            self._raw_frame_ids = [-1, -1]
+        self._raw_slot ^= 1
+        self._raw_frames[self._raw_slot] = obs
+        self._raw_frame_ids[self._raw_slot] = self._frame_id
+
+    def _merged_raw_frame(self):
+        """Returns maximum over the two last frames, if both of them are stored.
+        Used to get around Atari sprites flickering (see Mnih et al. (2015))."""
+        slot = self._raw_slot
+        current = self._raw_frames[slot]
+        if self._raw_frame_ids[slot ^ 1] != self._frame_id - 1:
+            return current
+        return np.maximum(current, self._raw_frames[slot ^ 1], out=self._raw_frames[2])
+
+    def _fetch_screen(self, slot):
+        self._ale.getScreenGrayscale(self._screens[slot])
+
+    def _frameskip(self):
+        frameskip = getattr(self._atari, 'frameskip', 1)
+        if isinstance(frameskip, int):
+            return frameskip
+        return self._atari.np_random.randint(frameskip[0], frameskip[1])
+
+    @staticmethod
+    def _find_time_limit(env):
+        """Returns episode step limit of the Gym `TimeLimit` wrapper, or None.
+
+        Gym wrappers don't forward private attributes, so the limit is looked up
+        on each of the nested wrappers.
+        """
+        while env is not None:
+            limit = getattr(env, '_max_episode_steps', None)
+            if limit is not None:
+                return limit
+            inner = getattr(env, 'env', None)
+            env = inner if inner is not env else None
+        return None
+
+    def _ale_step(self, action):
+        """Steps ALE directly, fetching grayscale screen only on the last two frames."""
+        ale = self._ale
+        ale_action = self._atari._action_set[self._rf_to_gym(action, self.env.action_space)]
+        start_lives = ale.lives()
+        max_steps = self._time_limit
+        num_frames = 0
+        for _ in range(self._action_repeat):
+            num_frames += self._frameskip()
+        reward_total = 0
+        done = False
+        needs_stack_reset = False
+        fetched = 0
+        for frame in range(num_frames):
+            reward_total += ale.act(ale_action)
+            done = ale.game_over()
+            needs_stack_reset = done or ale.lives() < start_lives
+            if frame >= num_frames - 2 or needs_stack_reset:
+                self._fetch_screen(frame % 2)
+                fetched += 1
+            if needs_stack_reset:
+                break
+        self._elapsed_steps += self._action_repeat
+        if max_steps is not None and self._elapsed_steps >= max_steps:
+            done = needs_stack_reset = True
+        screen = self._screens[frame % 2]
+        if self._use_merged_frame and fetched > 1:
+            screen = np.maximum(screen, self._screens[(frame + 1) % 2],
+                                out=self._screens[2])
+        obs = self._process_frame(screen)
+        info = {'ale.lives': ale.lives()}
+        return self._stack(obs, needs_stack_reset), reward_total, done, info
 
     def _reset(self):
+        if self._ale is not None:
+            self.env.reset()
+            self._elapsed_steps = 0
+            height, width = self._ale.getScreenDims()[::-1]
+            if self._screens is None:
+                self._screens = np.zeros((3, height, width), dtype=np.uint8)
+            self._fetch_screen(0)
+            return self._process_frame(self._screens[0])
+        # Frames of the previous episode are never merged with the new ones.
+        self._frame_id += 1
         return self._gym_to_rf(self._obs_preprocess(self.env.reset()),
                                self.env.observation_space)
 
     def _obs_preprocess(self, obs):
         """Applies such image preprocessing as resizing and converting to grayscale.
-        Also, takes maximum value for each pixel value over the current and previous frame.
-        Used to get around Atari sprites flickering (see Mnih et al. (2015)).
 
         Args:
             obs: (nd.array) 2-D or 3-D observation.
         Returns:
             (nd.array) Preprocessed 3-D observation.
         """
-        obs = image_preprocess(obs, resize_height=self.height,
-                               resize_width=self.width, to_gray=self.to_gray)
-        if self._use_merged_frame and self._prev_obs is not None:
-            prev_obs = self._prev_obs
-            self._prev_obs = obs
-            obs = np.maximum.reduce([obs, prev_obs]) if prev_obs else obs
-        return obs
+        return self._process_frame(obs, to_gray=self.to_gray)
+
+    def _process_frame(self, obs, to_gray=False):
+        """Resizes frame and, if requested, converts it to grayscale."""
+        if self._preprocessor is not None:
+            return self._preprocess_uint8(obs)
+        if not to_gray and np.ndim(obs) == 2:
+            # Grayscale ALE screen: keep the same 0-1 range, as `rgb2gray` produces.
+            obs = obs / 255.
+        return image_preprocess(obs, resize_height=self.height,
+                                resize_width=self.width, to_gray=to_gray)
+
+    def _preprocess_uint8(self, obs):
+        # Frame stack copies pushed frames, so the same buffer can be reused for every frame.
+        if self._obs_stack is None:
+            return self._preprocessor(obs)
+        shape = self._preprocessor.output_shape(np.shape(obs))
+        if self._preprocess_buffer is None or self._preprocess_buffer.shape != shape:
+            self._preprocess_buffer = np.empty(shape, dtype=np.uint8)
+        return self._preprocessor(obs, out=self._preprocess_buffer)
@@ -0,0 +1,154 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import ctypes
+import multiprocessing as mp
+
+import numpy as np
+from six.moves import range  # pylint: disable=redefined-builtin
+
+import reinforceflow
+
+
+def _shared_view(buffer, shape, dtype):
+    return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def _env_worker(env, env_id, conn, buffer, shape, dtype):
+    """Worker loop: executes commands, writes observations into the shared array."""
+    seed = reinforceflow.get_random_seed()
+    np.random.seed(None if seed is None else seed + env_id + 1)
+    obs_buffer = _shared_view(buffer, shape, dtype)[env_id]
+    try:
+        while True:
+            cmd, data = conn.recv()
+            if cmd == 'step':
+                obs, reward, done, info = env.step(data)
+                if done:
+                    info = dict(info or {})
+                    info['terminal_obs'] = obs
+                    obs = env.reset()
+                obs_buffer[...] = obs
+                conn.send((reward, done, info))
+            elif cmd == 'reset':
+                obs_buffer[...] = env.reset()
+                conn.send(None)
+            elif cmd == 'action_sample':
+                conn.send(env.action_sample())
+            elif cmd == 'close':
+                break
+            else:
+                raise ValueError("Unknown command: %s." % cmd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+
+class VecEnvWrapper(object):
+    def __init__(self, envs):
+        """Steps several environments in parallel worker processes.
+
+        Observations of all environments are written by the workers into a preallocated
+        shared memory array of (num_envs,) + `obs_shape` shape, so only actions, rewards
+        and terminal flags go through the pipes. Terminal environments are reset
+        automatically: `step` returns the first observation of the new episode, while the
+        last observation of the finished one is passed in `info['terminal_obs']`.
+
+        Args:
+            envs: (list) `EnvWrapper` instances. Each one is moved to its own process.
+        """
+        if len(envs) < 1:
+            raise ValueError("Amount of environments must be higher or equal to 1.")
+        env = envs[0]
+        self.num_envs = len(envs)
+        self.is_cont_action = env.is_cont_action
+        self.is_cont_obs = env.is_cont_obs
+        self.is_multiaction = env.is_multiaction
+        self.action_shape = env.action_shape
+        obs = np.asarray(env.reset())
+        self.obs_shape = list(obs.shape)
+        shape = (self.num_envs,) + obs.shape
+        buffer = mp.RawArray(ctypes.c_byte, int(np.prod(shape)) * obs.dtype.itemsize)
+        self._obs = _shared_view(buffer, shape, obs.dtype)
+        self._conns = []
+        self._workers = []
+        for env_id, env in enumerate(envs):
+            parent_conn, child_conn = mp.Pipe()
+            worker = mp.Process(target=_env_worker,
+                                args=(env, env_id, child_conn, buffer, shape, obs.dtype))
+            worker.daemon = True
+            worker.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._workers.append(worker)
+        self._closed = False
+
+    def reset(self, env_ids=None):
+        """Resets environments.
+
+        Args:
+            env_ids: (list) Indexes of the environments to reset. If None, resets all of them.
+
+        Returns: (nd.array)
+            Observations of all environments, of (num_envs,) + `obs_shape` shape.
+            Reset environments hold the first observations of the new episodes.
+        """
+        conns = self._conns if env_ids is None else [self._conns[i] for i in env_ids]
+        for conn in conns:
+            conn.send(('reset', None))
+        for conn in conns:
+            conn.recv()
+        return self._obs.copy()
+
+    def step(self, actions):
+        """Executes step in every environment with the corresponding action.
+
+        Args:
+            actions: Sequence of `num_envs` actions.
+        Returns:
+            Tuple of (next_observations, rewards, terminals, infos).
+            Observations are copied out of the shared array, so they remain valid
+            after the next step.
+        """
+        if len(actions) != self.num_envs:
+            raise ValueError("Expected %d actions (Got: %d)." % (self.num_envs, len(actions)))
+        for conn, action in zip(self._conns, actions):
+            conn.send(('step', action))
+        results = [conn.recv() for conn in self._conns]
+        rewards, terms, infos = zip(*results)
+        return (self._obs.copy(), np.array(rewards, dtype=np.float32),
+                np.array(terms, dtype=np.bool_), list(infos))
+
+    def action_sample(self):
+        """Samples random action for each environment."""
+        for conn in self._conns:
+            conn.send(('action_sample', None))
+        return [conn.recv() for conn in self._conns]
+
+    def close(self):
+        """Stops worker processes."""
+        if self._closed:
+            return
+        for conn in self._conns:
+            try:
+                conn.send(('close', None))
+            except (IOError, OSError):
+                pass
+        for worker in self._workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+        for conn in self._conns:
+            conn.close()
+        self._closed = True
+
+    def __len__(self):
+        return self.num_envs
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
@@ -58,24 +58,30 @@ class DQNFactory(AbstractFactory):
     """Factory for DQN Model.
     See `DQNModel`.
     """
+    def __init__(self, input_scale=1.0):
+        self.input_scale = input_scale
+
     def make(self, input_shape, output_size, trainable=True):
-        return DQNModel(input_shape, output_size, trainable)
+        return DQNModel(input_shape, output_size, trainable, input_scale=self.input_scale)
 
 
 class DuelingDQNFactory(AbstractFactory):
     """Factory for Dueling DQN Model.
     See `DuelingDQNModel`.
     """
-    def __init__(self, dueling_type='mean', advantage_layers=(512,), value_layers=(512,)):
+    def __init__(self, dueling_type='mean', advantage_layers=(512,), value_layers=(512,),
+                 input_scale=1.0):
         self.dueling_type = dueling_type
         self.advantage_layers = advantage_layers
         self.value_layers = value_layers
+        self.input_scale = input_scale
 
     def make(self, input_shape, output_size, trainable=True):
         return DuelingDQNModel(input_shape, output_size, dueling_type=self.dueling_type,
                                advantage_layers=self.advantage_layers,
                                value_layers=self.value_layers,
-                               trainable=trainable)
+                               trainable=trainable,
+                               input_scale=self.input_scale)
 
 
 class MLPFactory(AbstractFactory):
@@ -118,8 +124,11 @@ class A3CMLPFactory(AbstractFactory):
 
 
 class A3CFFFactory(AbstractFactory):
+    def __init__(self, input_scale=1.0):
+        self.input_scale = input_scale
+
     def make(self, input_shape, output_size, trainable=True):
-        return A3CFFModel(input_shape, output_size, trainable)
+        return A3CFFModel(input_shape, output_size, trainable, input_scale=self.input_scale)
 
 
 class MLPModel(AbstractModel):
@@ -177,9 +186,9 @@ class DQNModel(AbstractModel):
     """Deep Q-Network model.
     See "Human-level control through deep reinforcement learning", Mnih et al., 2015.
     """
-    def __init__(self, input_shape, output_size, trainable=True):
+    def __init__(self, input_shape, output_size, trainable=True, input_scale=1.0):
         super(DQNModel, self).__init__(input_shape, output_size)
-        net, end_points = _make_dqn_body(self.input_ph, trainable)
+        net, end_points = _make_dqn_body(self.input_ph, trainable, input_scale)
         net = layers.fully_connected(net, num_outputs=512, activation_fn=tf.nn.relu,
                                      scope='fc1', trainable=trainable)
         end_points['fc1'] = net
@@ -197,9 +206,10 @@ class A3CFFModel(AbstractModel):
     """Asynchronous Advantage Actor-Critic Feed-Forward model.
     See "Human-level control through deep reinforcement learning", Mnih et al., 2015.
     """
-    def __init__(self, input_shape, output_size, trainable=True, policy_activation=tf.nn.softmax):
+    def __init__(self, input_shape, output_size, trainable=True, policy_activation=tf.nn.softmax,
+                 input_scale=1.0):
         super(A3CFFModel, self).__init__(input_shape, output_size)
-        net, end_points = _make_dqn_body(self.input_ph, trainable)
+        net, end_points = _make_dqn_body(self.input_ph, trainable, input_scale)
         end_points['fc1'] = layers.fully_connected(net, num_outputs=512, activation_fn=tf.nn.relu,
                                                    scope='fc1', trainable=trainable)
         end_points['out_value'] = layers.fully_connected(end_points['fc1'], num_outputs=1,
@@ -258,9 +268,9 @@ class DuelingDQNModel(AbstractModel):
     See "Dueling Network Architectures for Deep Reinforcement Learning", Schaul et al., 2016.
     """
     def __init__(self, input_shape, output_size, dueling_type='mean',
-                 advantage_layers=(512,), value_layers=(512,), trainable=True):
+                 advantage_layers=(512,), value_layers=(512,), trainable=True, input_scale=1.0):
         super(DuelingDQNModel, self).__init__(input_shape, output_size)
-        net, end_points = _make_dqn_body(self.input_ph, trainable)
+        net, end_points = _make_dqn_body(self.input_ph, trainable, input_scale)
         out, dueling_endpoints = _make_dueling(input_layer=net,
                                                output_size=output_size,
                                                dueling_type=dueling_type,
@@ -276,8 +286,11 @@ class DuelingDQNModel(AbstractModel):
         return self._output
 
 
-def _make_dqn_body(input_layer, trainable=True):
+def _make_dqn_body(input_layer, trainable=True, input_scale=1.0):
     end_points = {}
+    if input_scale != 1.0:
+        # E.g., 1/255 for `uint8` pixel observations.
+        input_layer = input_layer * input_scale
     net = layers.conv2d(inputs=input_layer,
                         num_outputs=32,
                         kernel_size=[8, 8],
@@ -2,7 +2,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import threading
+import multiprocessing as mp
+
 import numpy as np
+from six.moves import range  # pylint: disable=redefined-builtin
 from skimage.color import rgb2gray
 from skimage.transform import resize
 
@@ -35,6 +39,76 @@ def stack_observations(obs, stack_len, obs_stack=None):
     return obs_stack
 
 
+class FrameStack(object):
+    def __init__(self, stack_len):
+        """Stacks consecutive observations along the last axis, as `stack_observations` does.
+
+        Frames are written into a preallocated circular buffer of doubled length:
+        every frame is stored twice, so the latest `stack_len` frames always form
+        a contiguous window, available without copying (see `frames`).
+
+        Args:
+            stack_len: (int) Stack's total length.
+        """
+        if stack_len < 1:
+            raise ValueError("Stack length must be higher or equal to 1.")
+        self._stack_len = stack_len
+        self._buffer = None
+        self._pos = 0
+        self._needs_reset = True
+
+    def reset(self, obs):
+        """Fills the whole stack with the given observation.
+
+        Returns:
+            (nd.array) Stack of observations.
+        """
+        obs = np.asarray(obs)
+        if obs.ndim == 0:
+            raise ValueError("Observation must have at least one dimension.")
+        if self._buffer is None or self._buffer.shape[1:] != obs.shape \
+                or self._buffer.dtype != obs.dtype:
+            self._buffer = np.empty((2 * self._stack_len,) + obs.shape, dtype=obs.dtype)
+        self._buffer[:] = obs
+        self._pos = 0
+        self._needs_reset = False
+        return self.stacked()
+
+    def clear(self):
+        """Marks the stack for refilling: the next `push` behaves as `reset`."""
+        self._needs_reset = True
+
+    def push(self, obs):
+        """Appends observation to the stack, dropping the oldest one.
+
+        Returns:
+            (nd.array) Stack of observations.
+        """
+        if self._needs_reset:
+            return self.reset(obs)
+        self._pos = (self._pos + 1) % self._stack_len
+        self._buffer[self._pos] = obs
+        self._buffer[self._pos + self._stack_len] = obs
+        return self.stacked()
+
+    def frames(self):
+        """Returns zero-copy view of the stacked frames from the oldest to the latest,
+        with shape (stack_len,) + observation shape. The view is overwritten by the next
+        `push` or `reset`.
+        """
+        start = self._pos + 1
+        return self._buffer[start:start + self._stack_len]
+
+    def stacked(self):
+        """Returns a new array with frames concatenated along the last axis."""
+        frames = self.frames()
+        # (stack, ..., channels) -> (..., stack, channels) -> (..., stack * channels).
+        stacked = np.moveaxis(frames, 0, -2).reshape(frames.shape[1:-1] + (-1,))
+        if np.may_share_memory(stacked, self._buffer):
+            stacked = stacked.copy()
+        return stacked
+
+
 def image_preprocess(obs, resize_width, resize_height, to_gray):
     """Applies basic preprocessing for image observations.
 
@@ -57,6 +131,114 @@ def image_preprocess(obs, resize_width, resize_height, to_gray):
     return processed_obs
 
 
+def _resize_weights(in_size, out_size, interpolation):
+    """Returns (out_size, in_size) matrix, which maps input pixels to the resized ones."""
+    weights = np.zeros((out_size, in_size), dtype=np.float32)
+    scale = in_size / out_size
+    if interpolation == 'area':
+        for i in range(out_size):
+            start, end = i * scale, (i + 1) * scale
+            for j in range(int(np.floor(start)), min(int(np.ceil(end)), in_size)):
+                weights[i, j] = min(end, j + 1) - max(start, j)
+    elif interpolation == 'bilinear':
+        centers = np.clip((np.arange(out_size) + 0.5) * scale - 0.5, 0, in_size - 1)
+        left = np.floor(centers).astype(np.int64)
+        right = np.minimum(left + 1, in_size - 1)
+        frac = (centers - left).astype(np.float32)
+        rows = np.arange(out_size)
+        np.add.at(weights, (rows, left), 1 - frac)
+        np.add.at(weights, (rows, right), frac)
+    else:
+        raise ValueError("Unknown interpolation: %s." % interpolation)
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+class ImagePreprocessor(object):
+    # Fixed-point luminance weights of `skimage.color.rgb2gray`, summing up to 256.
+    GRAY_WEIGHTS = (54, 183, 19)
+
+    def __init__(self, resize_width=None, resize_height=None, to_gray=False,
+                 interpolation='area'):
+        """Fast image preprocessing, producing `uint8` observations.
+
+        Does the same job as `image_preprocess`, but keeps pixels in 0-255 range:
+        grayscale conversion is done in integer arithmetic, and resize is done
+        by two matrix products with interpolation weights, precomputed
+        for each input shape. Output is always 3-D.
+
+        Args:
+            resize_width: (int) Resize width. To disable resize, pass None.
+            resize_height: (int) Resize height. To disable resize, pass None.
+            to_gray: (bool) Converts image to grayscale.
+            interpolation: (str) Resize interpolation: 'area' or 'bilinear'.
+        """
+        if interpolation not in ('area', 'bilinear'):
+            raise ValueError("Unknown interpolation: %s." % interpolation)
+        self.width = resize_width
+        self.height = resize_height
+        self.to_gray = to_gray
+        self.interpolation = interpolation
+        self._weights = {}
+
+    def _resize_matrices(self, height, width):
+        key = (height, width)
+        if key not in self._weights:
+            self._weights[key] = (_resize_weights(height, self.height, self.interpolation),
+                                  _resize_weights(width, self.width, self.interpolation))
+        return self._weights[key]
+
+    def _gray(self, obs):
+        weights = self.GRAY_WEIGHTS
+        gray = np.multiply(obs[..., 0], weights[0], dtype=np.uint16)
+        gray += np.multiply(obs[..., 1], weights[1], dtype=np.uint16)
+        gray += np.multiply(obs[..., 2], weights[2], dtype=np.uint16)
+        gray += 128
+        gray >>= 8
+        return gray[..., np.newaxis]
+
+    def output_shape(self, input_shape):
+        """Returns shape of the preprocessed observation for the given input shape."""
+        height, width = input_shape[:2]
+        channels = input_shape[2] if len(input_shape) > 2 else 1
+        if self.to_gray and channels == 3:
+            channels = 1
+        if self.height and self.width:
+            height, width = self.height, self.width
+        return height, width, channels
+
+    def __call__(self, obs, out=None):
+        """Preprocesses observation.
+
+        Args:
+            obs: (nd.array) 2-D or 3-D `uint8` image.
+            out: (nd.array) Optional `uint8` buffer of `output_shape` to write result into.
+
+        Returns:
+            (nd.array) Preprocessed 3-D `uint8` observation.
+        """
+        obs = np.asarray(obs)
+        if obs.ndim == 2:
+            obs = obs[..., np.newaxis]
+        if self.to_gray and obs.shape[2] == 3:
+            obs = self._gray(obs)
+        if out is None:
+            out = np.empty(self.output_shape(obs.shape), dtype=np.uint8)
+        if not (self.height and self.width):
+            out[...] = obs
+            return out
+        height, width, channels = obs.shape
+        rows, cols = self._resize_matrices(height, width)
+        resized = rows.dot(obs.reshape(height, -1).astype(np.float32))
+        resized = resized.reshape(self.height, width, channels)
+        if channels == 1:
+            resized = resized[..., 0].dot(cols.T)[..., np.newaxis]
+        else:
+            resized = np.einsum('ijc,kj->ikc', resized, cols)
+        resized += 0.5
+        np.copyto(out, np.minimum(resized, 255), casting='unsafe')
+        return out
+
+
 def discount_rewards(rewards, gamma, expected_reward=0.0):
     """Applies reward discounting.
 
@@ -95,10 +277,13 @@ def one_hot(shape, idx):
 
 
 class IncrementalAverage(object):
-    """Incremental average counter."""
+    """Incremental average counter.
+    Keeps running variance of the values with Welford's algorithm."""
     def __init__(self):
         self._total = 0.0
         self._counter = 0
+        self._mean = 0.0
+        self._m2 = 0.0
         self._min = float('+inf')
         self._max = float('-inf')
 
@@ -107,21 +292,57 @@ class IncrementalAverage(object):
         self._total += value
         if value < self._min:
             self._min = value
-        if value < self._max:
+        if value > self._max:
             self._max = value
         self._counter += 1
+        delta = value - self._mean
+        self._mean += delta / self._counter
+        self._m2 += delta * (value - self._mean)
 
     def add_batch(self, batch):
         """Adds batch of values to the counter."""
+        if len(batch) == 0:
+            return
+        batch_len = len(batch)
+        batch_mean = np.mean(batch)
+        counter = self._counter + batch_len
+        delta = batch_mean - self._mean
+        self._m2 += np.sum(np.square(np.asarray(batch) - batch_mean)) \
+            + delta ** 2 * self._counter * batch_len / counter
+        self._mean += delta * batch_len / counter
         self._total += np.sum(batch)
-        self._counter += len(batch)
+        self._counter = counter
         value_min = np.min(batch)
         if value_min < self._min:
             self._min = value_min
         value_max = np.max(batch)
-        if value_max < self._max:
+        if value_max > self._max:
             self._max = value_max
 
+    @property
+    def variance(self):
+        """Unbiased sample variance of the values."""
+        if self._counter < 2:
+            return 0.0
+        return self._m2 / (self._counter - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def confidence_interval(self, z=1.96):
+        """Computes half-width of the confidence interval on the mean,
+        using normal approximation (by default, 95% confidence).
+
+        Args:
+            z: (float) Standard score of the confidence level.
+
+        Returns: (float) Half-width. Infinite, if less than two values were added.
+        """
+        if self._counter < 2:
+            return float('+inf')
+        return z * self.std / np.sqrt(self._counter)
+
     @property
     def max(self):
         return self._max
@@ -145,6 +366,50 @@ class IncrementalAverage(object):
         average = self.compute_average()
         self._total = 0.0
         self._counter = 0
+        self._mean = 0.0
+        self._m2 = 0.0
         self._min = float('+inf')
         self._max = float('-inf')
         return average
+
+
+class Counter(object):
+    def __init__(self, value=0, shared=False):
+        """Atomic integer counter, kept on the host side.
+
+        Args:
+            value: (int) Initial value.
+            shared: (bool) If enabled, the value is kept in shared memory
+                    (see `multiprocessing.Value`), so it can be incremented
+                    by forked worker processes. Otherwise, it is shared between threads only.
+        """
+        if shared:
+            self._value = mp.Value('q', value)
+            self._lock = self._value.get_lock()
+        else:
+            self._value = None
+            self._int = value
+            self._lock = threading.Lock()
+
+    def increment(self, n=1):
+        """Increments the counter by `n`. Returns: (int) Updated value."""
+        with self._lock:
+            if self._value is not None:
+                self._value.value += n
+                return self._value.value
+            self._int += n
+            return self._int
+
+    @property
+    def value(self):
+        if self._value is not None:
+            return self._value.value
+        return self._int
+
+    @value.setter
+    def value(self, value):
+        with self._lock:
+            if self._value is not None:
+                self._value.value = value
+            else:
+                self._int = value
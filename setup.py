@@ -11,7 +11,8 @@ install_requires = [
     'scikit-image',
     'six',
     'matplotlib',
-    'seaborn'
+    'seaborn',
+    'futures; python_version < "3"'
 ]
 
 extras_require = {
@@ -0,0 +1,81 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+
+import numpy as np
+import numpy.testing as npt
+from reinforceflow.core import ParallelEvaluator, AsyncEvaluator
+
+
+class TargetEnv(object):
+    """Observation is the one-hot encoded rewarded action, episodes last `length` steps."""
+    is_cont_action = False
+    is_cont_obs = True
+    is_multiaction = False
+    action_shape = [3]
+    obs_shape = [3]
+
+    def __init__(self, length=4):
+        self._length = length
+        self._t = 0
+        self._target = 0
+
+    def reset(self):
+        self._t = 0
+        self._target = np.random.randint(3)
+        return np.eye(3, dtype=np.float32)[self._target]
+
+    def step(self, action):
+        self._t += 1
+        reward = float(np.argmax(action) == self._target)
+        obs = np.eye(3, dtype=np.float32)[self._target]
+        return obs, reward, self._length is not None and self._t >= self._length, {}
+
+    def action_sample(self):
+        return np.eye(3)[np.random.randint(3)]
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+
+def test_parallel_evaluation():
+    with ParallelEvaluator(TargetEnv(length=4), num_envs=3) as evaluator:
+        rewards, lengths, wall_time = evaluator.evaluate(lambda obs: obs, episodes=7)
+        assert rewards.length == 7
+        npt.assert_allclose(rewards.compute_average(), 4)
+        assert lengths == [4] * 7
+        assert wall_time > 0
+        # Workers are reused by the following evaluations.
+        rewards, lengths, _ = evaluator.evaluate(lambda obs: -obs, episodes=2)
+        npt.assert_allclose(rewards.compute_average(), 0)
+        assert lengths == [4, 4]
+
+
+def test_parallel_evaluation_max_steps():
+    with ParallelEvaluator(TargetEnv(length=None), num_envs=2) as evaluator:
+        rewards, lengths, _ = evaluator.evaluate(lambda obs: obs, episodes=3, max_ep_steps=5)
+        assert lengths == [5, 5, 5]
+        npt.assert_allclose(rewards.compute_average(), 5)
+
+
+def test_async_evaluation():
+    model = {'sign': 0}
+    results = []
+
+    def load(weights):
+        model['sign'] = weights
+
+    def predict(obs):
+        return model['sign'] * obs
+
+    evaluator = AsyncEvaluator(TargetEnv(length=3), predict, load,
+                               callback=lambda *args: results.append(args),
+                               episodes=4, num_envs=2)
+    evaluator.submit(10, 1)
+    evaluator.close(wait=True)
+    step, rewards, lengths, _ = results[-1]
+    assert step == 10
+    npt.assert_allclose(rewards.compute_average(), 3)
+    assert lengths == [3] * 4
@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import numpy as np
+import numpy.testing as npt
+from reinforceflow.core import InferenceServer
+
+
+def test_inference_server_batches():
+    calls = []
+
+    def predict(obs_batch):
+        calls.append(len(obs_batch))
+        return obs_batch * 2
+
+    results = {}
+    with InferenceServer(predict, max_batch_size=8, max_wait=0.05) as server:
+        def actor(thread_id):
+            results[thread_id] = [server.predict(np.array([thread_id, i])).result()
+                                  for i in range(20)]
+        threads = [threading.Thread(target=actor, args=(t,)) for t in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        batch_sizes, latencies = server.histograms()
+    for thread_id, predictions in results.items():
+        npt.assert_array_equal(predictions, [[2 * thread_id, 2 * i] for i in range(20)])
+    assert max(calls) <= 8 and sum(calls) == 160
+    assert len(calls) < 160
+    assert batch_sizes.sum() == len(calls) and latencies.sum() == 160
+    assert np.dot(batch_sizes, np.arange(len(batch_sizes))) == 160
+
+
+def test_inference_server_exception():
+    def predict(obs_batch):
+        raise RuntimeError('failed')
+
+    with InferenceServer(predict, max_batch_size=4, max_wait=0.0) as server:
+        future = server.predict(np.zeros(2))
+        assert isinstance(future.exception(timeout=5), RuntimeError)
+
+
+def test_inference_server_closed():
+    server = InferenceServer(lambda obs_batch: obs_batch, max_batch_size=4)
+    # Requests, submitted before the start, are cancelled on close.
+    pending = server.predict(np.zeros(2))
+    server.close()
+    assert pending.cancelled()
+    npt.assert_raises(RuntimeError, server.predict, np.zeros(2))
+    with server.start():
+        npt.assert_array_equal(server.predict(np.ones(2)).result(timeout=5), np.ones(2))
+    npt.assert_raises(RuntimeError, server.predict, np.zeros(2))
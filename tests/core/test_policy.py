@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+from reinforceflow.core import GreedyPolicy, EGreedyPolicy, SoftmaxPolicy
+
+
+class DiscreteEnv(object):
+    action_shape = [3]
+
+    def action_sample(self):
+        return np.eye(3)[np.random.randint(3)]
+
+
+def test_egreedy_update():
+    policy = EGreedyPolicy(eps_start=1.0, eps_final=0.1, anneal_steps=100)
+    policy.update(50)
+    npt.assert_allclose(policy.epsilon, 0.55)
+    policy.update(1000)
+    npt.assert_allclose(policy.epsilon, 0.1)
+    action = policy.select_action(DiscreteEnv(), np.array([[0., 2., 1.]]), step=1e9)
+    assert action.shape == (3,)
+
+
+def test_policy_update_noop():
+    for policy in [GreedyPolicy(), SoftmaxPolicy()]:
+        policy.update(100)
+
+
+def test_softmax_sampling():
+    policy = SoftmaxPolicy()
+    actions = [np.argmax(policy.select_action(DiscreteEnv(), np.array([[0.2, 0., 0.8]])))
+               for _ in range(200)]
+    assert set(actions) == {0, 2}
+    assert actions.count(2) > actions.count(0)
+
+
+def _graph_api():
+    tf = pytest.importorskip('tensorflow')
+    if not hasattr(tf, 'Session'):
+        pytest.skip('TensorFlow graph API is not available.')
+    return tf
+
+
+def test_greedy_action_op():
+    tf = _graph_api()
+    values = np.random.uniform(size=(16, 5)).astype(np.float32)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        values_ph = tf.placeholder(tf.float32, [None, 5])
+        action_op = GreedyPolicy().build_action_op(values_ph, step=None)
+        npt.assert_array_equal(sess.run(action_op, {values_ph: values}), np.argmax(values, 1))
+
+
+def test_egreedy_action_op_schedule():
+    tf = _graph_api()
+    batch = np.tile(np.array([[0., 3., 1.]], dtype=np.float32), (4000, 1))
+    # Epsilon is annealed from 0 (greedy) to 1 (uniformly random).
+    policy = EGreedyPolicy(eps_start=0.0, eps_final=1.0, anneal_steps=100)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        values_ph = tf.placeholder(tf.float32, [None, 3])
+        step_ph = tf.placeholder(tf.int64, [])
+        action_op = policy.build_action_op(values_ph, step_ph)
+
+        def non_greedy_fraction(step):
+            actions = sess.run(action_op, {values_ph: batch, step_ph: step})
+            assert set(actions) <= {0, 1, 2}
+            return np.mean(actions != 1)
+
+        assert non_greedy_fraction(0) == 0
+        # Random action differs from the greedy one in 2 out of 3 cases.
+        npt.assert_allclose(non_greedy_fraction(50), 0.5 * 2 / 3, atol=0.05)
+        npt.assert_allclose(non_greedy_fraction(1000), 2 / 3, atol=0.05)
+
+
+def test_softmax_action_op():
+    tf = _graph_api()
+    probs = np.tile(np.array([[0.2, 0., 0.8]], dtype=np.float32), (500, 1))
+    with tf.Graph().as_default(), tf.Session() as sess:
+        probs_ph = tf.placeholder(tf.float32, [None, 3])
+        actions = sess.run(SoftmaxPolicy().build_action_op(probs_ph), {probs_ph: probs})
+    assert actions.shape == (500,) and np.issubdtype(actions.dtype, np.integer)
+    assert set(actions) == {0, 2}
+
+
+def test_agent_act():
+    tf = _graph_api()
+    from reinforceflow.core.base_agent import BaseAgent
+
+    class Net(object):
+        def __init__(self):
+            self.input_ph = tf.placeholder(tf.float32, [None, 3])
+            self.output = self.input_ph * 2
+
+    class Agent(BaseAgent):
+        def __init__(self, env):
+            super(Agent, self).__init__(env)
+            self.net = Net()
+            self.sess = tf.Session()
+
+    with tf.Graph().as_default():
+        agent = Agent(DiscreteEnv())
+        action_op = agent._build_action_op(GreedyPolicy(), step=None)
+        action, prediction = agent._act(np.array([0., 1., 0.5]), action_op)
+        agent.sess.close()
+    npt.assert_array_equal(action, [0, 1, 0])
+    npt.assert_allclose(prediction, [[0., 2., 1.]])
@@ -2,9 +2,17 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import os
+import shutil
+import tempfile
+import threading
 import numpy as np
 import numpy.testing as npt
-from reinforceflow.core import ExperienceReplay, ProportionalReplay
+import pytest
+from reinforceflow.core import ExperienceReplay, ProportionalReplay, FrameStackReplay
+from reinforceflow.core import RankBasedReplay, NStepReplay, ReplayPrefetcher
+from reinforceflow.core import MemmapReplay, MemmapProportionalReplay, ConcurrentReplay
+from reinforceflow.core import CompressedReplay, EpisodeReplay
 
 
 def test_replay_add():
@@ -50,6 +58,102 @@ def test_replay_sample_term():
             assert o+1 == o_next
 
 
+def test_replay_sample_arrays():
+    cap = 128
+    batch_size = 16
+    replay = ExperienceReplay(capacity=cap, min_size=cap, batch_size=batch_size)
+    for i in range(cap):
+        obs = np.full((4, 4, 2), i, dtype=np.uint8)
+        replay.add(obs=obs, action=np.eye(3)[i % 3], reward=i, obs_next=obs + 1, term=False)
+    obs, a, r, obs_next, terms, idxs, importance = replay.sample()
+    assert obs.shape == (batch_size, 4, 4, 2)
+    assert obs.dtype == np.uint8
+    assert obs.flags['C_CONTIGUOUS'] and obs_next.flags['C_CONTIGUOUS']
+    assert a.shape == (batch_size, 3)
+    assert r.dtype.kind == 'f'
+    npt.assert_equal(obs[:, 0, 0, 0], r)
+    npt.assert_equal(obs + 1, obs_next)
+
+
+def test_replay_sample_without_replacement():
+    cap = 10
+    replay = ExperienceReplay(capacity=cap, min_size=cap, batch_size=cap - 1)
+    for i in range(2*cap):
+        replay.add(obs=i, action=0, reward=i, obs_next=i + 1, term=False)
+    for _ in range(20):
+        rewards = replay.sample()[2]
+        # Valid transitions of the full buffer, besides the one with overwritten observation.
+        npt.assert_equal(np.sort(rewards), np.arange(cap + 1, 2*cap))
+
+
+def _stacked_episodes(num_episodes, stack_len, frame_shape=(2, 2, 1)):
+    """Yields stacked transitions, as produced by environment wrappers."""
+    frame_id = 0
+    for ep in range(num_episodes):
+        frame_id += 1
+        frames = [np.full(frame_shape, frame_id)] * stack_len
+        for step in range(3 + ep % 7):
+            frame_id += 1
+            frames_next = frames[1:] + [np.full(frame_shape, frame_id)]
+            term = step == 2 + ep % 7
+            yield np.concatenate(frames, -1), np.concatenate(frames_next, -1), term
+            frames = frames_next
+
+
+def test_frame_stack_replay_sample():
+    stack_len = 4
+    cap = 50
+    replay = FrameStackReplay(capacity=cap, min_size=cap, batch_size=32, obs_stack=stack_len)
+    expected = {}
+    for obs, obs_next, term in _stacked_episodes(40, stack_len):
+        expected[obs[0, 0, -1]] = (obs, obs_next, term)
+        replay.add(obs=obs, action=0, reward=0, obs_next=obs_next, term=term)
+    assert replay.size == cap
+    for _ in range(20):
+        obs, a, r, obs_next, terms, idxs, importance = replay.sample()
+        assert obs.shape == (32, 2, 2, stack_len)
+        for o, o_next, t in zip(obs, obs_next, terms):
+            exp_obs, exp_obs_next, exp_term = expected[o[0, 0, -1]]
+            assert t == exp_term
+            npt.assert_equal(o, exp_obs)
+            if not t:
+                npt.assert_equal(o_next, exp_obs_next)
+
+
+def test_nstep_replay_returns():
+    n_step = 3
+    gamma = 0.5
+    num_envs = 2
+    replay = NStepReplay(capacity=1000, min_size=1, batch_size=64, n_step=n_step, gamma=gamma)
+    expected = {}
+    episodes = [[] for _ in range(num_envs)]
+    for step in range(200):
+        for env_id in range(num_envs):
+            # Observation encodes environment and step, reward equals to the step.
+            obs = env_id * 1000 + step
+            term = step % 11 == 10
+            replay.add(obs=obs, action=0, reward=step, obs_next=obs + 1, term=term,
+                       env_id=env_id)
+            episodes[env_id].append(obs)
+            if term:
+                ep = episodes[env_id]
+                for t, o in enumerate(ep):
+                    rewards = [(x % 1000) for x in ep[t:t + n_step]]
+                    ret = sum(gamma ** k * r for k, r in enumerate(rewards))
+                    ep_term = t + n_step >= len(ep)
+                    expected[o] = (ret, o + n_step, ep_term, len(rewards))
+                episodes[env_id] = []
+    for _ in range(10):
+        obs, a, r, obs_next, terms, idxs, importance, exponents = replay.sample()
+        for o, ret, o_next, t, exp in zip(obs, r, obs_next, terms, exponents):
+            exp_ret, exp_next, exp_term, exp_exponent = expected[o]
+            npt.assert_almost_equal(ret, exp_ret)
+            assert t == exp_term
+            assert exp == exp_exponent
+            if not t:
+                assert o_next == exp_next
+
+
 def test_proportional_add():
     cap = 10000
     replay = ProportionalReplay(capacity=cap, min_size=500, batch_size=32, alpha=1.0)
@@ -111,3 +215,330 @@ def test_prop_replay_update():
             received_priors[o] += 1
     received_priors = np.asarray(received_priors) / (sample_amount*batch_size)
     npt.assert_almost_equal(expected_priors, received_priors, decimal=2)
+
+
+def test_prop_replay_importance():
+    priors = np.array([4.0, 1.0, 2.0, 8.0])
+    replay = ProportionalReplay(capacity=64, min_size=1, batch_size=64, alpha=1.0,
+                                beta=0.5, beta_final=1.0, beta_anneal_steps=2)
+    for o, p in enumerate(priors):
+        replay.add(obs=o, action=0, reward=0, obs_next=0, term=False, priority=p)
+    leaf_priors = priors + 0.00001
+    for beta in [0.5, 0.75, 1.0, 1.0]:
+        obs, a, r, obs_next, terms, idxs, importance = replay.sample()
+        assert importance.dtype == np.float32
+        expected = (leaf_priors[obs] / leaf_priors.min()) ** -beta
+        npt.assert_almost_equal(importance, expected, decimal=5)
+        assert np.all(importance <= 1.0)
+
+
+def test_rank_replay_distribution():
+    cap = 1000
+    batch_size = 32
+    alpha = 0.7
+    replay = RankBasedReplay(capacity=cap, min_size=cap, batch_size=batch_size, alpha=alpha,
+                             sort_freq=cap)
+    for i in range(cap):
+        replay.add(obs=i, action=0, reward=0, obs_next=i+1, term=False)
+    # Priority of the transition equals to its observation.
+    replay.update(np.arange(cap), np.arange(cap, dtype=np.float64))
+    heap_prio = replay._heap_prio[:cap]
+    assert np.all(heap_prio[1:-1] <= heap_prio[:-2])
+    counts = np.zeros(cap)
+    for _ in range(500):
+        obs, a, r, obs_next, terms, idxs, importance = replay.sample()
+        npt.assert_equal(obs + 1, obs_next)
+        assert np.all(importance <= 1.0)
+        counts[obs] += 1
+    ranks = np.arange(1, cap)
+    expected = (1.0 / ranks) ** alpha
+    expected /= expected.sum()
+    # Compare probability mass of the top 10% ranks. Uniform sampling inside of the
+    # stratified segments only approximates rank distribution within a single segment.
+    top = cap - 1 - np.arange(cap // 10)
+    received = counts[top].sum() / counts.sum()
+    assert abs(received - expected[:cap // 10].sum()) < 1.0 / batch_size
+
+
+def test_rank_replay_heap_updates():
+    cap = 256
+    replay = RankBasedReplay(capacity=cap, min_size=1, batch_size=16, sort_freq=10**6)
+    for i in range(3 * cap):
+        replay.add(obs=i, action=0, reward=0, obs_next=i+1, term=False)
+        if i % 4 == 0:
+            obs, a, r, obs_next, terms, idxs, importance = replay.sample()
+            replay.update(idxs, np.random.uniform(size=len(idxs)))
+    heap_prio = replay._heap_prio
+    for pos in range(1, cap):
+        assert heap_prio[pos] <= heap_prio[(pos - 1) // 2]
+    npt.assert_equal(replay._heap_pos[replay._heap_ids], np.arange(cap))
+    assert heap_prio[cap - 1] == float('-inf')
+
+
+def test_prefetcher_sample_update():
+    cap = 512
+    batch_size = 32
+    replay = ProportionalReplay(capacity=cap, min_size=cap, batch_size=batch_size)
+    prefetcher = ReplayPrefetcher(replay, queue_size=2)
+    try:
+        for i in range(cap):
+            prefetcher.add(obs=i, action=0, reward=0, obs_next=i+1, term=False, priority=1.0)
+        assert prefetcher.is_ready
+        for i in range(cap, cap + 20):
+            obs, a, r, obs_next, terms, idxs, importance = prefetcher.sample()
+            assert len(obs) == batch_size
+            npt.assert_equal(obs + 1, obs_next)
+            prefetcher.update(idxs, np.random.uniform(size=batch_size))
+            prefetcher.add(obs=i, action=0, reward=0, obs_next=i+1, term=False)
+    finally:
+        prefetcher.close()
+    # Priority of the oldest overwritten transition is excluded from the tree.
+    expected_sum = np.sum(replay._priorities) - replay._priorities[replay._idx]
+    npt.assert_almost_equal(replay.sumtree.sum(), expected_sum)
+
+
+def test_nstep_replay_save_pending():
+    path = tempfile.mkdtemp()
+    try:
+        snapshot = os.path.join(path, 'replay')
+        replay = NStepReplay(capacity=16, min_size=1, batch_size=4, n_step=3, gamma=0.5)
+        for o in range(4):
+            replay.add(obs=o, action=0, reward=1, obs_next=o + 1, term=False)
+        replay.save(snapshot)
+        restored = NStepReplay(capacity=16, min_size=1, batch_size=4, n_step=3, gamma=0.5)
+        restored.load(snapshot)
+        # Pending returns are completed after restore.
+        restored.add(obs=4, action=0, reward=1, obs_next=5, term=True)
+        npt.assert_array_equal(restored._ready[:5], True)
+        npt.assert_almost_equal(restored._rewards[:5], [1.75, 1.75, 1.75, 1.5, 1])
+    finally:
+        shutil.rmtree(path)
+
+
+def test_nstep_replay_overwritten_pending():
+    replay = NStepReplay(capacity=4, min_size=1, batch_size=4, n_step=3)
+    # Long-running environment 0 is overwritten by transitions of environment 1.
+    replay.add(obs=100, action=0, reward=100, obs_next=101, term=False, env_id=0)
+    for o in range(5):
+        replay.add(obs=o, action=0, reward=1, obs_next=o + 1, term=o == 4, env_id=1)
+    replay.add(obs=101, action=0, reward=100, obs_next=102, term=True, env_id=0)
+    # Return of the overwritten transition isn't written into the new one in its slot.
+    assert replay._obs[0] == 3 and replay._ready[0] and replay._terms[0]
+    npt.assert_almost_equal(replay._rewards[0], 1 + 0.99)
+
+
+def test_prefetcher_sample_error():
+    # Returns aren't completed until the 3rd step of the episode.
+    replay = NStepReplay(capacity=16, min_size=1, batch_size=1, n_step=3)
+    prefetcher = ReplayPrefetcher(replay, queue_size=2)
+    try:
+        prefetcher.add(obs=0, action=0, reward=1, obs_next=1, term=False)
+        npt.assert_raises(ValueError, prefetcher.sample)
+        for o in range(1, 4):
+            prefetcher.add(obs=o, action=0, reward=1, obs_next=o + 1, term=False)
+        # Background thread is restarted after the error.
+        obs = prefetcher.sample()[0]
+        npt.assert_array_equal(obs, [0])
+    finally:
+        prefetcher.close()
+
+
+def test_memmap_replay_reopen():
+    path = tempfile.mkdtemp()
+    try:
+        cap = 64
+        replay = MemmapReplay(capacity=cap, min_size=cap, batch_size=16, path=path)
+        for i in range(cap + 10):
+            replay.add(obs=np.full(3, i), action=i, reward=i, obs_next=np.full(3, i+1), term=False)
+        replay.flush()
+        del replay
+        replay = MemmapReplay(capacity=cap, min_size=cap, batch_size=16, path=path)
+        assert replay.size == cap
+        assert replay.is_ready
+        obs, a, r, obs_next, terms, idxs, importance = replay.sample()
+        npt.assert_equal(obs[:, 0], a)
+        npt.assert_equal(obs[:, 0] + 1, obs_next[:, 0])
+        replay.add(obs=np.full(3, -1), action=-1, reward=-1, obs_next=np.full(3, 0), term=True)
+        assert replay.size == cap
+    finally:
+        shutil.rmtree(path)
+
+
+def test_memmap_proportional_reopen():
+    path = tempfile.mkdtemp()
+    try:
+        priors = [20000.0, 30000.0, 1000.0, 49000.0, 0.0]
+        replay = MemmapProportionalReplay(capacity=16, min_size=1, batch_size=4,
+                                          path=path, alpha=1.0)
+        for o, p in enumerate(priors):
+            replay.add(obs=o, action=0, reward=0, obs_next=0, term=False, priority=p)
+        expected_sum = replay.sumtree.sum()
+        expected_min = replay.mintree.min()
+        replay.flush()
+        replay = MemmapProportionalReplay(capacity=16, min_size=1, batch_size=4,
+                                          path=path, alpha=1.0)
+        assert replay.size == len(priors)
+        npt.assert_almost_equal(replay.sumtree.sum(), expected_sum)
+        npt.assert_almost_equal(replay.mintree.min(), expected_min)
+        assert replay.sumtree.size == len(priors)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_replay_save_load():
+    path = tempfile.mkdtemp()
+    try:
+        snapshot = os.path.join(path, 'replay')
+        replay = ProportionalReplay(capacity=8, min_size=1, batch_size=4, alpha=1.0)
+        for o in range(11):
+            replay.add(obs=o, action=o, reward=o, obs_next=o + 1, term=False, priority=o + 1.0)
+        replay.save(snapshot)
+        restored = ProportionalReplay(capacity=8, min_size=1, batch_size=4, alpha=1.0)
+        restored.load(snapshot)
+        assert restored.size == replay.size
+        npt.assert_array_equal(restored._obs, replay._obs)
+        npt.assert_almost_equal(restored.sumtree.sum(), replay.sumtree.sum())
+        npt.assert_almost_equal(restored.mintree.min(), replay.mintree.min())
+        # Copy-on-write mapping: new transitions never modify the snapshot.
+        restored.add(obs=100, action=0, reward=0, obs_next=101, term=False)
+        reloaded = ProportionalReplay(capacity=8, min_size=1, batch_size=4, alpha=1.0)
+        reloaded.load(snapshot)
+        npt.assert_array_equal(reloaded._obs, replay._obs)
+        # Snapshot can be restored into the memory-mapped replay.
+        memmap = MemmapReplay(capacity=8, min_size=1, batch_size=4,
+                              path=os.path.join(path, 'memmap'))
+        memmap.load(snapshot)
+        npt.assert_array_equal(memmap._actions, replay._actions)
+        obs, _, _, obs_next, _, _, _ = memmap.sample()
+        npt.assert_array_equal(obs + 1, obs_next)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_concurrent_replay_threads():
+    replay = ConcurrentReplay(capacity=256, min_size=32, batch_size=32)
+    num_threads, num_adds = 4, 500
+
+    def actor(thread_id):
+        for i in range(num_adds):
+            o = thread_id * num_adds + i
+            replay.add(obs=[o, o], action=o, reward=o, obs_next=[o + 1, o + 1], term=False)
+
+    threads = [threading.Thread(target=actor, args=(t,)) for t in range(num_threads)]
+    for t in threads:
+        t.start()
+    while any(t.is_alive() for t in threads):
+        if replay.is_ready:
+            obs, action, reward, obs_next, _, idxs, _ = replay.sample()
+            npt.assert_array_equal(obs[:, 0], action)
+            npt.assert_array_equal(obs[:, 0], reward)
+            npt.assert_array_equal(obs + 1, obs_next)
+    for t in threads:
+        t.join()
+    assert replay.size == 256
+    assert replay._num_added == num_threads * num_adds
+    assert len(np.unique(replay._actions)) == 256
+
+
+def test_compressed_replay_sample():
+    replay = CompressedReplay(capacity=16, min_size=4, batch_size=8, cache_size=4)
+    for o in range(40):
+        obs = np.full((6, 6), o, dtype=np.uint8)
+        replay.add(obs=obs, action=o, reward=o, obs_next=obs + 1, term=False)
+    for _ in range(10):
+        obs, action, reward, obs_next, _, _, _ = replay.sample()
+        assert obs.dtype == np.uint8 and obs.shape == (8, 6, 6)
+        npt.assert_array_equal(obs[:, 0, 0], action)
+        npt.assert_array_equal(obs + 1, obs_next)
+    assert len(replay._cache) <= 4
+    assert replay.compression_ratio > 1
+
+
+def test_compressed_replay_encodes_frames_once():
+    class CountingCodec(object):
+        calls = 0
+
+        def compress(self, data):
+            CountingCodec.calls += 1
+            return data
+
+        def decompress(self, data):
+            return data
+
+    replay = CompressedReplay(capacity=8, min_size=1, batch_size=4, codec=CountingCodec())
+    for o in range(20):
+        obs = np.full((2, 2), o, dtype=np.uint8)
+        replay.add(obs=obs, action=o, reward=o, obs_next=obs + 1, term=o % 5 == 4)
+    # One frame per transition, plus the first frame of each of 4 episodes.
+    assert CountingCodec.calls == 24
+    for _ in range(5):
+        obs, action, _, obs_next, _, _, _ = replay.sample()
+        npt.assert_array_equal(obs[:, 0, 0], action)
+        npt.assert_array_equal(obs + 1, obs_next)
+
+
+def test_compressed_replay_save_load():
+    path = tempfile.mkdtemp()
+    try:
+        snapshot = os.path.join(path, 'replay')
+        replay = CompressedReplay(capacity=8, min_size=1, batch_size=4)
+        for o in range(11):
+            obs = np.full((3, 3), o, dtype=np.uint8)
+            replay.add(obs=obs, action=o, reward=o, obs_next=obs + 1, term=False)
+        replay.save(snapshot)
+        restored = CompressedReplay(capacity=8, min_size=1, batch_size=4)
+        restored.load(snapshot)
+        assert restored.size == replay.size and restored._obs == replay._obs
+        obs, action, _, obs_next, _, _, _ = restored.sample()
+        assert obs.dtype == np.uint8 and obs.shape == (4, 3, 3)
+        npt.assert_array_equal(obs[:, 0, 0], action)
+        npt.assert_array_equal(obs + 1, obs_next)
+        restored.add(obs=obs[0], action=0, reward=0, obs_next=obs[0], term=False)
+        restored.save(snapshot)
+    finally:
+        shutil.rmtree(path)
+
+
+def _episode_transitions(replay, lengths):
+    o = 0
+    for ep, length in enumerate(lengths):
+        for t in range(length):
+            replay.add(obs=o, action=ep, reward=t, obs_next=o + 1, term=t == length - 1)
+            o += 1
+
+
+def test_episode_replay_sequences():
+    replay = EpisodeReplay(capacity=32, min_size=4, batch_size=16, seq_len=4)
+    _episode_transitions(replay, [6, 2, 10, 3, 9, 7])
+    obs, action, reward, obs_next, term, idxs, importance = replay.sample()
+    assert obs.shape == (16, 4) and importance.shape == (16,)
+    npt.assert_array_equal(np.diff(obs, axis=1), 1)
+    npt.assert_array_equal(obs_next[:, :-1], obs[:, 1:])
+    # Sequences stay within a single episode and don't reach overwritten transitions.
+    assert np.all(action == action[:, :1])
+    npt.assert_array_equal(np.diff(reward, axis=1), 1)
+    assert not np.any(term[:, :-1])
+    assert set(action[:, 0]) <= {2, 4, 5}
+    assert obs.min() >= 37 - 31
+
+    crossing = EpisodeReplay(capacity=32, min_size=4, batch_size=16, seq_len=4,
+                             cross_episodes=True)
+    _episode_transitions(crossing, [2, 2, 2])
+    obs = crossing.sample()[0]
+    npt.assert_array_equal(np.diff(obs, axis=1), 1)
+    assert set(obs[:, 0]) <= {0, 1, 2}
+
+
+def test_episode_replay_sample_empty():
+    for cross_episodes in [False, True]:
+        replay = EpisodeReplay(capacity=32, min_size=4, batch_size=16, seq_len=4,
+                               cross_episodes=cross_episodes)
+        with pytest.raises(ValueError):
+            replay.sample()
+    # Episodes are shorter than the sequence length, only crossing sequences exist.
+    _episode_transitions(replay, [2, 3])
+    npt.assert_equal(replay.sample()[0].shape, (16, 4))
+    replay = EpisodeReplay(capacity=32, min_size=4, batch_size=16, seq_len=4)
+    _episode_transitions(replay, [2, 3])
+    with pytest.raises(ValueError):
+        replay.sample()
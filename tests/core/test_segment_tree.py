@@ -44,6 +44,32 @@ def test_sumtree_distribution():
     npt.assert_almost_equal(expected_priors, received_priors, decimal=4)
 
 
+def test_sumtree_batch_find_idx():
+    capacity = 1000
+    tree = SumTree(capacity)
+    for i in range(capacity):
+        tree.append(np.random.uniform())
+    sums = np.random.uniform(0, tree.sum(), 256)
+    npt.assert_equal(tree.find_sum_idx(sums), [tree.find_sum_idx(s) for s in sums])
+
+
+def test_tree_batch_update():
+    capacity = 300
+    values = np.random.uniform(size=capacity)
+    sumtree = SumTree(capacity)
+    mintree = MinTree(capacity)
+    for v in values:
+        sumtree.append(v)
+        mintree.append(v)
+    idxs = np.random.choice(capacity, 64, replace=False)
+    values[idxs] = np.random.uniform(size=64)
+    sumtree.update(idxs, values[idxs])
+    mintree.update(idxs, values[idxs])
+    npt.assert_almost_equal(sumtree.sum(), np.sum(values))
+    npt.assert_almost_equal(mintree.min(), np.min(values))
+    npt.assert_equal(sumtree[idxs], values[idxs])
+
+
 def test_mintree_min():
     capacity = 100000
     dataset = list(range(capacity))
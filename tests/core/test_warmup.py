@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import numpy.testing as npt
+from reinforceflow.core import ExperienceReplay, FrameStackReplay, fill_replay
+
+
+class CounterEnv(object):
+    """Observation counts steps of the episode, episodes last from 3 to 7 steps."""
+    def __init__(self):
+        self._t = 0
+        self._length = 5
+
+    def reset(self):
+        self._t = 0
+        self._length = np.random.randint(3, 8)
+        return np.array([self._t, self._length], dtype=np.float32)
+
+    def step(self, action):
+        self._t += 1
+        obs = np.array([self._t, self._length], dtype=np.float32)
+        return obs, 1.0, self._t == self._length, {}
+
+    def action_sample(self):
+        return np.eye(2)[np.random.randint(2)]
+
+
+def test_fill_replay_contiguous():
+    replay = ExperienceReplay(capacity=500, min_size=200, batch_size=32)
+    num_added = fill_replay(CounterEnv(), replay, replay.min_size, num_workers=3)
+    assert num_added >= 200 and replay.size == num_added
+    assert replay.is_ready
+    terms = replay._terms[:num_added]
+    assert terms[-1]
+    obs = replay._obs[:num_added + 1]
+    # Every episode starts from zero and counts up to its length.
+    starts = np.concatenate([[0], np.flatnonzero(terms)[:-1] + 1])
+    npt.assert_array_equal(obs[starts, 0], 0)
+    steps = np.diff(obs[:, 0])
+    npt.assert_array_equal(steps[~terms], 1)
+    npt.assert_array_equal(obs[np.flatnonzero(terms), 0] + 1, obs[np.flatnonzero(terms), 1])
+
+
+def test_fill_frame_stack_replay():
+    replay = FrameStackReplay(capacity=100, min_size=50, batch_size=16, obs_stack=1)
+    fill_replay(CounterEnv(), replay, replay.min_size, num_workers=2, reward_clip=0.5)
+    obs, _, reward, obs_next, term, _, _ = replay.sample()
+    npt.assert_array_equal(reward, 0.5)
+    npt.assert_array_equal(obs_next[~term, ..., 0], obs[~term, ..., 0] + 1)
@@ -0,0 +1,196 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import numpy.testing as npt
+from gym import spaces
+import reinforceflow
+import reinforceflow.envs.gym_wrapper
+from reinforceflow.envs import GymPixelWrapper
+
+
+class FakeALE(object):
+    """Screen value equals the number of emulated frames, life is lost every 50 frames."""
+    def __init__(self):
+        self.frame = 0
+        self.fetches = 0
+
+    def act(self, action):
+        self.frame += 1
+        return action
+
+    def game_over(self):
+        return self.frame >= 200
+
+    def lives(self):
+        return 5 - self.frame // 50
+
+    def getScreenDims(self):
+        return 8, 6
+
+    def getScreenGrayscale(self, screen):
+        self.fetches += 1
+        screen[...] = self.frame % 256
+
+
+class FakeAtariEnv(object):
+    action_space = spaces.Discrete(2)
+    observation_space = spaces.Box(low=0, high=255, shape=(6, 8, 3))
+    frameskip = 2
+    _max_episode_steps = 10000
+
+    def __init__(self):
+        self.ale = FakeALE()
+        self._action_set = [0, 1]
+        self.unwrapped = self
+
+    def reset(self):
+        self.ale.frame = 0
+        return np.zeros((6, 8, 3), dtype=np.uint8)
+
+    def step(self, action):
+        raise AssertionError('Gym step must be bypassed.')
+
+
+def test_ale_grayscale_step():
+    raw_env = FakeAtariEnv()
+    env = GymPixelWrapper(raw_env, action_repeat=3, obs_stack=2, to_gray=True,
+                          merge_last_frames=True, uint8_obs=True)
+    obs = env.reset()
+    assert obs.shape == (6, 8, 2) and obs.dtype == np.uint8
+    fetches = raw_env.ale.fetches
+    obs, reward, done, info = env.step(np.array([0, 1]))
+    # 3 repeats x 2 skipped frames, screen fetched only for the last two of them.
+    assert raw_env.ale.frame == 6 and raw_env.ale.fetches - fetches == 2
+    assert reward == 6 and not done and info['ale.lives'] == 5
+    npt.assert_array_equal(obs[..., 0], 0)
+    npt.assert_array_equal(obs[..., 1], 6)
+    # Step stops on the life loss.
+    for _ in range(7):
+        obs, _, done, _ = env.step(np.array([1, 0]))
+    assert raw_env.ale.frame == 48
+    obs, _, done, _ = env.step(np.array([1, 0]))
+    assert raw_env.ale.frame == 50 and not done
+    npt.assert_array_equal(obs[..., 1], 50)
+
+
+class FlickerEnv(FakeAtariEnv):
+    """Gym env, which draws sprite only on odd frames."""
+    def __init__(self):
+        super(FlickerEnv, self).__init__()
+        self.t = 0
+
+    def reset(self):
+        self.t = 0
+        return np.zeros((6, 8, 3), dtype=np.uint8)
+
+    def step(self, action):
+        self.t += 1
+        obs = np.zeros((6, 8, 3), dtype=np.uint8)
+        obs[:, self.t % 8] = 100 if self.t % 2 else 0
+        return obs, 0.0, False, {}
+
+
+def test_merge_last_frames():
+    for repeat in [1, 4]:
+        raw_env = FlickerEnv()
+        env = GymPixelWrapper(raw_env, action_repeat=repeat, obs_stack=1,
+                              merge_last_frames=True, uint8_obs=True)
+        env.reset()
+        obs = env.step(np.array([1, 0]))[0]
+        if repeat == 1:
+            # Reset frame is not merged.
+            npt.assert_array_equal(obs[:, 1], 100)
+            obs = env.step(np.array([1, 0]))[0]
+        # Sprite from the previous (odd) frame is kept on the even frame.
+        assert raw_env.t % 2 == 0
+        npt.assert_array_equal(obs[:, (raw_env.t - 1) % 8], 100)
+        npt.assert_array_equal(np.delete(obs, (raw_env.t - 1) % 8, axis=1), 0)
+
+
+class FakeSpec(object):
+    id = 'FakeAtari-v0'
+
+
+class SeededAtariEnv(FakeAtariEnv):
+    spec = FakeSpec()
+
+    def __init__(self):
+        super(SeededAtariEnv, self).__init__()
+        self.seed_value = None
+
+    def seed(self, seed=None):
+        self.seed_value = seed
+
+
+class FakeALEState(FakeALE):
+    def cloneState(self):
+        return self.frame
+
+    def restoreState(self, state):
+        self.frame = state
+
+
+def test_copy_recreates_env(monkeypatch):
+    def make(env_id):
+        assert env_id == 'FakeAtari-v0'
+        env = SeededAtariEnv()
+        env.ale = FakeALEState()
+        return env
+    monkeypatch.setattr(reinforceflow.envs.gym_wrapper.gym, 'make', make)
+    monkeypatch.setattr(reinforceflow, '__RANDOM_SEED__', 100)
+    env = GymPixelWrapper(make('FakeAtari-v0'), action_repeat=2, obs_stack=2, to_gray=True,
+                          uint8_obs=True, resize_width=4, resize_height=3)
+    env.step(np.array([0, 1]))
+    clone = env.copy()
+    assert clone.env is not env.env
+    assert clone.obs_shape == env.obs_shape == [3, 4, 2]
+    assert clone.env.seed_value not in (None, 100, env.env.seed_value)
+    assert clone.copy().env.seed_value != clone.env.seed_value
+    assert clone._init_kwargs == env._init_kwargs
+    # Emulates elapsed steps of the Gym `TimeLimit` wrapper.
+    env.env._elapsed_steps = 7
+    state_clone = env.copy(clone_state=True)
+    assert state_clone.env.ale.frame == env.env.ale.frame == 4
+    assert state_clone._elapsed_steps == env._elapsed_steps == 2
+    assert state_clone.env._elapsed_steps == 7
+    assert clone._elapsed_steps == 0
+    npt.assert_array_equal(state_clone._obs_stack.frames(), env._obs_stack.frames())
+
+
+def test_close_closes_raw_env():
+    env = GymPixelWrapper(FakeAtariEnv(), action_repeat=1, obs_stack=1, to_gray=True)
+    closed = []
+    env.env.close = lambda: closed.append(True)
+    env.close()
+    assert closed == [True]
+
+
+class PrivateAttrWrapper(object):
+    """Emulates Gym wrapper, which doesn't forward private attributes."""
+    def __init__(self, env, **attrs):
+        self.env = env
+        self.__dict__.update(attrs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.env, name)
+
+    def reset(self):
+        return self.env.reset()
+
+
+def test_ale_step_time_limit():
+    raw_env = FakeAtariEnv()
+    # Emulates `OrderEnforcing(TimeLimit(env))`, created by `gym.make`.
+    time_limit = PrivateAttrWrapper(raw_env, _max_episode_steps=4)
+    env = GymPixelWrapper(PrivateAttrWrapper(time_limit), action_repeat=2, obs_stack=1,
+                          to_gray=True)
+    env.reset()
+    assert not env.step(np.array([1, 0]))[2]
+    assert env.step(np.array([1, 0]))[2]
+    assert raw_env.ale.frame == 8
+    env.reset()
+    assert not env.step(np.array([1, 0]))[2]
@@ -0,0 +1,53 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import numpy.testing as npt
+from reinforceflow.envs import VecEnvWrapper
+
+
+class CounterEnv(object):
+    """Observation is filled with the step number, episode lasts `length` steps."""
+    is_cont_action = False
+    is_cont_obs = True
+    is_multiaction = False
+    action_shape = [2]
+
+    def __init__(self, length):
+        self._length = length
+        self._t = 0
+
+    def reset(self):
+        self._t = 0
+        return np.zeros((3, 3), dtype=np.uint8)
+
+    def step(self, action):
+        self._t += 1
+        obs = np.full((3, 3), self._t + 10 * np.argmax(action), dtype=np.uint8)
+        return obs, 1.0, self._t == self._length, {}
+
+    def action_sample(self):
+        return np.eye(2)[np.random.randint(2)]
+
+
+def test_vec_env_step_auto_reset():
+    env = VecEnvWrapper([CounterEnv(2), CounterEnv(3)])
+    try:
+        assert env.obs_shape == [3, 3] and len(env) == 2
+        obs = env.reset()
+        assert obs.shape == (2, 3, 3) and obs.dtype == np.uint8
+        npt.assert_array_equal(obs, 0)
+        obs, rewards, terms, infos = env.step([[1, 0], [0, 1]])
+        npt.assert_array_equal(obs[:, 0, 0], [1, 11])
+        npt.assert_array_equal(rewards, [1, 1])
+        obs_prev = obs
+        obs, _, terms, infos = env.step([[1, 0], [1, 0]])
+        npt.assert_array_equal(terms, [True, False])
+        npt.assert_array_equal(obs[:, 0, 0], [0, 2])
+        npt.assert_array_equal(infos[0]['terminal_obs'], 2)
+        # Returned observations don't alias the shared buffer.
+        npt.assert_array_equal(obs_prev[:, 0, 0], [1, 11])
+        assert len(env.action_sample()) == 2
+    finally:
+        env.close()
@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import multiprocessing as mp
+
+import numpy as np
+import numpy.testing as npt
+from reinforceflow.utils import FrameStack, ImagePreprocessor, IncrementalAverage, Counter
+from reinforceflow.utils import stack_observations, image_preprocess
+
+
+def _check_frame_stack(obs_shape, stack_len=4):
+    frames = [np.random.randint(0, 255, obs_shape).astype(np.uint8) for _ in range(10)]
+    frame_stack = FrameStack(stack_len)
+    expected = stack_observations(frames[0], stack_len)
+    npt.assert_array_equal(frame_stack.reset(frames[0]), expected)
+    for frame in frames[1:]:
+        expected = stack_observations(frame, stack_len, expected)
+        stacked = frame_stack.push(frame)
+        npt.assert_array_equal(stacked, expected)
+        assert stacked.dtype == np.uint8
+    npt.assert_array_equal(frame_stack.frames()[-1], frames[-1])
+    # Returned stacks stay intact after the next push.
+    frame_stack.push(frames[0])
+    npt.assert_array_equal(stacked, expected)
+    frame_stack.clear()
+    npt.assert_array_equal(frame_stack.push(frames[3]), stack_observations(frames[3], stack_len))
+
+
+def test_frame_stack():
+    _check_frame_stack((5,))
+    _check_frame_stack((6, 7, 1))
+    _check_frame_stack((6, 7, 3), stack_len=2)
+    _check_frame_stack((6, 7, 3), stack_len=1)
+
+
+def test_image_preprocessor():
+    y, x = np.mgrid[0:210, 0:160]
+    img = np.stack([y, x, (x + y) // 2], axis=-1).astype(np.uint8)
+    gray = ImagePreprocessor(to_gray=True)(img)
+    assert gray.shape == (210, 160, 1) and gray.dtype == np.uint8
+    npt.assert_allclose(gray, image_preprocess(img, None, None, True) * 255, atol=1)
+    for interpolation in ['area', 'bilinear']:
+        preprocessor = ImagePreprocessor(84, 84, to_gray=True, interpolation=interpolation)
+        out = np.empty(preprocessor.output_shape(img.shape), dtype=np.uint8)
+        result = preprocessor(img, out=out)
+        assert result is out and out.shape == (84, 84, 1)
+        npt.assert_allclose(out, image_preprocess(img, 84, 84, True) * 255, atol=3)
+    rgb = ImagePreprocessor(42, 21)(img)
+    assert rgb.shape == (21, 42, 3)
+    npt.assert_allclose(rgb, image_preprocess(img, 42, 21, False) * 255, atol=3)
+
+
+def test_incremental_average_statistics():
+    values = np.random.normal(5, 2, size=50)
+    average = IncrementalAverage()
+    for value in values[:20]:
+        average.add(value)
+    average.add_batch(values[20:])
+    assert average.length == 50
+    npt.assert_allclose(average.compute_average(), np.mean(values))
+    npt.assert_allclose(average.variance, np.var(values, ddof=1))
+    npt.assert_allclose(average.confidence_interval(), 1.96 * np.std(values, ddof=1) / np.sqrt(50))
+    assert average.max == np.max(values) and average.min == np.min(values)
+    average.reset()
+    average.add(1.0)
+    assert average.variance == 0 and np.isinf(average.confidence_interval())
+
+
+def _increment(counter, n):
+    for _ in range(n):
+        counter.increment()
+
+
+def test_counter_threads():
+    counter = Counter(value=5)
+    threads = [threading.Thread(target=_increment, args=(counter, 1000)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert counter.value == 4005
+    counter.value = 1
+    assert counter.increment(2) == 3
+
+
+def test_counter_shared():
+    counter = Counter(shared=True)
+    workers = [mp.Process(target=_increment, args=(counter, 500)) for _ in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert counter.value == 1500